@@ -1,7 +1,38 @@
 """A pipeline to generate wideband TOAs from CHIME fold mode data."""
 
-from . import exec, fileutils, session, toautils, validation, _version
+from . import (
+    align_port,
+    cache,
+    exec,
+    fileutils,
+    index,
+    manifest,
+    pipeline,
+    psrfits,
+    scheduler,
+    session,
+    toautils,
+    trace,
+    validation,
+    watch,
+    _version,
+)
 
-__all__ = ["exec", "fileutils", "session", "toautils", "validation"]
+__all__ = [
+    "align_port",
+    "cache",
+    "exec",
+    "fileutils",
+    "index",
+    "manifest",
+    "pipeline",
+    "psrfits",
+    "scheduler",
+    "session",
+    "toautils",
+    "trace",
+    "validation",
+    "watch",
+]
 
 __version__ = _version.get_versions()["version"]
@@ -1,17 +1,320 @@
-import matplotlib.pyplot as plt
+"""Find the change in DM that best aligns the frequency channels of a portrait,
+and estimate per-epoch DM offsets for all processed archives of a pulsar."""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+from multiprocessing import Pool
+
 import numpy as np
 import pplib
-from astropy import constants as c
-from astropy import units as u
+from astropy.io import fits
+from loguru import logger as log
+
+from .cache import evict_lru, get_params_key, touch
+from .psrfits import DM_CONSTANT, read_portrait
+from .scheduler import parse_size
+
+# Maximum number of complex elements in the (trials, channels, harmonics) array of
+# phase ramps evaluated at once.
+MAX_RAMP_BATCH_SIZE = 2**24
+
+# Adaptive DM search: initial half-width and number of points of the coarse grid,
+# target tolerance, and maximum number of times the coarse grid is widened.
+DM_SEARCH_RANGE = 1e-2
+DM_COARSE_TRIALS = 9
+DM_TOLERANCE = 1e-5
+DM_MAX_WIDEN = 5
+
+# The statistic is considered flat if its values differ by less than this fraction
+# of its maximum.
+DM_FLAT_RTOL = 1e-10
+
+INVERSE_GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+
+# Number of frequency subbands in the shifted profile plots.
+PLOT_SUBBANDS = 8
+
+# Arrays of a pplib.DataPortrait stored in the portrait cache.
+PORTRAIT_ARRAYS = ["port", "weights", "freqs", "Ps"]
+
+
+class Portrait:
+    """The arrays of a pplib.DataPortrait used in this module."""
+
+    def __init__(self, port, weights, freqs, Ps):
+        self.port = port
+        self.weights = weights
+        self.freqs = freqs
+        self.Ps = Ps
+
+
+def load_portrait(datafile, chunk_size=None):
+    """Load a portrait using pplib.DataPortrait, which reads the whole archive into
+    memory. If `chunk_size` (bytes) is given, the time-scrunched portrait is read
+    using the native PSRFITS reader instead, in chunks of subintegrations of about
+    this size (see `chimerawb.psrfits.read_portrait`)."""
+    if chunk_size is None:
+        return pplib.DataPortrait(datafile=datafile)
+    return Portrait(*read_portrait(datafile, chunk_size))
+
+
+class PortraitCache:
+    """Cache of loaded portraits, stored as .npy files in `cache_dir` which are
+    memory-mapped when the portrait is loaded again. Entries are keyed by the path,
+    size and modification time of the archive and the load parameters. If
+    `max_size` (bytes) is given, the least recently used entries are removed as a
+    whole each time the cache grows beyond it. Removing an entry does not affect
+    the portraits already memory-mapped from it."""
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def get_entry_dir(self, datafile, chunk_size):
+        stat = os.stat(datafile)
+        # The chunk size does not change the portrait read natively.
+        load_params = {"reader": "native"} if chunk_size is not None else {}
+        params = json.dumps(
+            {
+                "archive": os.path.realpath(datafile),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                **load_params,
+            },
+            sort_keys=True,
+        )
+        return f"{self.cache_dir}/{get_params_key(params)}"
+
+    def load(self, datafile, chunk_size=None):
+        """Load a portrait from the cache, or using `load_portrait` and store it in
+        the cache."""
+        entry_dir = self.get_entry_dir(datafile, chunk_size)
+        try:
+            arrays = {
+                name: np.load(f"{entry_dir}/{name}.npy", mmap_mode="r")
+                for name in PORTRAIT_ARRAYS
+            }
+            for name in PORTRAIT_ARRAYS:
+                touch(f"{entry_dir}/{name}.npy")
+            return Portrait(**arrays)
+        except (OSError, ValueError):
+            pass
+
+        dp = load_portrait(datafile, chunk_size)
+        arrays = {name: np.asarray(getattr(dp, name)) for name in PORTRAIT_ARRAYS}
+        self.store(entry_dir, arrays)
+        return Portrait(**arrays)
+
+    def store(self, entry_dir, arrays):
+        # Write to a temporary directory first so that other processes never see
+        # an incomplete entry.
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(f"{tmp_dir}/{name}.npy", array)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # Stored by another process in the meantime.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        if self.max_size is not None:
+            evict_lru(self.cache_dir, self.max_size)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within
+        `max_size`, and the entries left incomplete by interrupted processes. This
+        should only be called when no other process is using the cache."""
+        if self.max_size is not None and os.path.isdir(self.cache_dir):
+            evict_lru(self.cache_dir, self.max_size, cleanup=True)
+
+
+def get_dm_phase_delays(freqs, P, delta_DM):
+    """Dispersion delay (in units of pulse phase) of each frequency channel relative
+    to the highest frequency, for each trial change in DM.
+    Parameter
+    ---------
+    freqs : np.ndarray
+         channel frequencies in MHz (nchan)
+    P : float
+         pulse period in s
+    delta_DM : np.ndarray
+         array of delta DM values (ntrial)
+    Returns
+    -------
+    np.ndarray
+        phase delays (ntrial x nchan)
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    return np.outer(delta_DM, DM_CONSTANT * (freqs**-2 - freqs.max() ** -2) / P)
+
+
+class DispersionStatistic:
+    """Standard deviation across the frequency-summed profile as a function of the
+    change in DM. The portrait is Fourier transformed once, the channels are
+    shifted by applying the phase ramps of all trials (including fractional-bin
+    shifts) in a single broadcast multiplication, and the standard deviation is
+    computed from the harmonics of the summed profile (Parseval's theorem).
+    Parameter
+    ---------
+    port : np.ndarray
+         portrait (nchan x nbin)
+    freqs : np.ndarray
+         channel frequencies in MHz (nchan)
+    P : float
+         pulse period in s
+    """
+
+    def __init__(self, port, freqs, P):
+        self.nbin = port.shape[1]
+        self.port_fft = np.fft.rfft(port, axis=1)
+        self.harmonics = np.arange(self.port_fft.shape[1])
+
+        # The mean (harmonic 0) does not contribute to the standard deviation, and
+        # all harmonics except the Nyquist harmonic appear twice in the full spectrum.
+        self.parseval_weights = np.full(len(self.harmonics), 2.0)
+        self.parseval_weights[0] = 0
+        if self.nbin % 2 == 0:
+            self.parseval_weights[-1] = 1
+
+        self.unit_delays = get_dm_phase_delays(freqs, P, [1.0])[0]
+
+    def __call__(self, delta_DM):
+        """Standard deviation for each value in the array `delta_DM`."""
+        delta_DM = np.atleast_1d(delta_DM)
+        delays = np.outer(delta_DM, self.unit_delays)
+        std = np.zeros(len(delta_DM))
+        batch_size = max(1, MAX_RAMP_BATCH_SIZE // self.port_fft.size)
+        for start in range(0, len(delta_DM), batch_size):
+            ramps = np.exp(
+                -2j
+                * np.pi
+                * delays[start : start + batch_size, :, None]
+                * self.harmonics
+            )
+            # sum over all channels
+            profile_fft = np.einsum("tck,ck->tk", ramps, self.port_fft)
+            std[start : start + batch_size] = (
+                np.sqrt((self.parseval_weights * np.abs(profile_fft) ** 2).sum(axis=1))
+                / self.nbin
+            )
+        return std
+
+
+def get_trial_stds(port, freqs, P, delta_DM):
+    """Compute the standard deviation across the frequency-summed profile for each
+    trial change in DM (see `DispersionStatistic`).
+    Returns
+    -------
+    std : np.ndarray
+        standard deviation as a function of delta_DM
+    """
+    return DispersionStatistic(port, freqs, P)(delta_DM)
+
+
+def is_flat(values, rtol=DM_FLAT_RTOL):
+    """Whether the values of a statistic are NaN or too flat to have a maximum."""
+    values = np.asarray(values)
+    if not np.all(np.isfinite(values)):
+        return True
+    return np.ptp(values) <= rtol * np.abs(values).max()
+
+
+def optimize_DM(
+    statistic,
+    dm_range=DM_SEARCH_RANGE,
+    ncoarse=DM_COARSE_TRIALS,
+    tol=DM_TOLERANCE,
+    max_widen=DM_MAX_WIDEN,
+):
+    """Find the change in DM that maximizes a smooth statistic using a coarse grid
+    followed by a golden-section search in the bracket around the coarse maximum.
+    If the coarse maximum is at the edge of the grid, the grid is moved to the edge
+    and widened (at most `max_widen` times). If the statistic is flat or NaN on the
+    coarse grid, NaN is returned.
+    Parameter
+    ---------
+    statistic : callable
+         function that evaluates the statistic for an array of delta DM values
+    dm_range : float, optional
+         the initial coarse grid spans [-dm_range, dm_range]
+    ncoarse : int, optional
+         number of points in the coarse grid
+    tol : float, optional
+         target tolerance of the change in DM
+    max_widen : int, optional
+         maximum number of times the coarse grid is widened
+    Returns
+    -------
+    float
+        Change in DM that maximizes the statistic (NaN if there is no maximum)
+    trials : dict
+        values of the statistic at each evaluated delta DM
+    """
+    trials = {}
+
+    def evaluate(dms):
+        values = statistic(np.asarray(dms, dtype=float))
+        trials.update(zip(dms, values))
+        return values
+
+    center, half_width = 0.0, dm_range
+    for _ in range(max_widen + 1):
+        grid = np.linspace(center - half_width, center + half_width, ncoarse)
+        values = evaluate(grid)
+        if is_flat(values):
+            log.warning(
+                f"The statistic is flat or NaN in the DM search range [{grid[0]:.3g}, {grid[-1]:.3g}]."
+            )
+            return np.nan, trials
+        j = np.argmax(values)
+        if 0 < j < ncoarse - 1:
+            break
+        # The maximum is at the edge of the grid.
+        center, half_width = grid[j], 2 * half_width
+    else:
+        log.warning(
+            f"The maximum is at the edge of the DM search range [{grid[0]:.3g}, {grid[-1]:.3g}]."
+        )
+        return grid[j], trials
+
+    # Golden-section search
+    a, b = grid[j - 1], grid[j + 1]
+    c = b - INVERSE_GOLDEN_RATIO * (b - a)
+    d = a + INVERSE_GOLDEN_RATIO * (b - a)
+    fc, fd = evaluate([c, d])
+    while b - a > tol:
+        if fc > fd:
+            b, d, fd = d, c, fc
+            c = b - INVERSE_GOLDEN_RATIO * (b - a)
+            fc = evaluate([c])[0]
+        else:
+            a, c, fc = c, d, fd
+            d = a + INVERSE_GOLDEN_RATIO * (b - a)
+            fd = evaluate([d])[0]
+
+    return (a + b) / 2, trials
 
-norm = True
-subbands = 8
-delta_DM = 0
-portrait = "dm_test/J1012_dm_test.port"
 
 # Find the DM that maximizes the standard deviation
-def find_DM(datafile, delta_DM=np.linspace(-1e-2, 1e-2), return_std=False):
-    """Find the change in DM that maximizes the standard deviation across the profile
+def find_DM(
+    datafile,
+    delta_DM=None,
+    return_std=False,
+    tol=DM_TOLERANCE,
+    cache=None,
+    chunk_size=None,
+):
+    """Find the change in DM that maximizes the standard deviation across the profile.
+    If `delta_DM` is not given, the DM is found using an adaptive search
+    (see `optimize_DM`). Otherwise, the standard deviation is evaluated at each
+    value in `delta_DM` and a parabola is fitted around the maximum. If the maximum
+    is at the edge of `delta_DM`, that edge is returned. If the standard deviation
+    is flat or NaN, NaN is returned.
     Parameter
     ---------
     datafile : str
@@ -20,104 +323,343 @@ def find_DM(datafile, delta_DM=np.linspace(-1e-2, 1e-2), return_std=False):
          array of delta DM values
     return_std : bool, optional
          whether to return the array of standard deviations or not
+    tol : float, optional
+         target tolerance of the change in DM for the adaptive search
+    cache : PortraitCache, optional
+         cache used to load the portrait
+    chunk_size : int, optional
+         read the portrait natively in chunks of this size (bytes) instead of
+         using pplib (see `load_portrait`)
     Returns
     -------
     float
         Change in DM that maximizes standard deviation
     std : np.ndarray
-        standard deviation as a function of delta_DM (if requested)
+        standard deviation as a function of delta_DM (if requested). For the
+        adaptive search, the evaluated delta DM values and the standard deviations
+        (both sorted by delta DM) are returned.
     """
-    dp = pplib.DataPortrait(datafile=datafile)
-    phase = np.arange(dp.port.shape[1]) / dp.port.shape[1]
-    P = dp.Ps[0] * u.s
-    timebin = (phase * P)[1] - (phase * P)[0]
-    std = np.zeros(len(delta_DM))
-    for j in range(len(delta_DM)):
-        # for the full portrait
-        time_delay_portrait = (
-            (dp.freqs**-2 - dp.freqs.max() ** -2) * 4.15e6 * u.ms * delta_DM[j]
-        )
-        shift_bins_portrait = np.int16(
-            np.round((time_delay_portrait[0] / timebin).decompose())
-        )
-        shifted_portrait = np.zeros_like(dp.port)
-        for i in range(dp.port.shape[0]):
-            shifted_portrait[i] = np.roll(dp.port[i], shift_bins_portrait[i])
-        # sum over all channels
-        profile = shifted_portrait.sum(axis=0)
-        # and compute standard deviation over phase bins
-        std[j] = profile.std()
-    # find the index where std is max
-    j = np.where(std == std.max())[0][0]
-    # fit a parabola to interpolate
-    fit = np.polyfit(delta_DM[j - 2 : j + 2], std[j - 2 : j + 2], 2)
+    dp = load_cached_portrait(datafile, cache, chunk_size)
+    return find_DM_portrait(dp, delta_DM, return_std, tol)
+
+
+def load_cached_portrait(datafile, cache=None, chunk_size=None):
+    """Load a portrait using `cache` if given (see `load_portrait`)."""
+    if cache is not None:
+        return cache.load(datafile, chunk_size)
+    return load_portrait(datafile, chunk_size)
+
+
+def find_DM_portrait(dp, delta_DM=None, return_std=False, tol=DM_TOLERANCE):
+    """Same as `find_DM` for a portrait that has already been loaded."""
+    statistic = DispersionStatistic(dp.port, dp.freqs[0], dp.Ps[0])
+
+    if delta_DM is None:
+        best_DM, trials = optimize_DM(statistic, tol=tol)
+        if not return_std:
+            return best_DM
+        trial_DMs = np.array(sorted(trials))
+        return best_DM, (trial_DMs, np.array([trials[dm] for dm in trial_DMs]))
+
+    delta_DM = np.asarray(delta_DM, dtype=float)
+    std = statistic(delta_DM)
+    if is_flat(std):
+        log.warning("The standard deviation is flat or NaN for all trial DMs.")
+        best_DM = np.nan
+    else:
+        # find the index where std is max
+        j = np.argmax(std)
+        best_DM = delta_DM[j]
+        if 0 < j < len(delta_DM) - 1:
+            # fit a parabola to interpolate, using at most two points on each side
+            # of the maximum
+            lo, hi = max(j - 2, 0), min(j + 3, len(delta_DM))
+            fit = np.polyfit(delta_DM[lo:hi], std[lo:hi], 2)
+            if fit[0] < 0:
+                best_DM = -fit[1] / 2 / fit[0]
+        else:
+            log.warning(
+                f"The maximum is at the edge of the trial DMs [{delta_DM[0]:.3g}, {delta_DM[-1]:.3g}]."
+            )
+
     if not return_std:
-        return -fit[1] / 2 / fit[0]
-    return -fit[1] / 2 / fit[0], std
-
-
-dp = pplib.DataPortrait(datafile=portrait)
-
-nchan_per_subband = dp.port.shape[0] // subbands
-profiles = np.zeros((subbands, dp.port.shape[1]))
-freqs = np.zeros((subbands)) * u.MHz
-phase = np.arange(dp.port.shape[1]) / dp.port.shape[1]
-P = dp.Ps[0] * u.s
-timebin = (phase * P)[1] - (phase * P)[0]
-
-
-# Calculating the average profile for each frequency subband
-for i in range(subbands):
-    d = dp.port[i * nchan_per_subband : (i + 1) * nchan_per_subband]
-    w = dp.weights[0, i * nchan_per_subband : (i + 1) * nchan_per_subband]
-    profiles[i] = (d.T * w).sum(axis=1).T / w.sum()
-    # weighted average frequency too
-    freqs[i] = (
-        (dp.freqs[0, i * nchan_per_subband : (i + 1) * nchan_per_subband] * w).sum()
-        / w.sum()
-        * u.MHz
+        return best_DM
+    return best_DM, std
+
+
+def get_subband_edges(nchan, subbands):
+    """Channel indices where each subband starts (and where the last one ends).
+    If `nchan` is not divisible by `subbands`, the first `nchan % subbands`
+    subbands have one more channel than the others."""
+    sizes = np.full(subbands, nchan // subbands)
+    sizes[: nchan % subbands] += 1
+    return np.concatenate([[0], np.cumsum(sizes)])
+
+
+def get_subband_profiles(port, weights, freqs, subbands, norm=True):
+    """Calculate the weighted average profile and the weighted average frequency
+    for each frequency subband of a portrait. All subbands are computed at once by
+    multiplying the portrait with a (subbands x nchan) matrix of channel weights,
+    without copying the portrait.
+    Parameter
+    ---------
+    port : np.ndarray
+         portrait (nchan x nbin)
+    weights : np.ndarray
+         channel weights (nchan)
+    freqs : np.ndarray
+         channel frequencies in MHz (nchan)
+    subbands : int
+         number of subbands
+    norm : bool, optional
+         whether to normalize each profile by its maximum
+    Returns
+    -------
+    profiles : np.ndarray
+        subband profiles (subbands x nbin)
+    freqs : np.ndarray
+        subband frequencies in MHz (subbands)
+    """
+    nchan = port.shape[0]
+    edges = get_subband_edges(nchan, subbands)
+    subband_idxs = np.searchsorted(edges, np.arange(nchan), side="right") - 1
+
+    weight_matrix = np.zeros((subbands, nchan))
+    weight_matrix[subband_idxs, np.arange(nchan)] = weights
+    weight_sums = weight_matrix.sum(axis=1)
+
+    # Subbands where all channels have zero weight are NaN.
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profiles = (weight_matrix @ port) / weight_sums[:, None]
+        # weighted average frequency too
+        subband_freqs = (weight_matrix @ freqs) / weight_sums
+        if norm:
+            profiles /= profiles.max(axis=1, keepdims=True)
+
+    return profiles, subband_freqs
+
+
+def shift_profiles(profiles, freqs, P, delta_DM):
+    """Shift each profile by the dispersion delay (rounded to the nearest bin)
+    corresponding to `delta_DM`, relative to the highest frequency."""
+    nbin = profiles.shape[1]
+    shift_bins = np.int16(np.round(get_dm_phase_delays(freqs, P, [delta_DM])[0] * nbin))
+    return np.array(
+        [np.roll(profile, shift) for profile, shift in zip(profiles, shift_bins)]
     )
-    if norm:
-        profiles[i] /= profiles[i].max()
 
 
-plt.clf()
+def plot_shifted_profiles(dp, delta_DM, subbands, outfile, norm=True):
+    import matplotlib.pyplot as plt
+
+    profiles, freqs = get_subband_profiles(
+        dp.port, dp.weights[0], dp.freqs[0], subbands, norm
+    )
+    shifted_profiles = shift_profiles(profiles, freqs, dp.Ps[0], delta_DM)
+    phase = np.arange(dp.port.shape[1]) / dp.port.shape[1]
+
+    plt.clf()
+    for profile, freq in zip(shifted_profiles, freqs):
+        plt.plot(phase, profile, label=f"{freq} MHz")
+    plt.xlabel("Phase")
+    plt.ylabel("Amplitude")
+    plt.legend()
+    plt.savefig(outfile)
+
+
+def plot_shifted_portrait(dp, delta_DM, outfile):
+    import matplotlib.pyplot as plt
+
+    shifted_portrait = shift_profiles(dp.port, dp.freqs[0], dp.Ps[0], delta_DM)
 
-# Calculating the time delay between each frequency bin and the maximum frequency bin. Pulsar handbook equation 4.7
-time_delay = (
-    (freqs.to(u.MHz).value ** -2 - freqs.max().to(u.MHz).value ** -2)
-    * 4.15e6
-    * u.ms
-    * delta_DM
-)
+    plt.clf()
+    plt.imshow(shifted_portrait, aspect="auto")
+    plt.savefig(outfile)
 
-# How many phase bins to shift subbands based on time-delay
-shift_bins = np.int16(np.round((time_delay / timebin).decompose()))
 
+def plot_dm_search(trial_DMs, std, best_DM, outfile):
+    import matplotlib.pyplot as plt
 
-for i in range(subbands):
-    plt.plot(phase, np.roll(profiles[i], shift_bins[i]), label=f"{freqs[i].value} MHz")
+    plt.clf()
+    plt.plot(trial_DMs, std, best_DM, std.max(), "ro")
+    plt.xlabel("$\\Delta$DM")
+    plt.ylabel("Standard Deviation")
+    plt.savefig(outfile)
 
 
-plt.xlabel("Phase")
-plt.ylabel("Amplitude")
-plt.legend()
-plt.savefig("shifted_profiles.pdf")
+def get_archive_mjd(datafile):
+    """Start MJD of a PSRFITS archive, read from the primary header."""
+    header = fits.getheader(datafile)
+    return header["STT_IMJD"] + (header["STT_SMJD"] + header["STT_OFFS"]) / 86400
 
-# do the same operations for the full portrait
-time_delay_portrait = (dp.freqs**-2 - dp.freqs.max() ** -2) * 4.15e6 * u.ms * delta_DM
-shift_bins_portrait = np.int16(np.round((time_delay_portrait[0] / timebin).decompose()))
-shifted_portrait = np.zeros_like(dp.port)
-for i in range(dp.port.shape[0]):
-    shifted_portrait[i] = np.roll(dp.port[i], shift_bins_portrait[i])
 
-plt.clf()
-plt.imshow(shifted_portrait, aspect="auto")
-plt.savefig("shifted_portrait.pdf")
+def read_metafile(metafile):
+    """Read the list of processed archives from a chimerawb output metafile."""
+    with open(metafile, "r") as f:
+        return [line.strip() for line in f if line.strip() != ""]
 
-delta_DM, std = find_DM(portrait, np.linspace(-1e-2, 1e-2), return_std=True)
-plt.clf()
-plt.plot(np.linspace(-1e-2, 1e-2), std, delta_DM, std.max(), "ro")
-plt.xlabel("$\Delta$DM")
-plt.ylabel("Standard Deviation")
-plt.savefig("find_dm_correction.pdf")
+
+def find_DM_epoch(
+    datafile, tol=DM_TOLERANCE, plot_dir=None, cache=None, chunk_size=None
+):
+    """Find the change in DM for one processed archive. Returns a row of the
+    per-epoch DM table. Errors are logged and reported as NaN. If `plot_dir` is
+    given, the DM search and the subband profiles and the portrait shifted by the
+    change in DM are plotted there."""
+    row = {"archive": datafile, "mjd": np.nan, "delta_dm": np.nan, "ntrials": 0}
+    try:
+        row["mjd"] = get_archive_mjd(datafile)
+        dp = load_cached_portrait(datafile, cache, chunk_size)
+        best_DM, (trial_DMs, std) = find_DM_portrait(dp, return_std=True, tol=tol)
+        row["delta_dm"] = best_DM
+        row["ntrials"] = len(trial_DMs)
+
+        if plot_dir is not None:
+            prefix = f"{plot_dir}/{os.path.splitext(os.path.basename(datafile))[0]}"
+            plot_dm_search(trial_DMs, std, best_DM, f"{prefix}_dm.pdf")
+            if not np.isnan(best_DM):
+                plot_shifted_profiles(
+                    dp, best_DM, PLOT_SUBBANDS, f"{prefix}_shifted_profiles.pdf"
+                )
+                plot_shifted_portrait(dp, best_DM, f"{prefix}_shifted_portrait.pdf")
+    except Exception as err:
+        log.error(f"Failed to find the DM for {datafile}.")
+        log.error(err)
+
+    return row
+
+
+def find_DM_epoch_star(args):
+    return find_DM_epoch(*args)
+
+
+DM_TABLE_COLUMNS = ["archive", "mjd", "delta_dm", "ntrials"]
+
+
+def create_dm_table(
+    datafiles,
+    outfile,
+    jobs=1,
+    tol=DM_TOLERANCE,
+    plot_dir=None,
+    cache=None,
+    chunk_size=None,
+):
+    """Find the change in DM for each archive using `jobs` worker processes and
+    write a per-epoch DM table. If `outfile` ends with `.csv`, the rows are written
+    as soon as they are computed; otherwise, the table is saved as an `.npz` file
+    at the end (sorted by MJD). The portraits are loaded using `cache` if given, and
+    natively in chunks of `chunk_size` bytes if given (see `load_portrait`)."""
+    args_list = [(datafile, tol, plot_dir, cache, chunk_size) for datafile in datafiles]
+    streaming = outfile.endswith(".csv")
+
+    rows = []
+    with Pool(jobs) as pool, open(
+        outfile if streaming else os.devnull, "w", newline=""
+    ) as f:
+        writer = csv.DictWriter(f, fieldnames=DM_TABLE_COLUMNS)
+        writer.writeheader()
+        for idx, row in enumerate(
+            pool.imap_unordered(find_DM_epoch_star, args_list), start=1
+        ):
+            writer.writerow(row)
+            f.flush()
+            rows.append(row)
+            log.info(
+                f"[{idx}/{len(datafiles)}] {row['archive']} : MJD {row['mjd']:.6f}, ΔDM {row['delta_dm']:.6g}"
+            )
+
+    if cache is not None:
+        cache.evict()
+
+    if not streaming:
+        rows = sorted(rows, key=lambda row: (np.isnan(row["mjd"]), row["mjd"]))
+        np.savez(
+            outfile,
+            **{col: np.array([row[col] for row in rows]) for col in DM_TABLE_COLUMNS},
+        )
+
+    log.info(f"Wrote the DM table for {len(rows)} files to {outfile}.")
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Find the per-epoch change in DM for the processed archives listed in a chimerawb output metafile."
+    )
+    parser.add_argument(
+        "-m",
+        "--metafile",
+        required=True,
+        help="Metafile listing the processed archives (e.g. <pulsar>.meta in the chimerawb output dir).",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="Output DM table (.csv or .npz).",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of archives to process in parallel.",
+    )
+    parser.add_argument(
+        "--tol",
+        required=False,
+        type=float,
+        default=DM_TOLERANCE,
+        help="Target tolerance of the change in DM.",
+    )
+    parser.add_argument(
+        "--plot_dir",
+        required=False,
+        help="Directory where the DM search plots are saved (no plots by default).",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        required=False,
+        help="Directory where the loaded portraits are cached (no cache by default).",
+    )
+    parser.add_argument(
+        "--cache_size",
+        required=False,
+        help="Maximum size of the portrait cache (e.g. 100G). The least recently used portraits are removed first.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        required=False,
+        help="Read the archives with the native PSRFITS reader in chunks of subintegrations of about this size (e.g. 256M) instead of loading them whole with pplib.",
+    )
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        raise ValueError("The number of jobs (--jobs) must be positive.")
+    if args.plot_dir is not None:
+        os.makedirs(args.plot_dir, exist_ok=True)
+
+    cache = None
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        cache_size = (
+            parse_size(args.cache_size) if args.cache_size is not None else None
+        )
+        cache = PortraitCache(args.cache_dir, cache_size)
+    elif args.cache_size is not None:
+        log.warning("--cache_size has no effect without --cache_dir.")
+
+    datafiles = read_metafile(args.metafile)
+    log.info(f"Finding the DM for {len(datafiles)} files using {args.jobs} workers.")
+    chunk_size = parse_size(args.chunk_size) if args.chunk_size is not None else None
+    create_dm_table(
+        datafiles,
+        args.output,
+        args.jobs,
+        args.tol,
+        args.plot_dir,
+        cache,
+        chunk_size,
+    )
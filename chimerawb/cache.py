@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import shutil
+from functools import lru_cache
+
+from loguru import logger as log
+
+from .exec import get_psrchive_version
+from .fileutils import get_fused_script_filename
+from .manifest import get_file_hash
+from .session import PulsarConfig, Session
+
+
+@lru_cache()
+def get_tool_versions():
+    return {"psrchive": get_psrchive_version()}
+
+
+@lru_cache()
+def get_static_file_hash(filename: str):
+    """Hash of a file that does not change during a run (scripts, templates)."""
+    return get_file_hash(filename)
+
+
+def get_config_hash(session: Session):
+    return get_static_file_hash(session.config_file)[:16]
+
+
+def get_params_key(params: str):
+    """A short key identifying a set of stage parameters."""
+    return hashlib.blake2b(params.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def get_stage_params(session: Session, pulsar: PulsarConfig, input_hash: str):
+    """Parameters that determine the output of each processing stage, as JSON
+    strings to be stored in the manifest. The parameters of each stage include
+    the key of the preceding stage, so that a stage is rerun only if its own
+    parameters or those of a preceding stage have changed."""
+    versions = get_tool_versions()
+
+    # RFI excision does not depend on the pulsar config.
+    tfzap_script = shutil.which("chime_convert_and_tfzap.psh")
+    params_01 = json.dumps(
+        {"input": input_hash, "script": get_static_file_hash(tfzap_script), **versions},
+        sort_keys=True,
+    )
+    params_12 = json.dumps(
+        {
+            "input": get_params_key(params_01),
+            "nchan": pulsar.nchan,
+            "nsub": pulsar.nsub,
+            "dm": pulsar.dm,
+            "engine": pulsar.scrunch_engine,
+            **versions,
+        },
+        sort_keys=True,
+    )
+    params_23 = json.dumps(
+        {
+            "input": get_params_key(params_12),
+            "zap_chans": pulsar.zap_chans,
+            "engine": pulsar.pzap_engine,
+            **versions,
+        },
+        sort_keys=True,
+    )
+    stage_params = {"level01": params_01, "level12": params_12, "level23": params_23}
+
+    if session.fused:
+        fused_script = get_fused_script_filename(session, pulsar)
+        stage_params["fused"] = json.dumps(
+            {
+                "input": input_hash,
+                "script": get_static_file_hash(fused_script),
+                **versions,
+            },
+            sort_keys=True,
+        )
+
+    return stage_params
+
+
+def get_toa_params(pulsar: PulsarConfig):
+    """Parameters that determine the TOAs of a processed archive, as a JSON string
+    to be stored in the manifest."""
+    return json.dumps(
+        {"template": get_static_file_hash(pulsar.template), "dm": pulsar.dm},
+        sort_keys=True,
+    )
+
+
+def touch(filename: str):
+    """Mark a cached file as recently used."""
+    os.utime(filename)
+
+
+def get_entry_usage(entry_dir: str):
+    """Total size and last modification time of the files in a cache entry."""
+    size, mtime = 0, None
+    for root, dirs, files in os.walk(entry_dir):
+        for f in files:
+            try:
+                stat = os.stat(os.path.join(root, f))
+            except OSError:
+                continue
+            size += stat.st_size
+            mtime = stat.st_mtime if mtime is None else max(mtime, stat.st_mtime)
+    return size, mtime
+
+
+def evict_lru(cache_dir: str, max_size: int, cleanup: bool = False):
+    """Remove the least recently used entries (the subdirectories of `cache_dir`)
+    until the total size of the cache is within `max_size` bytes. Entries are
+    removed as a whole. Temporary (".tmp") and empty entries may still be being
+    written by other processes, so that they are removed only if `cleanup` is True
+    (Only when no other process is using the cache)."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if not os.path.isdir(entry_dir):
+            continue
+        size, mtime = get_entry_usage(entry_dir)
+        if mtime is None or name.endswith(".tmp"):
+            if cleanup:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            continue
+        entries.append((mtime, size, entry_dir))
+
+    total_size = sum(size for _, size, _ in entries)
+    for mtime, size, entry_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+        log.info(f"Removing {entry_dir} from the cache.")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+    return total_size
@@ -1,28 +1,301 @@
+import ast
+import datetime
 import json
+import os
+import resource
+import signal
+from functools import lru_cache
 from subprocess import Popen, check_output
 import sys
+import threading
 import time
 
+import numpy as np
 from loguru import logger as log
 from astropy.io import fits
 
 from .session import Session
+from ._version import get_versions
 
+# Resource usage fields that are peak values rather than totals.
+USAGE_PEAK_KEYS = ["max_rss"]
 
-def run_cmd(cmd: str, test_mode: bool):
-    """Run a shell command using Popen"""
+# Return codes of run_cmd for commands that were killed for exceeding a limit.
+KILLED_STATUSES = ["timeout", "memfail"]
+
+# Signals that terminate a command that has run out of memory: SIGABRT (e.g. an
+# uncaught std::bad_alloc) and SIGKILL (the OOM killer). SIGSEGV is not included
+# since it is also how corrupted archives crash psrsh.
+MEMORY_KILL_SIGNALS = [signal.SIGABRT, signal.SIGKILL]
+
+# Runs a shell command in a child process and writes the resource usage of the
+# shell and the commands it has run (a tuple of the rusage fields) to a file
+# descriptor, then exits in the same way as the shell. The maximum RSS reported by
+# wait4 includes the RSS of the parent at the time of the fork, so the shell is not
+# forked from the pipeline (which can be large) but from this small process.
+# Arguments: the command, the file descriptor and the memory limit (may be empty).
+RUSAGE_WRAPPER = """
+import os, resource, signal, sys
+cmd, fd, memory_limit = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+os.set_inheritable(fd, False)
+pid = os.fork()
+if pid == 0:
+    try:
+        if memory_limit:
+            limit = int(memory_limit)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        os.execv("/bin/sh", ["/bin/sh", "-c", cmd])
+    finally:
+        os._exit(127)
+_, status, rusage = os.wait4(pid, 0)
+os.write(fd, repr(tuple(rusage)).encode())
+os.close(fd)
+if os.WIFSIGNALED(status):
+    sig = os.WTERMSIG(status)
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    if sig not in (signal.SIGKILL, signal.SIGSTOP):
+        signal.signal(sig, signal.SIG_DFL)
+    os.kill(os.getpid(), sig)
+    sys.exit(128 + sig)
+sys.exit(os.WEXITSTATUS(status))
+"""
+
+
+def get_usage(rusage, start_rusage=None):
+    """Convert an rusage into a dict. If `start_rusage` is given, the usage since
+    then is returned, except for the maximum RSS (a peak value)."""
+    usage = {
+        "cpu_user": rusage.ru_utime,
+        "cpu_sys": rusage.ru_stime,
+        # Linux reports the maximum RSS in kB and I/O in 512-byte blocks.
+        "max_rss": rusage.ru_maxrss * 1024,
+        "read_bytes": rusage.ru_inblock * 512,
+        "write_bytes": rusage.ru_oublock * 512,
+        "voluntary_switches": rusage.ru_nvcsw,
+        "involuntary_switches": rusage.ru_nivcsw,
+    }
+    if start_rusage is not None:
+        start_usage = get_usage(start_rusage)
+        for key in usage:
+            if key not in USAGE_PEAK_KEYS:
+                usage[key] -= start_usage[key]
+    return usage
+
+
+def split_usage(usage: dict, n: int):
+    """Divide the resource usage of a command run on `n` files equally among them."""
+    if usage is None:
+        return None
+    return {
+        key: value if key in USAGE_PEAK_KEYS else value / n
+        for key, value in usage.items()
+    }
+
+
+def kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def get_exitcode(status: int):
+    """Convert a wait status into a return code, which is the negative signal number
+    if the process was killed by a signal (like os.waitstatus_to_exitcode, which
+    requires Python 3.9)."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def is_memory_kill(status: int):
+    """Check whether a wait status is that of a command terminated by one of
+    `MEMORY_KILL_SIGNALS`, either directly or as the last command of a shell (exit
+    code 128 + the signal number)."""
+    exitcode = get_exitcode(status)
+    return -exitcode in MEMORY_KILL_SIGNALS or exitcode - 128 in MEMORY_KILL_SIGNALS
+
+
+def read_wrapper_usage(fd: int):
+    """Read the resource usage written by `RUSAGE_WRAPPER` from the read end of its
+    pipe and close it. Returns None if the wrapper did not write it (e.g. because it
+    was killed)."""
+    with os.fdopen(fd, "rb") as f:
+        report = f.read()
+    try:
+        return resource.struct_rusage(ast.literal_eval(report.decode()))
+    except (SyntaxError, TypeError, ValueError):
+        return None
+
+
+def run_cmd(cmd: str, test_mode: bool, timeout: float = None, memory_limit: int = None):
+    """Run a shell command using Popen. Returns the return code, the execution time
+    and the resource usage of the command (see `get_usage`). The command is run in
+    its own process group, which is killed if the command runs for longer than
+    `timeout` seconds, in which case the return code is "timeout". If
+    `memory_limit` is given, the address space of the command and its children is
+    limited to `memory_limit` bytes, and the return code is "memfail" if the command
+    is terminated in a way that indicates that it has run out of memory (see
+    `is_memory_kill`).
+    The shell is run by `RUSAGE_WRAPPER` so that the maximum RSS is that of the
+    command rather than that of the pipeline. It includes the RSS of the wrapper
+    (about 10 MB), so it is not accurate for commands that use less memory than
+    that. If the wrapper is killed (e.g. by the timeout), the maximum RSS is not
+    known and the other fields are those of the wrapper and of the commands that
+    have finished."""
     try:
         log.info(f"RUN $ {cmd}")
         if not test_mode:
             start = time.time()
-            p = Popen(cmd, shell=True)
-            p.wait()
+            read_fd, write_fd = os.pipe()
+            try:
+                # The process group ID is the PID of the wrapper.
+                p = Popen(
+                    [
+                        sys.executable,
+                        "-I",
+                        "-S",
+                        "-c",
+                        RUSAGE_WRAPPER,
+                        cmd,
+                        str(write_fd),
+                        str(memory_limit) if memory_limit is not None else "",
+                    ],
+                    start_new_session=True,
+                    pass_fds=(write_fd,),
+                )
+            except BaseException:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+
+            timed_out = threading.Event()
+
+            def expire():
+                timed_out.set()
+                kill_process_group(p.pid)
+
+            timer = threading.Timer(timeout, expire) if timeout is not None else None
+            if timer is not None:
+                timer.start()
+            try:
+                _, status, rusage = os.wait4(p.pid, 0)
+            except BaseException:
+                # The command does not receive the signals sent to our process
+                # group (e.g. Ctrl-C).
+                kill_process_group(p.pid)
+                os.close(read_fd)
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
             end = time.time()
-            return p.returncode, end - start
-        return "skip"
+
+            cmd_rusage = read_wrapper_usage(read_fd)
+            if cmd_rusage is not None:
+                usage = get_usage(cmd_rusage)
+            else:
+                usage = get_usage(rusage)
+                usage.pop("max_rss")
+
+            if timed_out.is_set():
+                log.error(
+                    f"Command killed after exceeding the timeout ({timeout:.1f} s). cmd :: {cmd}"
+                )
+                return "timeout", end - start, usage
+
+            if memory_limit is not None and is_memory_kill(status):
+                log.error(
+                    f"Command killed after exceeding the memory limit ({memory_limit} bytes). cmd :: {cmd}"
+                )
+                return "memfail", end - start, usage
+
+            p.returncode = get_exitcode(status)
+            return p.returncode, end - start, usage
+        return "skip", 0, None
     except Exception:
         log.error(f"Error while executing command. cmd :: {cmd}")
-        return "error"
+        return "error", 0, None
+
+
+def add_usage_to_summary(pulsar_summary: dict, result: dict):
+    """Add the resource usage of each stage of a processed file to the execution
+    summary of its pulsar, per file and as per-stage aggregates (the number of
+    files, the totals, and the maximum of the peak values)."""
+    if len(result.get("usage", {})) == 0:
+        return
+
+    pulsar_summary.setdefault("usage_per_file", {})[result["prefix"]] = result["usage"]
+
+    aggregates = pulsar_summary.setdefault("usage", {})
+    for stage, usage in result["usage"].items():
+        stage_aggregates = aggregates.setdefault(stage, {"num_files": 0})
+        stage_aggregates["num_files"] += 1
+        for key, value in usage.items():
+            if key in USAGE_PEAK_KEYS:
+                stage_aggregates[key] = max(stage_aggregates.get(key, 0), value)
+            else:
+                stage_aggregates[key] = stage_aggregates.get(key, 0) + value
+
+
+def get_timing_filename(session: Session):
+    return f"{session.output_dir}/chime_pipeline_timing.jsonl"
+
+
+def record_timing(
+    session: Session,
+    pulsar_name: str,
+    prefix: str,
+    stage: str,
+    exec_time: float,
+    nfiles: int = 1,
+):
+    """Append a timing record of a stage of a file to the timing file (JSON Lines).
+    `nfiles` is the number of files over which the execution time was measured and
+    divided equally. Each record is written with a single write so that records
+    from worker processes are not interleaved."""
+    record = {
+        "run": session.start_time,
+        "timestamp": datetime.datetime.now().isoformat(),
+        "pulsar": pulsar_name,
+        "file": prefix,
+        "stage": stage,
+        "exec_time": exec_time,
+        "nfiles": nfiles,
+    }
+    with open(get_timing_filename(session), "a") as timing_file:
+        timing_file.write(f"{json.dumps(record)}\n")
+
+
+def get_timing_aggregates(session: Session, pulsar_name: str):
+    """Per-stage aggregates (count, total, mean, median, 95th percentile and
+    maximum) of the execution times of a pulsar's files in the current run, from
+    the timing file."""
+    exec_times = {}
+    try:
+        with open(get_timing_filename(session), "r") as timing_file:
+            for line in timing_file:
+                record = json.loads(line)
+                if record["run"] != session.start_time:
+                    continue
+                if record["pulsar"] == pulsar_name:
+                    stage_times = exec_times.setdefault(record["stage"], [])
+                    stage_times.append(record["exec_time"])
+    except OSError:
+        return {}
+
+    return {
+        stage: {
+            "count": len(times),
+            "total": float(np.sum(times)),
+            "mean": float(np.mean(times)),
+            "p50": float(np.percentile(times, 50)),
+            "p95": float(np.percentile(times, 95)),
+            "max": float(np.max(times)),
+        }
+        for stage, times in exec_times.items()
+    }
 
 
 def create_exec_summary_file(session: Session, exec_summary: dict):
@@ -31,16 +304,43 @@ def create_exec_summary_file(session: Session, exec_summary: dict):
         json.dump(exec_summary, summary_file, indent=4)
 
 
-def update_fits_header(filename: str, level: int):
+def update_fits_header(
+    filename: str, level: int, exec_time: float = None, config_hash: str = None
+):
+    """Write the pipeline provenance (command, processing level, date, execution
+    time, versions and config hash) to the primary header of a FITS file. The file
+    is opened only once, in update mode, and the header is rewritten in place if it
+    fits in its existing 2880-byte blocks. Otherwise, the whole file is rewritten."""
     try:
-        cmd = " ".join(sys.argv)
-        fits.setval(filename, "PL_CMD", value=cmd)
-        fits.setval(filename, "PL_LVL", value=level)
+        cards = {
+            "PL_CMD": (" ".join(sys.argv), "chimerawb command"),
+            "PL_LVL": (level, "Processing level"),
+            "PL_DATE": (
+                datetime.datetime.now().isoformat(timespec="seconds"),
+                "Processing date",
+            ),
+            "PL_VER": (get_versions()["version"], "chimerawb version"),
+            "PL_PSRCH": (get_psrchive_version(), "PSRCHIVE version"),
+        }
+        if exec_time is not None:
+            cards["PL_TIME"] = (round(exec_time, 3), "Execution time of this level (s)")
+        if config_hash is not None:
+            cards["PL_CFG"] = (config_hash, "Config file hash")
+
+        with fits.open(filename, mode="update", memmap=True) as hdul:
+            header = hdul[0].header
+            header.update(cards)
+
+            fileinfo = hdul.fileinfo(0)
+            if len(header.tostring()) > fileinfo["datLoc"] - fileinfo["hdrLoc"]:
+                log.info(f"Header of {filename} does not fit. Rewriting the file.")
+
         log.info(f"Updated FITS header for {filename}.")
     except Exception:
         log.error(f"Failed to update FITS header for {filename}.")
 
 
+@lru_cache()
 def get_psrchive_version():
     try:
         return (
@@ -27,3 +27,15 @@ def get_ftscr_filename(session: Session, prefix: str):
 
 def get_pzap_filename(session: Session, prefix: str):
     return f"{session.output_dir}/{prefix}.pzap"
+
+
+def get_fused_script_filename(session: Session, pulsar: PulsarConfig):
+    return f"{session.output_dir}/{pulsar.name}_fused.psh"
+
+
+def get_zap_cache_dir(session: Session):
+    return f"{session.output_dir}/zap_cache"
+
+
+def get_zap_cache_filename(session: Session, key: str, prefix: str):
+    return f"{get_zap_cache_dir(session)}/{key}/{prefix}.zap"
@@ -0,0 +1,158 @@
+import os
+import re
+
+from astropy.io import fits
+from loguru import logger as log
+
+from .manifest import get_file_signature
+from .scheduler import VAP_BATCH_SIZE, run_jobs, run_vap
+from .session import Session
+from .trace import trace_span
+
+# Header parameters read using vap, in addition to the MJD.
+VAP_KEYS = ["nsub", "nchan", "nbin", "npol", "length"]
+
+# CHIME archive names contain the day (MJD) and the second of the day of the start
+# of the observation, e.g. CHIME_J2302+4442_beam_1_59611_78494.ar
+CHIME_MJD_PATTERN = re.compile(r"_beam_\d+_(\d{5})_(\d+)")
+
+
+def is_fits_file(filename: str):
+    with open(filename, "rb") as f:
+        return f.read(9) == b"SIMPLE  ="
+
+
+def read_fits_header(filename: str):
+    """Read the header parameters of a PSRFITS archive from its primary and SUBINT
+    headers. No data is read, so the length (the sum of the TSUBINT column) is left
+    unset."""
+    with fits.open(filename, memmap=True, lazy_load_hdus=True) as hdul:
+        primary = hdul[0].header
+        subint = hdul["SUBINT"]
+        return {
+            "mjd": primary["STT_IMJD"]
+            + (primary["STT_SMJD"] + primary["STT_OFFS"]) / 86400,
+            "nsub": subint.header["NAXIS2"],
+            "nchan": subint.header["NCHAN"],
+            "nbin": subint.header["NBIN"],
+            "npol": subint.header["NPOL"],
+        }
+
+
+def get_chime_mjd(filename: str):
+    match = CHIME_MJD_PATTERN.search(os.path.basename(filename))
+    if match is None:
+        return None
+    return int(match.group(1)) + int(match.group(2)) / 86400
+
+
+def read_headers(filenames: list):
+    """Read the header parameters of archives without reading their data. PSRFITS
+    headers are read directly, and other archives (e.g. Timer) are read using vap,
+    in which case the MJD is taken from the CHIME file name. The length is only
+    known for the files read using vap. The status of a file
+    is "empty" if it has zero length, "unreadable" if its header cannot be read,
+    and "ok" otherwise. Returns a dict with the header parameters of each file.
+    Files that do not exist are left out, and so are the files to be read using vap
+    if vap could not be run."""
+    headers = {}
+    vap_files = []
+    for filename in filenames:
+        # Taken before reading the header so that a file modified in the meantime
+        # is scanned again.
+        size, mtime = get_file_signature(filename)
+        if size is None:
+            continue
+        header = dict.fromkeys(["mjd", *VAP_KEYS])
+        header.update({"size": size, "mtime": mtime, "status": "ok"})
+        headers[filename] = header
+
+        if size == 0:
+            header["status"] = "empty"
+            continue
+
+        try:
+            if is_fits_file(filename):
+                header.update(read_fits_header(filename))
+                continue
+        except Exception:
+            # Let PSRCHIVE decide whether the file is readable.
+            pass
+        vap_files.append(filename)
+
+    if len(vap_files) > 0:
+        fields = run_vap(vap_files, VAP_KEYS)
+        for filename in vap_files:
+            header = headers[filename]
+            if fields is None:
+                headers.pop(filename)
+                continue
+
+            try:
+                nsub, nchan, nbin, npol, length = fields[filename]
+                header.update(
+                    {
+                        "mjd": get_chime_mjd(filename),
+                        "nsub": int(nsub),
+                        "nchan": int(nchan),
+                        "nbin": int(nbin),
+                        "npol": int(npol),
+                        "length": float(length),
+                    }
+                )
+            except (KeyError, ValueError):
+                header["status"] = "unreadable"
+
+    return headers
+
+
+def scan_headers(session: Session, filenames: list):
+    """Pre-scan the headers of input archives using `session.jobs` worker processes
+    and store them in the header index in the manifest. Only the files that are
+    new or have been modified since they were last scanned are read. Returns a dict
+    with the header parameters of each file (see `read_headers`)."""
+    headers = {}
+    to_scan = []
+    for filename in filenames:
+        header = session.manifest.get_header(filename)
+        if header is not None:
+            headers[filename] = header
+        else:
+            to_scan.append(filename)
+
+    if len(to_scan) > 0:
+        log.info(
+            f"Scanning the headers of {len(to_scan)} files ({len(headers)} files are up to date)."
+        )
+        chunk_size = min(VAP_BATCH_SIZE, -(-len(to_scan) // session.jobs))
+        chunks = [
+            to_scan[i : i + chunk_size] for i in range(0, len(to_scan), chunk_size)
+        ]
+        with trace_span(session, "header_scan", "scan", nfiles=len(to_scan)):
+            chunk_headers_list = run_jobs(
+                read_headers, [(chunk,) for chunk in chunks], session.jobs
+            )
+        for chunk_headers in chunk_headers_list:
+            session.manifest.record_headers(chunk_headers)
+            headers.update(chunk_headers)
+
+    return headers
+
+
+def get_index_dims(headers: dict):
+    """The dimensions (nsub, nchan, nbin, npol) of the archives in the header index
+    that could be read."""
+    return {
+        filename: (header["nsub"], header["nchan"], header["nbin"], header["npol"])
+        for filename, header in headers.items()
+        if header["status"] == "ok" and header["nsub"] is not None
+    }
+
+
+def is_mjd_selected(session: Session, mjd: float):
+    """Check whether an MJD is within the --min_mjd/--max_mjd range. Archives with
+    an unknown MJD are always selected."""
+    return mjd is None or (
+        (session.min_mjd is None or mjd >= session.min_mjd)
+        and (session.max_mjd is None or mjd <= session.max_mjd)
+    )
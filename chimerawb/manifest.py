@@ -0,0 +1,271 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+
+from loguru import logger as log
+
+HASH_CHUNK_SIZE = 16 * 1024**2
+
+# Columns of the header index after the archive name.
+HEADER_COLUMNS = [
+    "size",
+    "mtime",
+    "status",
+    "mjd",
+    "nsub",
+    "nchan",
+    "nbin",
+    "npol",
+    "length",
+]
+
+
+def get_file_hash(filename: str):
+    """Compute the BLAKE2 hash of the contents of a file."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_file_signature(filename: str):
+    """Returns (size, mtime) of a file, or (None, None) if it does not exist."""
+    if filename is None:
+        return None, None
+    try:
+        stat = os.stat(filename)
+        return stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return None, None
+
+
+class Manifest:
+    """Persistent record of the processing of each input archive, stored as an
+    SQLite database in the output directory.
+
+    For each input archive, the manifest records its size, modification time and
+    content hash. For each processing stage of an input archive, it records the
+    parameters used, the output file with its size and modification time, the
+    return code and the execution time. A stage is up to date if its parameters
+    have not changed and its output file has not been modified since.
+
+    For each processed archive, the manifest records the TOA generation parameters
+    (template and DM), the size and modification time of the archive and the number
+    of TOAs written to the tim file (0 if the TOA generation failed).
+
+    For each input archive, the manifest also keeps an index of the header
+    parameters read by the header pre-scan (see `chimerawb.index`), along with the
+    size and modification time of the archive when it was scanned."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # The connection cannot be shared with worker processes.
+        return {"filename": self.filename, "_conn": None, "_pid": None}
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.filename, timeout=600)
+            self._pid = os.getpid()
+            with self._conn:
+                self._conn.execute(
+                    """CREATE TABLE IF NOT EXISTS inputs (
+                        input_file TEXT PRIMARY KEY,
+                        size INTEGER,
+                        mtime INTEGER,
+                        hash TEXT
+                    )"""
+                )
+                self._conn.execute(
+                    """CREATE TABLE IF NOT EXISTS stages (
+                        input_file TEXT,
+                        stage TEXT,
+                        params TEXT,
+                        output_file TEXT,
+                        output_size INTEGER,
+                        output_mtime INTEGER,
+                        retcode INTEGER,
+                        exec_time REAL,
+                        timestamp TEXT,
+                        PRIMARY KEY (input_file, stage)
+                    )"""
+                )
+                self._conn.execute(
+                    """CREATE TABLE IF NOT EXISTS toas (
+                        archive TEXT PRIMARY KEY,
+                        pulsar TEXT,
+                        params TEXT,
+                        archive_size INTEGER,
+                        archive_mtime INTEGER,
+                        ntoas INTEGER,
+                        timestamp TEXT
+                    )"""
+                )
+                self._conn.execute(
+                    """CREATE TABLE IF NOT EXISTS headers (
+                        archive TEXT PRIMARY KEY,
+                        size INTEGER,
+                        mtime INTEGER,
+                        status TEXT,
+                        mjd REAL,
+                        nsub INTEGER,
+                        nchan INTEGER,
+                        nbin INTEGER,
+                        npol INTEGER,
+                        length REAL
+                    )"""
+                )
+        return self._conn
+
+    def is_input_unchanged(self, input_file: str):
+        """Check whether the size and modification time of an input archive are
+        the same as when it was last processed."""
+        row = self.conn.execute(
+            "SELECT size, mtime FROM inputs WHERE input_file = ?", (input_file,)
+        ).fetchone()
+        return row is not None and tuple(row) == get_file_signature(input_file)
+
+    def get_input_hash(self, input_file: str):
+        row = self.conn.execute(
+            "SELECT hash FROM inputs WHERE input_file = ?", (input_file,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def update_input(self, input_file: str):
+        """Record the size, modification time and hash of an input archive and
+        return the hash. The hash is only computed if the size or modification time
+        have changed, and all stages of the file are invalidated if the contents
+        have changed."""
+        if self.is_input_unchanged(input_file):
+            return self.get_input_hash(input_file)
+
+        size, mtime = get_file_signature(input_file)
+        file_hash = get_file_hash(input_file)
+
+        row = self.conn.execute(
+            "SELECT hash FROM inputs WHERE input_file = ?", (input_file,)
+        ).fetchone()
+
+        with self.conn:
+            if row is not None and row[0] != file_hash:
+                log.info(f"{input_file} has changed since it was last processed.")
+                self.conn.execute(
+                    "DELETE FROM stages WHERE input_file = ?", (input_file,)
+                )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?)",
+                (input_file, size, mtime, file_hash),
+            )
+
+        return file_hash
+
+    def record_stage(
+        self,
+        input_file: str,
+        stage: str,
+        params: str,
+        output_file: str,
+        retcode,
+        exec_time: float,
+    ):
+        """Record a processing stage of an input archive. This should be called
+        after the output file is written (including the FITS header updates)."""
+        output_size, output_mtime = get_file_signature(output_file)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    input_file,
+                    stage,
+                    params,
+                    output_file,
+                    output_size,
+                    output_mtime,
+                    retcode if isinstance(retcode, int) else None,
+                    exec_time,
+                    datetime.datetime.now().isoformat(),
+                ),
+            )
+
+    def is_stage_current(
+        self, input_file: str, stage: str, params: str, output_file: str
+    ):
+        """Check whether a stage of an input archive was run with the given
+        parameters and its output file is intact."""
+        row = self.conn.execute(
+            "SELECT params, output_file, output_size, output_mtime FROM stages WHERE input_file = ? AND stage = ?",
+            (input_file, stage),
+        ).fetchone()
+        return (
+            row is not None
+            and row[0] == params
+            and row[1] == output_file
+            and row[2] is not None
+            and tuple(row[2:]) == get_file_signature(output_file)
+        )
+
+    def record_toas(self, pulsar: str, archive: str, params: str, ntoas: int):
+        """Record that the TOAs of a processed archive have been written to the
+        tim file. This should be called after the tim file is written."""
+        archive_size, archive_mtime = get_file_signature(archive)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO toas VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    archive,
+                    pulsar,
+                    params,
+                    archive_size,
+                    archive_mtime,
+                    ntoas,
+                    datetime.datetime.now().isoformat(),
+                ),
+            )
+
+    def get_toa_count(self, archive: str):
+        row = self.conn.execute(
+            "SELECT ntoas FROM toas WHERE archive = ?", (archive,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def is_toa_current(self, archive: str, params: str):
+        """Check whether the TOAs of a processed archive were created with the given
+        parameters and the archive has not been modified since."""
+        row = self.conn.execute(
+            "SELECT params, archive_size, archive_mtime FROM toas WHERE archive = ?",
+            (archive,),
+        ).fetchone()
+        return (
+            row is not None
+            and row[0] == params
+            and tuple(row[1:]) == get_file_signature(archive)
+        )
+
+    def record_headers(self, headers: dict):
+        """Record the header pre-scan results of input archives. `headers` is a dict
+        mapping each archive to a dict with the keys in HEADER_COLUMNS."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (archive, *[header[col] for col in HEADER_COLUMNS])
+                    for archive, header in headers.items()
+                ],
+            )
+
+    def get_header(self, archive: str):
+        """Returns the header pre-scan result of an input archive as a dict, or None
+        if the archive has not been scanned since it was last modified."""
+        row = self.conn.execute(
+            f"SELECT {', '.join(HEADER_COLUMNS)} FROM headers WHERE archive = ?",
+            (archive,),
+        ).fetchone()
+        if row is None or tuple(row[:2]) != get_file_signature(archive):
+            return None
+        return dict(zip(HEADER_COLUMNS, row))
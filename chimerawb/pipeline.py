@@ -0,0 +1,1010 @@
+import os
+import resource
+import shutil
+import time
+
+from loguru import logger as log
+
+from .cache import (
+    evict_lru,
+    get_config_hash,
+    get_params_key,
+    get_stage_params,
+    touch,
+)
+from .exec import (
+    KILLED_STATUSES,
+    get_usage,
+    record_timing,
+    run_cmd,
+    split_usage,
+    update_fits_header,
+)
+from .fileutils import (
+    get_file_prefix,
+    get_final_output_filename,
+    get_ftscr_filename,
+    get_fused_script_filename,
+    get_pzap_filename,
+    get_zap_cache_dir,
+    get_zap_cache_filename,
+    get_zap_filename,
+)
+from .index import get_index_dims, is_mjd_selected, scan_headers
+from .psrfits import scrunch, zap_channels
+from .scheduler import estimate_memory_all, run_jobs
+from .session import PulsarConfig, Session
+from .trace import trace_span
+from .validation import test_input_file
+
+# Upper limit on the length of a batched pam/paz command. The commands are run
+# through a shell, and Linux limits the length of a single argument to 128 kB.
+MAX_BATCH_CMD_LENGTH = 100000
+
+
+def create_fused_script(session: Session, pulsar: PulsarConfig):
+    """Create a psrsh script that runs the CHIME preprocessing script followed by
+    the scrunching and post-scrunch zapping steps for a pulsar. This way, each
+    archive is loaded only once and only the final output is written to disk."""
+
+    with open(shutil.which("chime_convert_and_tfzap.psh"), "r") as tfzap_script:
+        script = tfzap_script.read()
+
+    script += f"""
+
+############################################
+# Scrunching (Same as pam in Level 1 -> 2) #
+############################################
+
+# Update DM
+edit dm={pulsar.dm}
+
+# Scrunch in Frequency and Time. A scrunch factor of 0 means scrunching
+# everything, so the factors are at least 1 (like pam, which keeps the
+# channels or subintegrations if there are fewer than requested).
+fscrunch {{max(1,floor($nchan/{pulsar.nchan}))}}
+"""
+    script += (
+        "tscrunch\n"
+        if pulsar.nsub == 1
+        else f"tscrunch {{max(1,floor($nsubint/{pulsar.nsub}))}}\n"
+    )
+
+    if not session.skip_pzap and len(pulsar.zap_chans) > 0:
+        zap_chans_str = " ".join(map(str, pulsar.zap_chans))
+        script += f"""
+##########################################################
+# Post-scrunch RFI zapping (Same as paz in Level 2 -> 3) #
+##########################################################
+
+zap chan {zap_chans_str}
+"""
+
+    fused_script = get_fused_script_filename(session, pulsar)
+    log.info(f"Creating fused psrsh script {fused_script}.")
+    with open(fused_script, "w") as f:
+        f.write(script)
+
+
+def get_stages(session: Session, pulsar: PulsarConfig):
+    """The processing stages needed to create the final output file."""
+    if session.fused:
+        return ["fused"]
+    elif is_pzap_enabled(session, pulsar):
+        return ["level01", "level12", "level23"]
+    else:
+        return ["level01", "level12"]
+
+
+def is_stage_current(
+    session: Session, pulsar: PulsarConfig, result: dict, stage: str, output_file: str
+):
+    """Check whether a stage can be skipped because its output file was created
+    with the current parameters."""
+    if session.reprocess:
+        return False
+
+    params = get_stage_params(session, pulsar, result["input_hash"])[stage]
+    if session.manifest.is_stage_current(
+        result["input_file"], stage, params, output_file
+    ):
+        log.info(f"Reusing {output_file} (Up to date).")
+        return True
+
+    return False
+
+
+def record_stage(
+    session: Session,
+    pulsar: PulsarConfig,
+    result: dict,
+    stage: str,
+    output_file: str,
+    retcode,
+    exectime: float,
+):
+    params = get_stage_params(session, pulsar, result["input_hash"])[stage]
+    session.manifest.record_stage(
+        result["input_file"], stage, params, output_file, retcode, exectime
+    )
+
+
+def record_usage(
+    session: Session,
+    pulsar: PulsarConfig,
+    result: dict,
+    stage: str,
+    exectime: float,
+    usage: dict,
+    nfiles: int = 1,
+):
+    """Record the execution time of a stage of a file in the timing file and its
+    resource usage in the result of the file."""
+    record_timing(session, pulsar.name, result["prefix"], stage, exectime, nfiles)
+    if usage is not None:
+        result["usage"][stage] = usage
+
+
+def stamp_header(
+    session: Session,
+    pulsar: PulsarConfig,
+    result: dict,
+    filename: str,
+    level: int,
+    exectime: float,
+):
+    """Write the provenance keywords to the header of an output file and record the
+    time taken in the timing file."""
+    start = time.time()
+    with trace_span(
+        session, "header", "header", pulsar=pulsar.name, file=result["prefix"]
+    ):
+        update_fits_header(filename, level, exectime, get_config_hash(session))
+    end = time.time()
+    record_timing(session, pulsar.name, result["prefix"], "header", end - start)
+
+
+def get_stage_timeout(session: Session, filenames: list):
+    """The timeout (s) of a command that processes `filenames`: --timeout for each
+    file plus --timeout_per_gb for each GB of the files. None if --timeout is not
+    given (--timeout_per_gb requires it)."""
+    if session.timeout is None:
+        return None
+
+    timeout = session.timeout * len(filenames)
+    if session.timeout_per_gb is not None:
+        size = sum(os.path.getsize(f) for f in filenames if os.path.isfile(f))
+        timeout += session.timeout_per_gb * size / 1e9
+    return timeout
+
+
+def fail_killed(
+    session: Session,
+    pulsar: PulsarConfig,
+    result: dict,
+    stage: str,
+    output_file: str,
+    retcode: str,
+    exectime: float,
+):
+    """Record a stage of a file whose command was killed after exceeding the timeout
+    ("timeout") or the memory limit ("memfail") as failed, and remove its partially
+    written output. The status of the file is set to `retcode`."""
+    log.error(f"{retcode} in {stage} for {result['input_file']}. Skipping file.")
+    remove_output(output_file)
+    record_stage(session, pulsar, result, stage, None, retcode, exectime)
+    result["status"] = retcode
+
+
+def remove_output(output_file: str):
+    """Remove the output file of a stage if it exists. This is done before a stage
+    is run so that an output left over from an earlier run (e.g. with different
+    parameters) cannot be taken for the output of a failed command."""
+    if os.path.isfile(output_file):
+        os.unlink(output_file)
+
+
+def finish_stage(
+    session: Session,
+    pulsar: PulsarConfig,
+    result: dict,
+    stage: str,
+    output_file: str,
+    level: int,
+    retcode,
+    exectime: float,
+):
+    """Validate the output file of a stage, stamp its header and record the stage
+    as up to date in the manifest. If the command failed (non-zero return code) or
+    the output file cannot be read, the output file is removed and the stage is
+    recorded as failed. Returns True if successful."""
+    if retcode != 0:
+        log.error(
+            f"{stage} failed for {result['input_file']} (return code {retcode}). Skipping file."
+        )
+        remove_output(output_file)
+        record_stage(session, pulsar, result, stage, None, retcode, exectime)
+        return False
+
+    try:
+        test_input_file(output_file)
+    except OSError as err:
+        log.error(f"Error reading file {output_file}. Skipping file.")
+        remove_output(output_file)
+        record_stage(session, pulsar, result, stage, None, retcode, exectime)
+        return False
+
+    stamp_header(session, pulsar, result, output_file, level, exectime)
+    record_stage(session, pulsar, result, stage, output_file, retcode, exectime)
+    return True
+
+
+def get_skip_status(session: Session, pulsar: PulsarConfig, ar_file: str):
+    """Returns "skip_meta", "skip_mjd" or "skip_exist" if the file should be
+    skipped, and None otherwise."""
+
+    # Skip the file if it is not in the input metafile if the input metafile is given.
+    if session.input_metafile is not None and ar_file not in session.input_file_names:
+        return "skip_meta"
+
+    # Skip the file if its MJD (from the header index) is outside the MJD range.
+    header = session.manifest.get_header(ar_file)
+    if header is not None and not is_mjd_selected(session, header["mjd"]):
+        return "skip_mjd"
+
+    # Skip the file if it has already been processed with the current parameters
+    # and the output is intact (except when the --reprocess option is given).
+    if session.reprocess:
+        return None
+
+    # Files not in the manifest (including those processed before the manifest
+    # existed) are processed once so that their outputs can be checked. Files that
+    # have been modified are checked again in `start_file` once their hash is known.
+    if not session.manifest.is_input_unchanged(ar_file):
+        return None
+
+    input_hash = session.manifest.get_input_hash(ar_file)
+    if is_output_current(session, pulsar, ar_file, input_hash):
+        return "skip_exist"
+
+    return None
+
+
+def is_output_current(
+    session: Session, pulsar: PulsarConfig, ar_file: str, input_hash: str
+):
+    """Check whether the final output file of an input archive with the given hash
+    was created with the current parameters and is intact."""
+    final_output_file = get_final_output_filename(
+        session, pulsar, get_file_prefix(ar_file)
+    )
+    final_stage = get_stages(session, pulsar)[-1]
+    final_params = get_stage_params(session, pulsar, input_hash)[final_stage]
+    return session.manifest.is_stage_current(
+        ar_file, final_stage, final_params, final_output_file
+    )
+
+
+def is_pzap_enabled(session: Session, pulsar: PulsarConfig):
+    return not session.skip_pzap and len(pulsar.zap_chans) > 0
+
+
+def get_scrunch_cmd(session: Session, pulsar: PulsarConfig, zap_files: list):
+    zap_files_str = " ".join(zap_files)
+    return f"pam -e ftscr -u {session.output_dir} --setnchn {pulsar.nchan} --setnsub {pulsar.nsub} -d {pulsar.dm} {zap_files_str}"
+
+
+def get_pzap_cmd(session: Session, pulsar: PulsarConfig, ftscr_files: list):
+    zap_chans_str = " ".join(map(str, pulsar.zap_chans))
+    ftscr_files_str = " ".join(ftscr_files)
+    return f'paz -z "{zap_chans_str}" -e pzap -O {session.output_dir} {ftscr_files_str}'
+
+
+def start_file(session: Session, pulsar: PulsarConfig, ar_file: str):
+    """Create the result dict for an input archive. Its status is "pending" if
+    the file should be processed, and "skip_meta", "skip_mjd", "skip_exist" or
+    "processfail" otherwise."""
+
+    prefix = get_file_prefix(ar_file)
+
+    result = {
+        "input_file": ar_file,
+        "prefix": prefix,
+        "status": "processfail",
+        "output_file": get_final_output_filename(session, pulsar, prefix),
+        "exec_time": 0,
+        "usage": {},
+    }
+
+    skip_status = get_skip_status(session, pulsar, ar_file)
+    if skip_status == "skip_meta":
+        log.info(f"--- Skipping {prefix} ... Not included in the input metafile. ---")
+        result["status"] = skip_status
+        return result
+    elif skip_status == "skip_mjd":
+        log.info(f"--- Skipping {prefix} ... Outside the MJD range. ---")
+        result["status"] = skip_status
+        return result
+    elif skip_status == "skip_exist":
+        log.info(f"--- Skipping {prefix} ... Output already exists. ---")
+        result["status"] = skip_status
+        return result
+
+    log.info(f"--- Processing {prefix} ---")
+
+    try:
+        test_input_file(f"{ar_file}")
+    except OSError as err:
+        log.error(f"Error reading file {ar_file}. Skipping file.")
+        return result
+
+    # Reject broken files found by the header pre-scan before running psrsh.
+    header = session.manifest.get_header(ar_file)
+    if header is not None and header["status"] != "ok":
+        log.error(f"File {ar_file} is {header['status']}. Skipping file.")
+        return result
+
+    result["input_hash"] = session.manifest.update_input(ar_file)
+
+    # The file may have been touched without changing its contents.
+    if not session.reprocess and is_output_current(
+        session, pulsar, ar_file, result["input_hash"]
+    ):
+        log.info(f"{ar_file} has not changed. Output already exists.")
+        result["status"] = "skip_exist"
+        return result
+
+    result["status"] = "pending"
+    return result
+
+
+def is_zap_cache_enabled(session: Session):
+    return session.clean_files and session.zap_cache_size is not None
+
+
+def get_cached_zap_filename(session: Session, pulsar: PulsarConfig, result: dict):
+    """The zap file is cached under the key of the Level 0 -> 1 stage, which depends
+    on the contents of the input file and the RFI excision script."""
+    params = get_stage_params(session, pulsar, result["input_hash"])["level01"]
+    return get_zap_cache_filename(session, get_params_key(params), result["prefix"])
+
+
+def cache_zap_file(session: Session, pulsar: PulsarConfig, result: dict):
+    """Move the zap file into the cache (--clean with --zap_cache_size) and remove
+    the least recently used files if the cache is too big. The files in the cache
+    are not used by any worker (see `reuse_cached_zap_file`), so that the cache
+    stays within its budget during the run."""
+    zap_file = result["zap_file"]
+    cached_zap_file = get_cached_zap_filename(session, pulsar, result)
+    if os.path.isfile(cached_zap_file) and os.path.samefile(zap_file, cached_zap_file):
+        # Linked from the cache, which still has it.
+        os.unlink(zap_file)
+    else:
+        log.info(f"Moving file {zap_file} to the cache ... (--clean)")
+        os.makedirs(os.path.dirname(cached_zap_file), exist_ok=True)
+        os.replace(zap_file, cached_zap_file)
+    touch(cached_zap_file)
+    result["zap_file"] = cached_zap_file
+
+    evict_lru(get_zap_cache_dir(session), session.zap_cache_size)
+
+
+def reuse_cached_zap_file(session: Session, pulsar: PulsarConfig, result: dict):
+    """Link the cached zap file of an input file (if any) to its zap file, so that
+    it is not affected if it is removed from the cache by another worker while it is
+    being used. Returns True if successful."""
+    cached_zap_file = get_cached_zap_filename(session, pulsar, result)
+    remove_output(result["zap_file"])
+    try:
+        os.link(cached_zap_file, result["zap_file"])
+    except FileNotFoundError:
+        return False
+    except OSError:
+        # Hard links are not supported.
+        try:
+            shutil.copyfile(cached_zap_file, result["zap_file"])
+        except OSError:
+            remove_output(result["zap_file"])
+            return False
+    log.info(f"Reusing {cached_zap_file} (Cached).")
+    touch(cached_zap_file)
+    return True
+
+
+def run_level01(session: Session, pulsar: PulsarConfig, result: dict):
+    """Level 0 -> 1 processing. Returns True if successful."""
+
+    zap_file = get_zap_filename(session, result["prefix"])
+    result["zap_file"] = zap_file
+    if is_stage_current(session, pulsar, result, "level01", zap_file):
+        return True
+
+    if (
+        is_zap_cache_enabled(session)
+        and not session.reprocess
+        and reuse_cached_zap_file(session, pulsar, result)
+    ):
+        return True
+
+    # CHIME preprocessing script
+    # 1. Convert coherence mode data to Stokes mode.
+    # 2. Run RFI excision
+    # 3. Convert from Timer to PSRFITS format
+    ar_file = result["input_file"]
+    zap_cmd = f"chime_convert_and_tfzap.psh -e zap -O {session.output_dir} {ar_file}"
+    remove_output(zap_file)
+    with trace_span(
+        session, "level01", "stage", pulsar=pulsar.name, file=result["prefix"]
+    ):
+        retcode, exectime_01, usage_01 = run_cmd(
+            zap_cmd,
+            session.test_mode,
+            get_stage_timeout(session, [ar_file]),
+            session.memory_limit,
+        )
+    log.info(f"Execution time for Level 0 -> 1 = {exectime_01} s")
+    result["exec_time"] += exectime_01
+    record_usage(session, pulsar, result, "level01", exectime_01, usage_01)
+
+    if retcode in KILLED_STATUSES:
+        fail_killed(session, pulsar, result, "level01", zap_file, retcode, exectime_01)
+        return False
+
+    return finish_stage(
+        session, pulsar, result, "level01", zap_file, 1, retcode, exectime_01
+    )
+
+
+def run_native_scrunch(
+    session: Session, pulsar: PulsarConfig, zap_file: str, ftscr_file: str
+):
+    """Dedisperse and scrunch the Level 1 file in NumPy instead of running pam.
+    Returns the return code, the execution time and the resource usage like
+    `run_cmd`. The maximum RSS is that of the worker process so far."""
+    log.info(f"Scrunching {zap_file} (native).")
+    start = time.time()
+    start_rusage = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        scrunch(
+            zap_file,
+            ftscr_file,
+            pulsar.nchan,
+            pulsar.nsub,
+            pulsar.dm,
+            chunk_size=session.chunk_size,
+        )
+        retcode = 0
+    except Exception as err:
+        log.error(f"Error while scrunching {zap_file}.")
+        log.error(err)
+        retcode = 1
+    end = time.time()
+    usage = get_usage(resource.getrusage(resource.RUSAGE_SELF), start_rusage)
+    return retcode, end - start, usage
+
+
+def run_level12(session: Session, pulsar: PulsarConfig, result: dict):
+    """Level 1 -> 2 processing. Returns True if successful."""
+
+    ftscr_file = get_ftscr_filename(session, result["prefix"])
+    if is_stage_current(session, pulsar, result, "level12", ftscr_file):
+        return True
+
+    # Scrunch in Frequency and Time, Update DM
+    remove_output(ftscr_file)
+    with trace_span(
+        session, "level12", "stage", pulsar=pulsar.name, file=result["prefix"]
+    ):
+        if pulsar.scrunch_engine == "native":
+            retcode, exectime_12, usage_12 = run_native_scrunch(
+                session, pulsar, result["zap_file"], ftscr_file
+            )
+        else:
+            scr_cmd = get_scrunch_cmd(session, pulsar, [result["zap_file"]])
+            retcode, exectime_12, usage_12 = run_cmd(
+                scr_cmd,
+                session.test_mode,
+                get_stage_timeout(session, [result["zap_file"]]),
+                session.memory_limit,
+            )
+    log.info(f"Execution time for Level 1 -> 2 = {exectime_12} s")
+    result["exec_time"] += exectime_12
+    record_usage(session, pulsar, result, "level12", exectime_12, usage_12)
+
+    if retcode in KILLED_STATUSES:
+        fail_killed(
+            session, pulsar, result, "level12", ftscr_file, retcode, exectime_12
+        )
+        return False
+
+    return finish_level12(session, pulsar, result, retcode, exectime_12)
+
+
+def finish_level12(
+    session: Session, pulsar: PulsarConfig, result: dict, retcode, exectime: float
+):
+    """Validate the Level 2 output file (see `finish_stage`) and remove the Level 1
+    file if required. Returns True if successful."""
+
+    ftscr_file = get_ftscr_filename(session, result["prefix"])
+    if not finish_stage(
+        session, pulsar, result, "level12", ftscr_file, 2, retcode, exectime
+    ):
+        return False
+
+    if session.clean_files:
+        zap_file = result["zap_file"]
+        if is_zap_cache_enabled(session):
+            cache_zap_file(session, pulsar, result)
+        else:
+            log.warning(f"Removing file {zap_file} ... (--clean)")
+            os.unlink(zap_file)
+
+    return True
+
+
+def run_native_pzap(
+    session: Session, pulsar: PulsarConfig, ftscr_file: str, pzap_file: str
+):
+    """Zap channels by setting their weights to zero in the PSRFITS file instead
+    of running paz. The Level 2 file is copied (as a copy-on-write clone if
+    possible) and only the copy is updated, so that a failure cannot leave a
+    partially zapped Level 2 file behind (it is removed afterwards with --clean).
+    If zapping fails, no Level 3 file is left behind. Returns the return code, the
+    execution time and the resource usage like `run_cmd`. The maximum RSS is that
+    of the worker process so far."""
+    log.info(f"Zapping channels {pulsar.zap_chans} in {ftscr_file} (native).")
+    start = time.time()
+    start_rusage = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        zap_channels(ftscr_file, pzap_file, pulsar.zap_chans)
+        retcode = 0
+    except Exception as err:
+        log.error(f"Error while zapping channels in {ftscr_file}.")
+        log.error(err)
+        remove_output(pzap_file)
+        retcode = 1
+    end = time.time()
+    usage = get_usage(resource.getrusage(resource.RUSAGE_SELF), start_rusage)
+    return retcode, end - start, usage
+
+
+def run_level23(session: Session, pulsar: PulsarConfig, result: dict):
+    """Level 2 -> 3 processing. Returns True if successful."""
+
+    pzap_file = get_pzap_filename(session, result["prefix"])
+    if is_stage_current(session, pulsar, result, "level23", pzap_file):
+        return True
+
+    # Remove bad channels based on the config.
+    # This will need to be unique for each pulsar.
+    ftscr_file = get_ftscr_filename(session, result["prefix"])
+    remove_output(pzap_file)
+    with trace_span(
+        session, "level23", "stage", pulsar=pulsar.name, file=result["prefix"]
+    ):
+        if pulsar.pzap_engine == "native":
+            retcode, exectime_23, usage_23 = run_native_pzap(
+                session, pulsar, ftscr_file, pzap_file
+            )
+        else:
+            pzap_cmd = get_pzap_cmd(session, pulsar, [ftscr_file])
+            retcode, exectime_23, usage_23 = run_cmd(
+                pzap_cmd,
+                session.test_mode,
+                get_stage_timeout(session, [ftscr_file]),
+                session.memory_limit,
+            )
+    log.info(f"Execution time for Level 2 -> 3 = {exectime_23} s")
+    result["exec_time"] += exectime_23
+    record_usage(session, pulsar, result, "level23", exectime_23, usage_23)
+
+    if retcode in KILLED_STATUSES:
+        fail_killed(session, pulsar, result, "level23", pzap_file, retcode, exectime_23)
+        return False
+
+    return finish_level23(session, pulsar, result, retcode, exectime_23)
+
+
+def finish_level23(
+    session: Session, pulsar: PulsarConfig, result: dict, retcode, exectime: float
+):
+    """Validate the Level 3 output file (see `finish_stage`) and remove the Level 2
+    file if required. Returns True if successful."""
+
+    pzap_file = get_pzap_filename(session, result["prefix"])
+    if not finish_stage(
+        session, pulsar, result, "level23", pzap_file, 3, retcode, exectime
+    ):
+        return False
+
+    # This will change if there are fewer or more steps.
+    assert pzap_file == result["output_file"]
+
+    ftscr_file = get_ftscr_filename(session, result["prefix"])
+    if session.clean_files and os.path.isfile(ftscr_file):
+        log.warning(f"Removing file {ftscr_file} ... (--clean)")
+        os.unlink(ftscr_file)
+
+    return True
+
+
+def log_skip_level23(session: Session, pulsar: PulsarConfig):
+    if len(pulsar.zap_chans) == 0:
+        log.warning(
+            "Skipping post-scrunch zapping step because no channels were flagged for zapping (zap_chans)."
+        )
+    else:
+        log.info("Skipping post-scrunch zapping step. (--skip_pzap)")
+
+
+def process_file(session: Session, pulsar: PulsarConfig, ar_file: str):
+    """Run the Level 0 -> 3 processing chain on a single input archive.
+
+    Returns a dict containing the status of the file (one of "success",
+    "skip_meta", "skip_mjd", "skip_exist", "processfail", "timeout" or "memfail"),
+    the final output file and the execution time."""
+
+    result = start_file(session, pulsar, ar_file)
+    if result["status"] != "pending":
+        return result
+
+    result["status"] = "processfail"
+
+    if session.fused:
+        return process_file_fused(session, pulsar, ar_file, result)
+
+    if not run_level01(session, pulsar, result):
+        return result
+
+    if not run_level12(session, pulsar, result):
+        return result
+
+    if is_pzap_enabled(session, pulsar):
+        if not run_level23(session, pulsar, result):
+            return result
+    else:
+        log_skip_level23(session, pulsar)
+        assert get_ftscr_filename(session, result["prefix"]) == result["output_file"]
+
+    result["status"] = "success"
+
+    return result
+
+
+def process_file_level01(session: Session, pulsar: PulsarConfig, ar_file: str):
+    """Run only the Level 0 -> 1 step on a single input archive. The status of
+    the returned result is "pending" if successful."""
+
+    result = start_file(session, pulsar, ar_file)
+    if result["status"] == "pending" and not run_level01(session, pulsar, result):
+        if result["status"] not in KILLED_STATUSES:
+            result["status"] = "processfail"
+    return result
+
+
+def process_file_fused(
+    session: Session, pulsar: PulsarConfig, ar_file: str, result: dict
+):
+    """Run the Level 0 -> 3 processing chain on a single input archive in a
+    single psrsh run using the script created by `create_fused_script`."""
+
+    final_output_file = result["output_file"]
+    ext = os.path.splitext(final_output_file)[1][1:]
+    level = 3 if ext == "pzap" else 2
+
+    fused_script = get_fused_script_filename(session, pulsar)
+    fused_cmd = f"psrsh {fused_script} -e {ext} -O {session.output_dir} {ar_file}"
+    remove_output(final_output_file)
+    with trace_span(
+        session, "fused", "stage", pulsar=pulsar.name, file=result["prefix"]
+    ):
+        retcode, exectime, usage = run_cmd(
+            fused_cmd,
+            session.test_mode,
+            get_stage_timeout(session, [ar_file]),
+            session.memory_limit,
+        )
+    log.info(f"Execution time for Level 0 -> {level} = {exectime} s")
+    record_usage(session, pulsar, result, "fused", exectime, usage)
+
+    if retcode in KILLED_STATUSES:
+        fail_killed(
+            session, pulsar, result, "fused", final_output_file, retcode, exectime
+        )
+        return result
+
+    if not finish_stage(
+        session, pulsar, result, "fused", final_output_file, level, retcode, exectime
+    ):
+        return result
+
+    result["status"] = "success"
+    result["exec_time"] = exectime
+
+    return result
+
+
+def get_batches(results: list, filenames: list, base_cmd_length: int, nbatch_min: int):
+    """Split `results` into batches such that the command for each batch (the base
+    command followed by the corresponding `filenames`) is not too long. The files
+    are split into at least `nbatch_min` batches if there are enough files, so that
+    the batches can run in parallel."""
+    max_batch_size = max(1, -(-len(results) // nbatch_min))
+
+    batches = []
+    batch = []
+    cmd_length = base_cmd_length
+    for result, filename in zip(results, filenames):
+        if len(batch) > 0 and (
+            len(batch) >= max_batch_size
+            or cmd_length + len(filename) + 1 > MAX_BATCH_CMD_LENGTH
+        ):
+            batches.append(batch)
+            batch = []
+            cmd_length = base_cmd_length
+        batch.append(result)
+        cmd_length += len(filename) + 1
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+def run_batch(session: Session, pulsar: PulsarConfig, results: list, level: int):
+    """Run the Level 1 -> 2 (pam) or Level 2 -> 3 (paz) step on a batch of files
+    in a single invocation. The execution time is divided equally among the files.
+    The status of a file is set to "processfail" if its output is not created. If
+    the command fails or is killed (see `run_cmd`), the files are processed again
+    one at a time."""
+
+    if (level == 2 and pulsar.scrunch_engine == "native") or (
+        level == 3 and pulsar.pzap_engine == "native"
+    ):
+        # Nothing to gain from batching.
+        return run_one_by_one(session, pulsar, results, level)
+
+    prefixes = [result["prefix"] for result in results]
+    if level == 2:
+        input_files = [result["zap_file"] for result in results]
+        cmd = get_scrunch_cmd(session, pulsar, input_files)
+        finish_level = finish_level12
+        get_output_filename = get_ftscr_filename
+    else:
+        input_files = [get_ftscr_filename(session, prefix) for prefix in prefixes]
+        cmd = get_pzap_cmd(session, pulsar, input_files)
+        finish_level = finish_level23
+        get_output_filename = get_pzap_filename
+
+    stage = "level12" if level == 2 else "level23"
+    for prefix in prefixes:
+        remove_output(get_output_filename(session, prefix))
+    with trace_span(session, stage, "batch", pulsar=pulsar.name, files=prefixes):
+        retcode, exectime, usage = run_cmd(
+            cmd,
+            session.test_mode,
+            get_stage_timeout(session, input_files),
+            session.memory_limit,
+        )
+    log.info(
+        f"Execution time for Level {level-1} -> {level} ({len(results)} files) = {exectime} s"
+    )
+
+    if retcode != 0:
+        # The files processed before the command failed or was killed cannot be
+        # told apart from the one that caused it, so that the files are processed
+        # again one at a time (with their own limits), removing the outputs first.
+        log.warning(
+            f"Batch command failed ({retcode}). Processing its {len(results)} files one at a time."
+        )
+        return run_one_by_one(session, pulsar, results, level)
+
+    for result in results:
+        result["exec_time"] += exectime / len(results)
+        record_usage(
+            session,
+            pulsar,
+            result,
+            stage,
+            exectime / len(results),
+            split_usage(usage, len(results)),
+            len(results),
+        )
+        if not finish_level(session, pulsar, result, retcode, exectime / len(results)):
+            result["status"] = "processfail"
+
+    return results
+
+
+def run_one_by_one(session: Session, pulsar: PulsarConfig, results: list, level: int):
+    """Run the Level 1 -> 2 or Level 2 -> 3 step on the files one at a time. The
+    status of a file is set to "processfail" if the step fails, unless the command
+    was killed."""
+
+    run_level = run_level12 if level == 2 else run_level23
+    for result in results:
+        if (
+            not run_level(session, pulsar, result)
+            and result["status"] not in KILLED_STATUSES
+        ):
+            result["status"] = "processfail"
+    return results
+
+
+def get_batch_costs(session: Session, batch_filenames: list, dims: dict):
+    """Estimated peak memory of each batch (see `run_jobs`), which is that of its
+    largest input file since pam and paz process the files one after another.
+    `batch_filenames` contains the list of input files of each batch. Returns None
+    if there is no memory budget."""
+    if session.max_memory is None:
+        return None
+    return [max(estimate_memory_all(filenames, dims)) for filenames in batch_filenames]
+
+
+def process_files_batched(
+    session: Session,
+    pulsar: PulsarConfig,
+    ar_files: list,
+    costs: list,
+    dims: dict = None,
+):
+    """Process the input archives of a pulsar, running pam and paz on many files
+    per invocation. The Level 0 -> 1 step is still run one file at a time. The
+    dimensions of the input archives (`dims`, from the header index) are used to
+    estimate the memory needed by each batch if `session.max_memory` is given."""
+
+    results = run_jobs(
+        process_file_level01,
+        [(session, pulsar, ar_file) for ar_file in ar_files],
+        session.jobs,
+        costs=costs,
+        budget=session.max_memory,
+    )
+    indices = {result["input_file"]: idx for idx, result in enumerate(results)}
+
+    levels = [2, 3] if is_pzap_enabled(session, pulsar) else [2]
+    for level in levels:
+        if level == 2:
+            stage, get_output_filename = "level12", get_ftscr_filename
+        else:
+            stage, get_output_filename = "level23", get_pzap_filename
+
+        pending = [
+            result
+            for result in results
+            if result["status"] == "pending"
+            and not is_stage_current(
+                session,
+                pulsar,
+                result,
+                stage,
+                get_output_filename(session, result["prefix"]),
+            )
+        ]
+        if len(pending) == 0:
+            continue
+
+        if level == 2:
+            filenames = [r["zap_file"] for r in pending]
+            base_cmd_length = len(get_scrunch_cmd(session, pulsar, []))
+            # The Level 1 files have the dimensions of the input files.
+            file_dims = {
+                r["zap_file"]: dims[r["input_file"]]
+                for r in pending
+                if dims is not None and r["input_file"] in dims
+            }
+        else:
+            filenames = [get_ftscr_filename(session, r["prefix"]) for r in pending]
+            base_cmd_length = len(get_pzap_cmd(session, pulsar, []))
+            file_dims = {}
+        batches = get_batches(pending, filenames, base_cmd_length, session.jobs)
+        input_files = dict(zip([r["input_file"] for r in pending], filenames))
+        batch_filenames = [
+            [input_files[result["input_file"]] for result in batch] for batch in batches
+        ]
+
+        log.info(
+            f"Running Level {level-1} -> {level} on {len(pending)} files in {len(batches)} batches."
+        )
+        batch_results = run_jobs(
+            run_batch,
+            [(session, pulsar, batch, level) for batch in batches],
+            session.jobs,
+            costs=get_batch_costs(session, batch_filenames, file_dims),
+            budget=session.max_memory,
+        )
+
+        # The results are copies if the batches were run in worker processes.
+        for batch in batch_results:
+            for result in batch:
+                results[indices[result["input_file"]]] = result
+
+    if not is_pzap_enabled(session, pulsar):
+        log_skip_level23(session, pulsar)
+
+    for result in results:
+        if result["status"] == "pending":
+            result["status"] = "success"
+
+    return results
+
+
+def process_files(session: Session, pulsar: PulsarConfig, ar_files: list):
+    """Process the input archives of a pulsar, using `session.jobs` worker
+    processes. If `session.max_memory` is given, the number of files processed
+    concurrently is limited such that their estimated peak memory usage stays
+    within this budget. The headers of the input archives are pre-scanned first
+    (see `chimerawb.index`). The results are returned in the same order as
+    `ar_files`."""
+
+    # The files that are not in the input metafile are skipped without being read.
+    if session.input_metafile is not None:
+        input_file_names = set(session.input_file_names)
+        scan_files = [ar_file for ar_file in ar_files if ar_file in input_file_names]
+    else:
+        scan_files = ar_files
+    headers = scan_headers(session, scan_files)
+
+    dims = get_index_dims(headers)
+    costs = None
+    if session.jobs > 1:
+        log.info(f"Processing {len(ar_files)} files using {session.jobs} workers.")
+
+        if session.max_memory is not None:
+            to_process = [
+                ar_file
+                for ar_file in ar_files
+                if get_skip_status(session, pulsar, ar_file) is None
+            ]
+            estimates = dict(
+                zip(
+                    to_process,
+                    estimate_memory_all(to_process, dims),
+                )
+            )
+            costs = [estimates.get(ar_file, 0) for ar_file in ar_files]
+
+    if session.batch and not session.fused:
+        results = process_files_batched(session, pulsar, ar_files, costs, dims)
+    else:
+        results = run_jobs(
+            process_file,
+            [(session, pulsar, ar_file) for ar_file in ar_files],
+            session.jobs,
+            costs=costs,
+            budget=session.max_memory,
+        )
+
+    if session.memfail_retry_limit is not None:
+        results = retry_memfail(session, pulsar, results)
+
+    if is_zap_cache_enabled(session) and os.path.isdir(get_zap_cache_dir(session)):
+        evict_lru(get_zap_cache_dir(session), session.zap_cache_size, cleanup=True)
+
+    return results
+
+
+def retry_memfail(session: Session, pulsar: PulsarConfig, results: list):
+    """Process the files that exceeded the memory limit again, one at a time and with
+    the larger memory limit --memfail_retry_limit, once the other files have been
+    processed. The stages that were completed are not rerun. Returns the updated
+    results."""
+
+    memfail_files = [r["input_file"] for r in results if r["status"] == "memfail"]
+    if len(memfail_files) == 0:
+        return results
+
+    log.info(
+        f"Retrying {len(memfail_files)} files that exceeded the memory limit one at a time (memory limit = {session.memfail_retry_limit} bytes)."
+    )
+    memory_limit = session.memory_limit
+    session.memory_limit = session.memfail_retry_limit
+    try:
+        retried = {
+            ar_file: process_file(session, pulsar, ar_file) for ar_file in memfail_files
+        }
+    finally:
+        session.memory_limit = memory_limit
+
+    return [retried.get(result["input_file"], result) for result in results]
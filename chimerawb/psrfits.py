@@ -0,0 +1,356 @@
+import fcntl
+import os
+import shutil
+
+import numpy as np
+from astropy.io import fits
+from loguru import logger as log
+
+# ioctl request to clone a file (copy-on-write) on Linux.
+FICLONE = 0x40049409
+
+# Dispersion constant used by PSRCHIVE (s MHz^2 pc^-1 cm^3), so that the native
+# engines and chimeradm apply the same delays as pam.
+DM_CONSTANT = 1 / 2.41e-4
+
+INT16_MAX = 32767
+
+# Width of the off-pulse window used to remove the baseline (in units of the pulse
+# period), as in PSRCHIVE.
+BASELINE_DUTY = 0.15
+
+# Approximate memory used for the data of a chunk of subintegrations read at a
+# time by the functions in this module (bytes).
+DEFAULT_CHUNK_SIZE = 256 * 1024**2
+
+# Columns of the SUBINT table with one element per channel (and polarization).
+CHANNEL_COLUMNS = ["DAT_FREQ", "DAT_WTS", "DAT_OFFS", "DAT_SCL", "DATA"]
+
+
+def copy_file(src: str, dst: str):
+    """Copy a file, as a copy-on-write clone if the filesystem supports it."""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+
+
+def zap_channels(infile: str, outfile: str, zap_chans: list):
+    """Set the weights (DAT_WTS) of the channels `zap_chans` to zero in all
+    subintegrations of a PSRFITS file. The file is opened in memory-mapped update
+    mode so that only the weights are written. If `outfile` is not the same as
+    `infile`, `infile` is copied to `outfile` first and `outfile` is updated."""
+    if outfile != infile:
+        copy_file(infile, outfile)
+
+    with fits.open(outfile, mode="update", memmap=True) as hdul:
+        subint = hdul["SUBINT"]
+        nchan = subint.header["NCHAN"]
+
+        chans = sorted(set(chan for chan in zap_chans if 0 <= chan < nchan))
+        if len(chans) < len(set(zap_chans)):
+            log.warning(
+                f"Ignoring channels out of range in zap_chans (nchan = {nchan})."
+            )
+
+        weights = subint.data["DAT_WTS"].reshape(len(subint.data), nchan)
+        weights[:, chans] = 0
+
+
+def get_dispersion_phases(freqs, ref_freqs, dm: float, periods):
+    """Dispersion delays of channels at `freqs` relative to `ref_freqs` (MHz), in
+    units of the pulse period."""
+    return DM_CONSTANT * dm * (freqs**-2 - ref_freqs**-2) / periods
+
+
+def rotate_profiles(profiles, phases):
+    """Shift the profiles (phase bins along the last axis) earlier by `phases` (in
+    units of the pulse period) using the Fourier shift theorem. `phases` must
+    broadcast against the other axes of `profiles`."""
+    nbin = profiles.shape[-1]
+    spectra = np.fft.rfft(profiles, axis=-1)
+    harmonics = np.arange(spectra.shape[-1])
+    spectra *= np.exp(2j * np.pi * phases[..., None] * harmonics)
+    return np.fft.irfft(spectra, n=nbin, axis=-1)
+
+
+def quantize_profiles(profiles):
+    """Convert profiles of shape (npol, nchan, nbin) into 16-bit integers, with a
+    scale and an offset per polarization and channel like PSRFITS. Returns the
+    data, the scales and the offsets."""
+    pmin = profiles.min(axis=-1)
+    pmax = profiles.max(axis=-1)
+    offsets = (pmax + pmin) / 2
+    scales = (pmax - pmin) / (2 * INT16_MAX)
+    scales[scales == 0] = 1
+    data = np.rint((profiles - offsets[..., None]) / scales[..., None])
+    return data.astype(np.int16), scales, offsets
+
+
+def release_columns(columns):
+    """Detach the columns of a table from its data. Otherwise astropy copies the
+    data of the columns that are still referenced when the table is freed (see
+    `FITS_rec.__del__`), which would load the whole of a memory-mapped table into
+    memory."""
+    for col in columns:
+        col.array = None
+
+
+def get_chunk_rows(chunk_size: int, row_size: int):
+    """Number of rows of `row_size` bytes that fit in a chunk of `chunk_size` bytes
+    (at least one)."""
+    return max(chunk_size // row_size, 1)
+
+
+def scrunch(
+    infile: str,
+    outfile: str,
+    nchan: int,
+    nsub: int,
+    dm: float,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    """Dedisperse and scrunch a fold-mode PSRFITS file to `nchan` channels and
+    `nsub` subintegrations, like `pam --setnchn nchan --setnsub nsub -d dm`.
+
+    The input channels that make up an output channel are shifted to the centre
+    frequency of the output channel using the dispersion delays for `dm`, and are
+    averaged with their weights together with the other input subintegrations that
+    make up the output subintegration. The output data therefore keep the PSRFITS
+    convention of not being dedispersed across channels. The file is memory-mapped
+    and processed in chunks of subintegrations whose data take up about
+    `chunk_size` bytes in memory, so that the memory usage does not depend on the
+    size of the input file. Apart from these chunks, only a single copy of the
+    (scrunched) output table is kept in memory. The output is written to a temporary
+    file that is moved to `outfile` at the end."""
+
+    with fits.open(infile, memmap=True) as hdul:
+        subint = hdul["SUBINT"]
+        header = subint.header
+        nchan_in, npol, nbin = header["NCHAN"], header["NPOL"], header["NBIN"]
+        nsub_in = len(subint.data)
+
+        if nchan_in % nchan != 0:
+            raise ValueError(f"Unable to scrunch {nchan_in} channels to {nchan}.")
+        fscr = nchan_in // nchan
+        # Like pam, the last subintegration can be shorter than the others.
+        tscr = max(nsub_in // nsub, 1)
+        nsub_out = -(-nsub_in // tscr)
+
+        # The profiles are complex while being shifted.
+        chunk_rows = get_chunk_rows(chunk_size, npol * nchan_in * nbin * 16)
+
+        columns = subint.columns
+        is_float_data = subint.data["DATA"].dtype.kind == "f"
+        # Scalar columns other than TSUBINT are averaged over the subintegrations
+        # with their durations as weights.
+        mean_columns = [
+            col.name
+            for col in columns
+            if col.name not in CHANNEL_COLUMNS + ["TSUBINT"]
+            and subint.data[col.name].ndim == 1
+            and subint.data[col.name].dtype.kind == "f"
+        ]
+        # The output table is allocated once and filled in as each output
+        # subintegration is finished.
+        sizes = {
+            "DAT_FREQ": nchan,
+            "DAT_WTS": nchan,
+            "DAT_OFFS": nchan * npol,
+            "DAT_SCL": nchan * npol,
+            "DATA": nbin * nchan * npol,
+        }
+        new_columns = []
+        for col in columns:
+            if col.name in CHANNEL_COLUMNS:
+                new_columns.append(
+                    fits.Column(
+                        name=col.name,
+                        format=f"{sizes[col.name]}{col.format.format}",
+                        unit=col.unit,
+                        dim=f"({nbin},{nchan},{npol})" if col.name == "DATA" else None,
+                    )
+                )
+            else:
+                new_columns.append(
+                    fits.Column(
+                        name=col.name, format=col.format, unit=col.unit, dim=col.dim
+                    )
+                )
+
+        new_subint = fits.BinTableHDU.from_columns(
+            new_columns, header=header.copy(), nrows=nsub_out
+        )
+        output = new_subint.data
+
+        for isub in range(nsub_out):
+            start, stop = isub * tscr, min((isub + 1) * tscr, nsub_in)
+
+            first_row = subint.data[start]
+            freqs_out = first_row["DAT_FREQ"].reshape(nchan, fscr).mean(axis=-1)
+            ref_freqs = np.repeat(freqs_out, fscr)
+
+            profiles_sum = np.zeros((npol, nchan, nbin))
+            weights_sum = np.zeros(nchan)
+            tsubint = 0.0
+            mean_sums = dict.fromkeys(mean_columns, 0.0)
+            for chunk_start in range(start, stop, chunk_rows):
+                rows = subint.data[chunk_start : min(chunk_start + chunk_rows, stop)]
+                n = len(rows)
+                weights = rows["DAT_WTS"].reshape(n, nchan_in).astype(float)
+                scales = rows["DAT_SCL"].reshape(n, npol, nchan_in, 1)
+                offsets = rows["DAT_OFFS"].reshape(n, npol, nchan_in, 1)
+                profiles = (
+                    rows["DATA"].reshape(n, npol, nchan_in, nbin) * scales + offsets
+                )
+
+                phases = get_dispersion_phases(
+                    rows["DAT_FREQ"].reshape(n, nchan_in),
+                    ref_freqs,
+                    dm,
+                    rows["PERIOD"][:, None],
+                )
+                profiles = rotate_profiles(profiles, phases[:, None, :])
+
+                profiles_sum += (
+                    (profiles * weights[:, None, :, None])
+                    .reshape(n, npol, nchan, fscr, nbin)
+                    .sum(axis=(0, 3))
+                )
+                weights_sum += weights.reshape(n, nchan, fscr).sum(axis=(0, 2))
+
+                tsubint += rows["TSUBINT"].sum()
+                for name in mean_columns:
+                    mean_sums[name] += (rows[name] * rows["TSUBINT"]).sum()
+
+            profiles_out = np.zeros_like(profiles_sum)
+            np.divide(
+                profiles_sum,
+                weights_sum[:, None],
+                out=profiles_out,
+                where=weights_sum[:, None] > 0,
+            )
+            if is_float_data:
+                data = profiles_out
+                scales = np.ones((npol, nchan))
+                offsets = np.zeros((npol, nchan))
+            else:
+                data, scales, offsets = quantize_profiles(profiles_out)
+
+            row = {
+                col.name: first_row[col.name]
+                for col in columns
+                if col.name not in CHANNEL_COLUMNS
+            }
+            row["TSUBINT"] = tsubint
+            for name in mean_columns:
+                row[name] = mean_sums[name] / tsubint if tsubint > 0 else 0
+            row["DAT_FREQ"] = freqs_out
+            row["DAT_WTS"] = weights_sum
+            row["DAT_SCL"] = scales
+            row["DAT_OFFS"] = offsets
+            row["DATA"] = data
+            for name, value in row.items():
+                # Single-element columns (e.g. nchan = 1) are scalars.
+                output[name][isub] = np.reshape(value, output[name].shape[1:])
+
+        new_subint.header["NCHAN"] = nchan
+        new_subint.header["CHAN_BW"] = header["CHAN_BW"] * fscr
+        new_subint.header["DM"] = dm
+
+        # Don't leave a partially written file behind if writing fails.
+        tmp_outfile = f"{outfile}.tmp"
+        try:
+            fits.HDUList(
+                [new_subint if hdu is subint else hdu for hdu in hdul]
+            ).writeto(tmp_outfile, overwrite=True)
+            os.replace(tmp_outfile, outfile)
+        except BaseException:
+            if os.path.isfile(tmp_outfile):
+                os.unlink(tmp_outfile)
+            raise
+        finally:
+            release_columns(new_columns)
+            release_columns(new_subint.columns)
+            release_columns(subint.columns)
+
+
+def remove_baseline(port, duty: float = BASELINE_DUTY):
+    """Subtract the baseline of each channel of a portrait (nchan, nbin), like
+    PSRCHIVE. The off-pulse window is the (circular) window of `duty` times the
+    number of bins with the smallest mean in the channel-summed profile, and the mean
+    of each channel over this window is subtracted from it."""
+    nbin = port.shape[-1]
+    width = max(int(duty * nbin), 1)
+    profile = port.sum(axis=0)
+    window_sums = np.convolve(
+        np.concatenate([profile, profile[: width - 1]]), np.ones(width), "valid"
+    )
+    start = np.argmin(window_sums)
+    window = (start + np.arange(width)) % nbin
+    return port - port[:, window].mean(axis=1, keepdims=True)
+
+
+def read_portrait(infile: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Read the total intensity portrait of a fold-mode PSRFITS file, dedispersed at
+    the DM in its header, averaged over the subintegrations with the channel weights
+    and with the baseline removed (like a time-scrunched pplib.DataPortrait). The
+    channels are dedispersed relative to the centre frequency of the observation
+    (OBSFREQ). The file is memory-mapped and read in chunks of subintegrations whose
+    data take up about `chunk_size` bytes in memory. Returns the portrait (nchan,
+    nbin), the weights (1, nchan), the frequencies (1, nchan) and the folding
+    periods (1,)."""
+
+    with fits.open(infile, memmap=True) as hdul:
+        subint = hdul["SUBINT"]
+        header = subint.header
+        nchan, npol, nbin = header["NCHAN"], header["NPOL"], header["NBIN"]
+        nsub = len(subint.data)
+        dm = header.get("DM", hdul[0].header.get("CHAN_DM", 0.0))
+        freqs = np.array(subint.data["DAT_FREQ"][0], dtype=float).reshape(1, nchan)
+        ref_freq = hdul[0].header.get("OBSFREQ", freqs.mean())
+
+        # Total intensity is AA+BB for these polarization types, and the first
+        # polarization otherwise.
+        nsum = 2 if header.get("POL_TYPE") in ["AABBCRCI", "AABB"] else 1
+
+        # The profiles are complex while being shifted.
+        chunk_rows = get_chunk_rows(chunk_size, npol * nchan * nbin * 16)
+
+        port_sum = np.zeros((nchan, nbin))
+        weights_sum = np.zeros(nchan)
+        period_sum = 0.0
+        tsubint = 0.0
+        for start in range(0, nsub, chunk_rows):
+            rows = subint.data[start : start + chunk_rows]
+            n = len(rows)
+            weights = rows["DAT_WTS"].reshape(n, nchan).astype(float)
+            scales = rows["DAT_SCL"].reshape(n, npol, nchan, 1)[:, :nsum]
+            offsets = rows["DAT_OFFS"].reshape(n, npol, nchan, 1)[:, :nsum]
+            profiles = rows["DATA"].reshape(n, npol, nchan, nbin)[:, :nsum]
+            profiles = (profiles * scales + offsets).sum(axis=1)
+
+            phases = get_dispersion_phases(
+                rows["DAT_FREQ"].reshape(n, nchan),
+                ref_freq,
+                dm,
+                rows["PERIOD"][:, None],
+            )
+            profiles = rotate_profiles(profiles, phases)
+
+            port_sum += (profiles * weights[:, :, None]).sum(axis=0)
+            weights_sum += weights.sum(axis=0)
+            period_sum += (rows["PERIOD"] * rows["TSUBINT"]).sum()
+            tsubint += rows["TSUBINT"].sum()
+
+        port = np.zeros_like(port_sum)
+        np.divide(
+            port_sum, weights_sum[:, None], out=port, where=weights_sum[:, None] > 0
+        )
+        port = remove_baseline(port)
+        period = period_sum / tsubint if tsubint > 0 else subint.data["PERIOD"][0]
+
+    return port, weights_sum.reshape(1, nchan), freqs, np.array([period])
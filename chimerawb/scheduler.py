@@ -0,0 +1,139 @@
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from subprocess import DEVNULL, PIPE, run
+
+from loguru import logger as log
+
+# Rough model of the peak memory used by psrsh/pam while processing an archive.
+# PSRCHIVE keeps the data in memory as 32-bit floats, and the RFI excision
+# steps make temporary copies of the data cube.
+MEMORY_BASE = 256 * 1024**2
+MEMORY_OVERHEAD_FACTOR = 3
+BYTES_PER_SAMPLE = 4
+
+# Maximum number of files passed to a single vap invocation.
+VAP_BATCH_SIZE = 256
+
+
+def parse_size(size: str):
+    """Convert a memory or disk size like '64G', '512M' or '1000000' into bytes."""
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)i?B?\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Unable to parse size '{size}'.")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit or " "))
+
+
+def run_vap(filenames: list, keys: list):
+    """Read header parameters of archives using vap. Returns a dict containing the
+    list of values (as strings) of each file that vap can read, or None if vap
+    could not be run."""
+    fields = {}
+    for i in range(0, len(filenames), VAP_BATCH_SIZE):
+        chunk = filenames[i : i + VAP_BATCH_SIZE]
+        try:
+            output = run(
+                ["vap", "-nc", ",".join(keys), *chunk],
+                stdout=PIPE,
+                stderr=DEVNULL,
+            ).stdout.decode("utf-8")
+        except Exception:
+            log.warning("Unable to read archive headers using vap.")
+            return None
+
+        for line in output.splitlines():
+            values = line.split()
+            if len(values) == len(keys) + 1 and values[0] in chunk:
+                fields[values[0]] = values[1:]
+
+    return fields
+
+
+def get_archive_dims(filenames: list):
+    """Read (nsub, nchan, nbin, npol) from the archive headers using vap.
+    Files that vap cannot read are not included in the output."""
+    dims = {}
+    for filename, values in (
+        run_vap(filenames, ["nsub", "nchan", "nbin", "npol"]) or {}
+    ).items():
+        try:
+            dims[filename] = tuple(map(int, values))
+        except ValueError:
+            continue
+    return dims
+
+
+def estimate_memory(filename: str, dims: tuple = None):
+    """Estimate the peak memory (in bytes) needed to process an archive
+    from its size on disk and its dimensions (nsub, nchan, nbin, npol)."""
+    data_size = 2 * os.path.getsize(filename)
+    if dims is not None:
+        nsub, nchan, nbin, npol = dims
+        data_size = max(data_size, nsub * nchan * nbin * npol * BYTES_PER_SAMPLE)
+    return MEMORY_BASE + MEMORY_OVERHEAD_FACTOR * data_size
+
+
+def estimate_memory_all(filenames: list, dims: dict = None):
+    """Estimate the peak memory needed to process each archive in `filenames`. The
+    dimensions of the archives are read using vap if `dims` is not given."""
+    if dims is None:
+        dims = get_archive_dims(filenames)
+    costs = []
+    for filename in filenames:
+        try:
+            costs.append(estimate_memory(filename, dims.get(filename)))
+        except OSError:
+            # This file will fail anyway.
+            costs.append(MEMORY_BASE)
+    return costs
+
+
+def run_jobs(
+    func, args_list: list, jobs: int = 1, costs: list = None, budget: int = None
+):
+    """Call `func(*args)` for each `args` in `args_list`, using a pool of
+    `jobs` worker processes if `jobs` > 1. The results are returned in the
+    same order as `args_list`.
+
+    If `costs` and `budget` are given, a job is only started if the sum of the
+    costs of the running jobs stays within the budget. A job that does not fit
+    in the budget by itself is run alone."""
+    if jobs <= 1:
+        return [func(*args) for args in args_list]
+
+    if costs is None or budget is None:
+        costs = [0] * len(args_list)
+        budget = 0
+
+    # Start the most expensive jobs first so that they don't end up running
+    # alone at the end.
+    pending = sorted(range(len(args_list)), key=lambda idx: -costs[idx])
+    running = {}
+    in_use = 0
+    results = [None] * len(args_list)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < jobs:
+                idx = next(
+                    (idx for idx in pending if in_use + costs[idx] <= budget),
+                    pending[0] if len(running) == 0 else None,
+                )
+                if idx is None:
+                    break
+                if costs[idx] > budget > 0:
+                    log.warning(
+                        f"Estimated memory {costs[idx]/1024**3:.2f} GB exceeds the budget. Running job alone."
+                    )
+                pending.remove(idx)
+                running[executor.submit(func, *args_list[idx])] = idx
+                in_use += costs[idx]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = running.pop(future)
+                in_use -= costs[idx]
+                results[idx] = future.result()
+
+    return results
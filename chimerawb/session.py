@@ -1,10 +1,13 @@
 import argparse
 import json
 import os
+import time
 from glob import glob
 
 from loguru import logger as log
 
+from .manifest import Manifest
+from .scheduler import parse_size
 from .validation import test_dir, test_input_file, test_read_dir, check_command
 from ._version import get_versions
 
@@ -18,6 +21,8 @@ class PulsarConfig:
         nsub: int,
         zap_chans: list,
         template: str = "",
+        scrunch_engine: str = "pam",
+        pzap_engine: str = "paz",
     ):
         self.name = name
         self.dm = dm
@@ -25,6 +30,8 @@ class PulsarConfig:
         self.nchan = nchan
         self.nsub = nsub
         self.zap_chans = zap_chans
+        self.scrunch_engine = scrunch_engine
+        self.pzap_engine = pzap_engine
         self.datafile_glob_prefix = f"CHIME_{self.name}*_beam_?_?????_*"
 
         self.validate()
@@ -37,6 +44,8 @@ class PulsarConfig:
             assert isinstance(self.nchan, int) and self.nchan > 0
             assert isinstance(self.nsub, int) and self.nchan > 0
             assert isinstance(self.zap_chans, list)
+            assert self.scrunch_engine in ["pam", "native"]
+            assert self.pzap_engine in ["paz", "native"]
 
             for zap_chan in self.zap_chans:
                 assert (
@@ -56,6 +65,8 @@ class Session:
 
     def __init__(self):
 
+        self.start_time = time.time()
+
         parser = argparse.ArgumentParser(
             description="Generate TOAs from fold mode CHIME data."
         )
@@ -113,6 +124,20 @@ class Session:
             action="store_true",
             help="Skip TOA generation.",
         )
+        parser.add_argument(
+            "--batch_toas",
+            required=False,
+            dest="batch_toas",
+            action="store_true",
+            help="Create TOAs for all files with a single GetTOAs call.",
+        )
+        parser.add_argument(
+            "--toa_jobs",
+            required=False,
+            type=int,
+            default=1,
+            help="Number of worker processes for TOA generation.",
+        )
         parser.add_argument(
             "-C",
             "--clean",
@@ -121,6 +146,105 @@ class Session:
             action="store_true",
             help="Remove intermediate files.",
         )
+        parser.add_argument(
+            "--zap_cache_size",
+            required=False,
+            help="With --clean, keep the RFI-excised (.zap) files in a cache of at most this size (e.g. 500G) instead of removing them. The least recently used files are removed first.",
+        )
+        parser.add_argument(
+            "--fused",
+            required=False,
+            dest="fused",
+            action="store_true",
+            help="Run RFI excision, scrunching and post-scrunch zapping in a single psrsh run without writing intermediate files.",
+        )
+        parser.add_argument(
+            "--batch",
+            required=False,
+            dest="batch",
+            action="store_true",
+            help="Run pam and paz on many files per invocation (ignored if --fused is given).",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            required=False,
+            type=int,
+            default=None,
+            help="Number of input files to process in parallel (default 1, or the number of CPUs if --max_memory is given).",
+        )
+        parser.add_argument(
+            "--max_memory",
+            required=False,
+            help="Memory budget for processing files in parallel (e.g. 64G). Files are processed concurrently only if their estimated peak memory usage fits in the budget.",
+        )
+        parser.add_argument(
+            "--chunk_size",
+            required=False,
+            default="256M",
+            help="Approximate memory used for the subintegrations read at a time by the native engines (default 256M).",
+        )
+        parser.add_argument(
+            "--memory_limit",
+            required=False,
+            help="Limit the address space of each processing command (psrsh, pam or paz) to this size (e.g. 8G). Files whose processing runs out of memory are recorded as failed (memfail) and skipped.",
+        )
+        parser.add_argument(
+            "--memfail_retry_limit",
+            required=False,
+            help="Process the files that exceeded --memory_limit again, one at a time with this larger memory limit, after the other files (e.g. 32G).",
+        )
+        parser.add_argument(
+            "--timeout",
+            required=False,
+            type=float,
+            help="Kill a processing command (psrsh, pam or paz) if it runs for longer than this (s) per file it processes, in addition to --timeout_per_gb. The file is recorded as failed and skipped.",
+        )
+        parser.add_argument(
+            "--timeout_per_gb",
+            required=False,
+            type=float,
+            help="Additional time (s) allowed for a processing command per GB of the files it processes. Requires --timeout, which is the minimum time allowed per file.",
+        )
+        parser.add_argument(
+            "--watch",
+            required=False,
+            dest="watch",
+            action="store_true",
+            help="After processing the existing files, keep watching the input directory and process new files as they arrive (stop with Ctrl-C or SIGTERM).",
+        )
+        parser.add_argument(
+            "--watch_interval",
+            required=False,
+            type=float,
+            default=10,
+            help="Interval (s) between checks for new files in --watch mode.",
+        )
+        parser.add_argument(
+            "--settle_time",
+            required=False,
+            type=float,
+            default=60,
+            help="In --watch mode, a new file is processed once it has been closed after writing, or once it has not changed for this long (s).",
+        )
+        parser.add_argument(
+            "--min_mjd",
+            required=False,
+            type=float,
+            help="Only process the input files observed on or after this MJD.",
+        )
+        parser.add_argument(
+            "--max_mjd",
+            required=False,
+            type=float,
+            help="Only process the input files observed on or before this MJD.",
+        )
+        parser.add_argument(
+            "--trace",
+            required=False,
+            dest="trace_file",
+            help="Write a trace of the run (a span for each processing stage, header update, TOA generation and validation) to this file in the Chrome trace event format, to be opened in Perfetto.",
+        )
         args = parser.parse_args()
 
         required_cmds = [
@@ -128,6 +252,7 @@ class Session:
             "psrchive",
             "pam",
             "paz",
+            "vap",
             "chime_convert_and_tfzap.psh",
         ]
         for cmd in required_cmds:
@@ -136,6 +261,7 @@ class Session:
         self.input_dir = test_read_dir(os.path.realpath(args.input_dir))
         self.output_dir = test_dir(os.path.realpath(args.output_dir))
         self.config_file = test_input_file(os.path.realpath(args.config))
+        self.manifest = Manifest(f"{self.output_dir}/chimerawb_manifest.db")
 
         if args.metafile is not None:
             self.input_metafile = test_input_file(os.path.realpath(args.metafile))
@@ -151,7 +277,74 @@ class Session:
         self.reprocess = args.reprocess
         self.skip_pzap = args.skip_pzap
         self.skip_toagen = args.skip_toagen
+        self.batch_toas = args.batch_toas
+
+        if args.toa_jobs < 1:
+            raise ValueError("The number of TOA jobs (--toa_jobs) must be positive.")
+        self.toa_jobs = args.toa_jobs
         self.clean_files = args.clean_files
+        self.zap_cache_size = (
+            parse_size(args.zap_cache_size) if args.zap_cache_size is not None else None
+        )
+        if self.zap_cache_size is not None and not self.clean_files:
+            log.warning("--zap_cache_size has no effect without --clean.")
+        self.fused = args.fused
+        self.batch = args.batch
+
+        self.max_memory = (
+            parse_size(args.max_memory) if args.max_memory is not None else None
+        )
+        self.chunk_size = parse_size(args.chunk_size)
+        if self.chunk_size <= 0:
+            raise ValueError("The chunk size (--chunk_size) must be positive.")
+
+        self.memory_limit = (
+            parse_size(args.memory_limit) if args.memory_limit is not None else None
+        )
+        self.memfail_retry_limit = (
+            parse_size(args.memfail_retry_limit)
+            if args.memfail_retry_limit is not None
+            else None
+        )
+        if self.memfail_retry_limit is not None and (
+            self.memory_limit is None or self.memfail_retry_limit <= self.memory_limit
+        ):
+            raise ValueError(
+                "--memfail_retry_limit must be given with a smaller --memory_limit."
+            )
+
+        if (args.timeout is not None and args.timeout <= 0) or (
+            args.timeout_per_gb is not None and args.timeout_per_gb < 0
+        ):
+            raise ValueError("Invalid --timeout or --timeout_per_gb.")
+        if args.timeout_per_gb is not None and args.timeout is None:
+            # Otherwise small files (e.g. truncated ones) would get almost no time.
+            raise ValueError("--timeout_per_gb must be given with --timeout.")
+        self.timeout = args.timeout
+        self.timeout_per_gb = args.timeout_per_gb
+
+        if args.jobs is None:
+            self.jobs = os.cpu_count() if self.max_memory is not None else 1
+        elif args.jobs < 1:
+            raise ValueError("The number of jobs (--jobs) must be positive.")
+        else:
+            self.jobs = args.jobs
+
+        self.watch = args.watch
+        if args.watch_interval <= 0 or args.settle_time < 0:
+            raise ValueError("Invalid --watch_interval or --settle_time.")
+        self.watch_interval = args.watch_interval
+        self.settle_time = args.settle_time
+
+        self.min_mjd = args.min_mjd
+        self.max_mjd = args.max_mjd
+
+        self.trace_file = (
+            os.path.realpath(args.trace_file) if args.trace_file is not None else None
+        )
+        if self.trace_file is not None and os.path.isfile(f"{self.trace_file}.events"):
+            # Events of a previous run.
+            os.unlink(f"{self.trace_file}.events")
 
         self.process_config()
 
@@ -165,15 +358,30 @@ class Session:
                     "The JSON config is malformed or missing attributes."
                 )
 
-    def create_output_metafile(self, pulsar: PulsarConfig):
-        """Make a metafile of the fully zapped and scrunched files"""
+    def create_output_metafile(
+        self,
+        pulsar: PulsarConfig,
+        files: list = None,
+        output_meta_file: str = None,
+        append: bool = False,
+    ):
+        """Make a metafile of the fully zapped and scrunched files.
+        If `files` is not given, all the pzap files in the output directory are included.
+        If `append` is True, the files already listed in the metafile are kept."""
+
+        if files is None:
+            files = glob(f"{self.output_dir}/{pulsar.datafile_glob_prefix}.pzap")
+        if output_meta_file is None:
+            output_meta_file = f"{self.output_dir}/{pulsar.name}.meta"
 
-        pzap_files = glob(f"{self.output_dir}/{pulsar.datafile_glob_prefix}.pzap")
-        output_meta_file = f"{self.output_dir}/{pulsar.name}.meta"
+        if append and os.path.isfile(output_meta_file):
+            with open(output_meta_file, "r") as metafile:
+                old_files = [line.strip() for line in metafile if line.strip() != ""]
+            files = old_files + [file for file in files if file not in old_files]
 
         log.info(f"Creating meta file {output_meta_file}.")
         with open(output_meta_file, "w") as metafile:
-            for pzap_file in pzap_files:
-                metafile.write(f"{pzap_file}\n")
+            for file in files:
+                metafile.write(f"{file}\n")
 
         self.output_meta_file = output_meta_file
@@ -1,42 +1,337 @@
 import os
+import time
+import traceback
+from decimal import Decimal, InvalidOperation
+from glob import glob
 
 from loguru import logger as log
 from pint.toa import get_TOAs
 from pplib import write_TOAs
 from pptoas import GetTOAs
 
+from .cache import get_toa_params
+from .exec import record_timing
+from .fileutils import get_file_prefix
+from .scheduler import run_jobs
 from .session import PulsarConfig, Session
+from .trace import trace_span
+
+# Lines in a tim file that are not TOAs.
+TIM_COMMANDS = ["FORMAT", "MODE", "C", "#", "TIME", "EFAC", "EQUAD", "JUMP", "INCLUDE"]
 
 
 def get_tim_filename(session: Session, pulsar: PulsarConfig):
     return f"{session.output_dir}/{pulsar.name}.tim"
 
 
-def create_toas(session: Session, pulsar: PulsarConfig, input_file: str):
-    # Make a metafile of the fully zapped and scrunched files
-    # session.create_output_metafile(pulsar)
+def get_partial_tim_filename(session: Session, pulsar: PulsarConfig, idx):
+    return f"{session.output_dir}/{pulsar.name}.tim.{idx}"
+
+
+def get_partial_meta_filename(session: Session, pulsar: PulsarConfig, idx):
+    return f"{session.output_dir}/{pulsar.name}.meta.{idx}"
+
 
+def write_metafile(metafile: str, input_files: list):
+    """Write a metafile listing `input_files`, one per line."""
+    with open(metafile, "w") as f:
+        for input_file in input_files:
+            f.write(f"{input_file}\n")
+
+
+def create_toas(
+    session: Session, pulsar: PulsarConfig, input_file: str, timfile: str = None
+):
     gt = GetTOAs(input_file, pulsar.template)
     gt.get_TOAs(DM0=pulsar.dm)
 
     # Writing to a tim file
     # There is an optional SNR_cutoff and way to append to an existing timfile
-    timfile = get_tim_filename(session, pulsar)
+    if timfile is None:
+        timfile = get_tim_filename(session, pulsar)
     write_TOAs(gt.TOA_list, SNR_cutoff=0.0, outfile=timfile, append=True)
 
 
-def remove_toa_file(session: Session, pulsar: PulsarConfig):
+def create_toas_one_by_one(
+    session: Session, pulsar: PulsarConfig, input_files: list, timfile: str = None
+):
+    """Create TOAs for each file separately, recording the time taken for each file
+    in the timing file. Returns the list of files for which the TOA generation
+    failed."""
+    failed_files = []
+    for toa_input_file in input_files:
+        prefix = get_file_prefix(toa_input_file)
+        start = time.time()
+        with trace_span(session, "toas", "toas", pulsar=pulsar.name, file=prefix):
+            try:
+                create_toas(session, pulsar, toa_input_file, timfile)
+            except Exception as err:
+                log.error(f"Failed to create TOA for {toa_input_file}. Skipping file.")
+                log.error(err)
+                traceback.print_tb(err.__traceback__)
+                failed_files.append(toa_input_file)
+        end = time.time()
+        record_timing(session, pulsar.name, prefix, "toas", end - start)
+    return failed_files
+
+
+def create_toas_batch(
+    session: Session,
+    pulsar: PulsarConfig,
+    input_files: list,
+    timfile: str = None,
+    metafile: str = None,
+):
+    """Create TOAs for all files with a single GetTOAs call so that the template is
+    loaded only once, and write the tim file in one go. Falls back to creating TOAs
+    one by one if the batch fails. The time taken is divided equally among the files
+    in the timing file. Returns the list of files for which the TOA generation
+    failed."""
+    if len(input_files) == 0:
+        return []
+
+    start = time.time()
+    if timfile is None:
+        timfile = get_tim_filename(session, pulsar)
+    if metafile is None:
+        metafile = get_partial_meta_filename(session, pulsar, "batch")
+
+    # Make a temporary metafile of the fully zapped and scrunched files. The output
+    # metafile of the session is not touched.
+    write_metafile(metafile, input_files)
+
+    try:
+        gt = GetTOAs(metafile, pulsar.template)
+        gt.get_TOAs(DM0=pulsar.dm)
+
+        write_TOAs(gt.TOA_list, SNR_cutoff=0.0, outfile=timfile, append=False)
+    except Exception as err:
+        log.error("Batch TOA generation failed. Creating TOAs one by one.")
+        log.error(err)
+        traceback.print_tb(err.__traceback__)
+        if os.path.isfile(timfile):
+            os.unlink(timfile)
+        return create_toas_one_by_one(session, pulsar, input_files, timfile)
+    finally:
+        os.unlink(metafile)
+
+    end = time.time()
+    for toa_input_file in input_files:
+        record_timing(
+            session,
+            pulsar.name,
+            get_file_prefix(toa_input_file),
+            "toas",
+            (end - start) / len(input_files),
+            len(input_files),
+        )
+
+    # GetTOAs skips the files it cannot process.
+    files_with_toas = set(toa.archive for toa in gt.TOA_list)
+    failed_files = [f for f in input_files if f not in files_with_toas]
+    for toa_input_file in failed_files:
+        log.error(f"Failed to create TOA for {toa_input_file}.")
+
+    return failed_files
+
+
+def create_toas_chunk(
+    session: Session, pulsar: PulsarConfig, input_files: list, idx: int
+):
+    """Create TOAs for a chunk of files in a worker process. The TOAs are
+    written to a partial tim file."""
+    timfile = get_partial_tim_filename(session, pulsar, idx)
+    metafile = get_partial_meta_filename(session, pulsar, idx)
+    with trace_span(
+        session,
+        "toas_chunk",
+        "toas",
+        pulsar=pulsar.name,
+        files=[get_file_prefix(f) for f in input_files],
+    ):
+        return create_toas_batch(session, pulsar, input_files, timfile, metafile)
+
+
+def create_toas_parallel(
+    session: Session, pulsar: PulsarConfig, input_files: list, timfile: str = None
+):
+    """Create TOAs using `session.toa_jobs` worker processes. Each worker creates
+    TOAs for a chunk of files with a single GetTOAs call, so that the template is
+    loaded only once per worker. The partial tim files are merged into the tim file
+    in MJD order. Returns the list of files for which the TOA generation failed."""
+    if len(input_files) == 0:
+        return []
+
+    if timfile is None:
+        timfile = get_tim_filename(session, pulsar)
+
+    nchunks = min(session.toa_jobs, len(input_files))
+    chunks = [input_files[idx::nchunks] for idx in range(nchunks)]
+
+    log.info(f"Creating TOAs for {len(input_files)} files using {nchunks} workers.")
+    chunk_failed_files = run_jobs(
+        create_toas_chunk,
+        [(session, pulsar, chunk, idx) for idx, chunk in enumerate(chunks)],
+        session.toa_jobs,
+    )
+
+    partial_timfiles = [
+        get_partial_tim_filename(session, pulsar, idx) for idx in range(nchunks)
+    ]
+    partial_timfiles = [f for f in partial_timfiles if os.path.isfile(f)]
+    merge_tim_files(partial_timfiles, timfile)
+    for partial_timfile in partial_timfiles:
+        os.unlink(partial_timfile)
+
+    # Preserve the order of input_files.
+    failed_files = set(sum(chunk_failed_files, []))
+    return [f for f in input_files if f in failed_files]
+
+
+def update_toas(
+    session: Session,
+    pulsar: PulsarConfig,
+    input_files: list,
+    keep_other_files: bool = False,
+):
+    """Update the tim file with the TOAs of `input_files`. TOAs are created only for
+    the files that have no TOAs in the tim file or whose TOAs are out of date
+    according to the manifest (the file or the template/DM have changed), or for
+    all files with --reprocess. Files for which the TOA generation failed before
+    are not retried unless they are out of date. The new TOAs replace the old TOAs
+    of these files in the tim file, which is rewritten atomically in MJD order. The
+    TOAs of files not in `input_files` are removed unless `keep_other_files` is
+    True. Returns the list of files that have no TOAs."""
     timfile = get_tim_filename(session, pulsar)
+    params = get_toa_params(pulsar)
+
     if os.path.isfile(timfile):
-        log.info(f"File {timfile} will be rewritten.")
-        os.unlink(timfile)
+        header_lines, toa_lines = read_tim_file(timfile)
+    else:
+        header_lines, toa_lines = [], []
+    existing_files = set(get_toa_archive(line) for line in toa_lines)
+
+    def is_toa_current(f):
+        if session.reprocess or not session.manifest.is_toa_current(f, params):
+            return False
+        # Files for which the TOA generation failed are not retried.
+        return f in existing_files or session.manifest.get_toa_count(f) == 0
+
+    new_files = [f for f in input_files if not is_toa_current(f)]
+    log.info(
+        f"Creating TOAs for {len(new_files)} new or changed files ({len(input_files) - len(new_files)} files are up to date)."
+    )
+
+    # Remove the partial tim files left over by an interrupted run, which the new
+    # TOAs would otherwise be appended to.
+    for partial_timfile in glob(get_partial_tim_filename(session, pulsar, "*")):
+        os.unlink(partial_timfile)
+
+    new_timfile = get_partial_tim_filename(session, pulsar, "new")
+    with trace_span(
+        session, "toa_generation", "toas", pulsar=pulsar.name, nfiles=len(new_files)
+    ):
+        if session.toa_jobs > 1:
+            create_toas_parallel(session, pulsar, new_files, new_timfile)
+        elif session.batch_toas:
+            metafile = get_partial_meta_filename(session, pulsar, "new")
+            create_toas_batch(session, pulsar, new_files, new_timfile, metafile)
+        else:
+            create_toas_one_by_one(session, pulsar, new_files, new_timfile)
+
+    # Splice the new TOAs into the tim file.
+    removed_files = set(new_files)
+    if not keep_other_files:
+        removed_files |= existing_files - set(input_files)
+    toa_lines = [
+        line for line in toa_lines if get_toa_archive(line) not in removed_files
+    ]
+    new_toa_lines = []
+    if os.path.isfile(new_timfile):
+        new_header_lines, new_toa_lines = read_tim_file(new_timfile)
+        header_lines += [line for line in new_header_lines if line not in header_lines]
+        os.unlink(new_timfile)
+
+    if len(new_files) > 0 or len(removed_files) > 0 or not os.path.isfile(timfile):
+        log.info(f"Writing {len(toa_lines) + len(new_toa_lines)} TOAs to {timfile}.")
+        write_tim_file(timfile, header_lines, toa_lines + new_toa_lines)
+
+    ntoas = {}
+    for line in new_toa_lines:
+        archive = get_toa_archive(line)
+        ntoas[archive] = ntoas.get(archive, 0) + 1
+    for archive in new_files:
+        session.manifest.record_toas(
+            pulsar.name, archive, params, ntoas.get(archive, 0)
+        )
+
+    return [f for f in input_files if session.manifest.get_toa_count(f) == 0]
+
+
+def is_toa_line(line: str):
+    fields = line.split()
+    if len(fields) < 5 or fields[0] in TIM_COMMANDS or line.startswith("#"):
+        return False
+    try:
+        Decimal(fields[2])
+        return True
+    except InvalidOperation:
+        return False
+
+
+def get_toa_mjd(line: str):
+    return Decimal(line.split()[2])
+
+
+def get_toa_archive(line: str):
+    return line.split()[0]
+
+
+def read_tim_file(timfile: str):
+    """Read a tim file. Returns the list of header (non-TOA) lines and the list
+    of TOA lines."""
+    header_lines = []
+    toa_lines = []
+    with open(timfile, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if is_toa_line(line):
+                toa_lines.append(line)
+            elif line.strip() != "" and line not in header_lines:
+                header_lines.append(line)
+    return header_lines, toa_lines
+
+
+def write_tim_file(timfile: str, header_lines: list, toa_lines: list):
+    """Write a tim file with the TOAs sorted by MJD. The file is first written to
+    a temporary file and then moved into place so that it is never left incomplete."""
+    toa_lines = sorted(toa_lines, key=lambda line: (get_toa_mjd(line), line))
+    tmp_timfile = f"{timfile}.tmp"
+    with open(tmp_timfile, "w") as f:
+        for line in header_lines + toa_lines:
+            f.write(f"{line}\n")
+    os.replace(tmp_timfile, timfile)
+
+
+def merge_tim_files(timfiles: list, output_timfile: str):
+    """Merge tim files into a single tim file with the TOAs sorted by MJD."""
+    header_lines = []
+    toa_lines = []
+    for timfile in timfiles:
+        file_header_lines, file_toa_lines = read_tim_file(timfile)
+        header_lines += [line for line in file_header_lines if line not in header_lines]
+        toa_lines += file_toa_lines
+
+    log.info(f"Merging {len(timfiles)} tim files into {output_timfile}.")
+    write_tim_file(output_timfile, header_lines, toa_lines)
 
 
 def validate_toa_file(session: Session, pulsar: PulsarConfig, num_toas_expected: int):
     timfile = get_tim_filename(session, pulsar)
-    try:
-        toas = get_TOAs(timfile)
-        assert len(toas) == num_toas_expected
-        log.info(f"Successfully created {timfile}.")
-    except Exception:
-        log.error(f"Unable to validate {timfile}.")
+    with trace_span(session, "validation", "toas", pulsar=pulsar.name):
+        try:
+            toas = get_TOAs(timfile)
+            assert len(toas) == num_toas_expected
+            log.info(f"Successfully created {timfile}.")
+        except Exception:
+            log.error(f"Unable to validate {timfile}.")
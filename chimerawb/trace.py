@@ -0,0 +1,87 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from .session import Session
+
+# All events are shown as threads (one per worker process) of a single process.
+TRACE_PID = 1
+
+
+def get_trace_events_filename(session: Session):
+    return f"{session.trace_file}.events"
+
+
+def add_trace_event(
+    session: Session, name: str, category: str, start: float, end: float, args: dict
+):
+    """Append a complete event (a span from `start` to `end`) to the trace events
+    file if --trace is given. The events are written as JSON Lines, one write per
+    event, so that events from worker processes are not interleaved."""
+    if session.trace_file is None:
+        return
+
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": start * 1e6,
+        "dur": (end - start) * 1e6,
+        "pid": TRACE_PID,
+        "tid": os.getpid(),
+        "args": args,
+    }
+    with open(get_trace_events_filename(session), "a") as events_file:
+        events_file.write(f"{json.dumps(event)}\n")
+
+
+@contextmanager
+def trace_span(session: Session, name: str, category: str, **args):
+    """Record the code run within the context as a span in the trace."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_trace_event(session, name, category, start, time.time(), args)
+
+
+def write_trace_file(session: Session):
+    """Write the events recorded so far to the trace file in the Chrome trace event
+    format, which can be opened in Perfetto or chrome://tracing. The threads are
+    named after the worker processes."""
+    if session.trace_file is None:
+        return
+
+    events = []
+    try:
+        with open(get_trace_events_filename(session), "r") as events_file:
+            events = [json.loads(line) for line in events_file]
+    except OSError:
+        pass
+
+    metadata = [
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": TRACE_PID,
+            "args": {"name": "chimerawb"},
+        }
+    ]
+    for tid in sorted(set(event["tid"] for event in events)):
+        metadata.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": TRACE_PID,
+                "tid": tid,
+                "args": {"name": "main" if tid == os.getpid() else f"worker {tid}"},
+            }
+        )
+
+    tmp_trace_file = f"{session.trace_file}.tmp"
+    with open(tmp_trace_file, "w") as trace_file:
+        json.dump(
+            {"traceEvents": metadata + events, "displayTimeUnit": "ms"}, trace_file
+        )
+    os.replace(tmp_trace_file, session.trace_file)
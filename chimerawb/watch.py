@@ -0,0 +1,206 @@
+import os
+import signal
+import time
+from fnmatch import fnmatch
+
+from loguru import logger as log
+
+from .exec import (
+    add_usage_to_summary,
+    create_exec_summary_file,
+    get_timing_aggregates,
+)
+from .manifest import get_file_signature
+from .pipeline import process_files
+from .session import PulsarConfig, Session
+from .toautils import update_toas
+from .trace import write_trace_file
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+class DirectoryWatcher:
+    """Watch a directory for new or modified files using inotify, or by polling the
+    directory if inotify is not available.
+
+    A file is considered complete once it has been closed after writing (or moved
+    into the directory), or, when polling, once its size and modification time have
+    not changed for `settle_time` seconds. Files that have already been processed
+    (see `ignore_unchanged`) are not returned unless they are modified again."""
+
+    def __init__(self, directory: str, poll_interval: float, settle_time: float):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+
+        # File name -> time of the last change.
+        self.pending = {}
+        # Files that have been closed after writing since the last change.
+        self.closed = set()
+        # File name -> (size, mtime) when it was processed.
+        self.processed = {}
+
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.inotify.add_watch(
+                    directory,
+                    flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO,
+                )
+                log.info(f"Watching {directory} using inotify.")
+            except OSError:
+                log.warning("Unable to use inotify. Falling back to polling.")
+                self.inotify = None
+
+        if self.inotify is None:
+            log.info(f"Watching {directory} by polling every {poll_interval} s.")
+            # Files that exist already are not new.
+            self.signatures = self.scan()
+
+    def scan(self):
+        signatures = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    signatures[entry.path] = get_file_signature(entry.path)
+        return signatures
+
+    def ignore_unchanged(self, signatures: dict):
+        """Ignore the changes to files that have already been processed (e.g. by the
+        initial pass over the input dir, which can overlap with the first changes
+        seen by the watcher) as long as their size and modification time are the
+        same as when they were processed. `signatures` maps the files to their
+        (size, mtime) when they were processed."""
+        self.processed.update(signatures)
+
+    def read_events(self):
+        now = time.time()
+        for event in self.inotify.read(timeout=int(self.poll_interval * 1000)):
+            if event.name == "":
+                continue
+            filename = f"{self.directory}/{event.name}"
+            self.pending[filename] = now
+            if event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                self.closed.add(filename)
+            else:
+                self.closed.discard(filename)
+
+    def poll(self):
+        time.sleep(self.poll_interval)
+        now = time.time()
+        signatures = self.scan()
+        for filename, signature in signatures.items():
+            if self.signatures.get(filename) != signature:
+                self.pending[filename] = now
+        self.signatures = signatures
+
+    def get_complete_files(self):
+        """Wait for at most `poll_interval` seconds and return the list of new files
+        that are complete."""
+        if self.inotify is not None:
+            self.read_events()
+        else:
+            self.poll()
+
+        now = time.time()
+        complete_files = []
+        for filename, last_change in list(self.pending.items()):
+            if not os.path.isfile(filename):
+                # Temporary file that was moved or deleted.
+                self.pending.pop(filename)
+                self.closed.discard(filename)
+            elif filename in self.closed or now - last_change >= self.settle_time:
+                self.pending.pop(filename)
+                self.closed.discard(filename)
+                if self.processed.get(filename) != get_file_signature(filename):
+                    complete_files.append(filename)
+
+        return sorted(complete_files)
+
+
+def get_pulsar_for_file(session: Session, filename: str):
+    """Find the pulsar whose input file name pattern matches the given file."""
+    for pulsar in session.pulsars:
+        if fnmatch(os.path.basename(filename), f"{pulsar.datafile_glob_prefix}.ar"):
+            return pulsar
+    return None
+
+
+def process_new_files(
+    session: Session, pulsar: PulsarConfig, ar_files: list, pulsar_summary: dict
+):
+    """Process new input archives of a pulsar and add their TOAs to the tim file."""
+
+    log.info(f"### Processing {len(ar_files)} new files for {pulsar.name} ###")
+
+    results = process_files(session, pulsar, ar_files)
+
+    # Files that are up to date (e.g. rewritten without changes) have been counted
+    # already.
+    results = [result for result in results if result["status"] != "skip_exist"]
+
+    pulsar_summary["num_files_total"] += len(results)
+    for result in results:
+        pulsar_summary[f"num_files_{result['status']}"] += 1
+        add_usage_to_summary(pulsar_summary, result)
+        if result["status"] == "success":
+            pulsar_summary["exec_time"] = (
+                pulsar_summary.get("exec_time", 0) + result["exec_time"]
+            )
+
+    # Files that were already processed have their TOAs in the tim file.
+    input_files_for_toas = [
+        result["output_file"] for result in results if result["status"] == "success"
+    ]
+    session.create_output_metafile(pulsar, input_files_for_toas, append=True)
+
+    if (
+        not session.skip_toagen
+        and len(pulsar.template) > 0
+        and len(input_files_for_toas) > 0
+    ):
+        failed_files = update_toas(
+            session, pulsar, input_files_for_toas, keep_other_files=True
+        )
+        pulsar_summary["num_files_toafail"] += len(failed_files)
+        pulsar_summary["ntoas"] = (
+            pulsar_summary.get("ntoas", 0)
+            + len(input_files_for_toas)
+            - len(failed_files)
+        )
+
+    pulsar_summary["timing"] = get_timing_aggregates(session, pulsar.name)
+
+
+def watch_input_dir(
+    session: Session, watcher: DirectoryWatcher, execution_summary: dict
+):
+    """Process new input archives as they appear in the input directory until
+    interrupted (SIGINT or SIGTERM). The execution summary is updated after
+    each batch of new files."""
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    log.info(f"Waiting for new files in {session.input_dir} (--watch).")
+    try:
+        while True:
+            new_files = {}
+            for filename in watcher.get_complete_files():
+                pulsar = get_pulsar_for_file(session, filename)
+                if pulsar is not None:
+                    new_files.setdefault(pulsar.name, (pulsar, []))[1].append(filename)
+
+            for pulsar, ar_files in new_files.values():
+                process_new_files(
+                    session, pulsar, ar_files, execution_summary[pulsar.name]
+                )
+
+            if len(new_files) > 0:
+                create_exec_summary_file(session, execution_summary)
+                write_trace_file(session)
+    except KeyboardInterrupt:
+        log.info("Stopping watch mode.")
@@ -4,5 +4,9 @@ import versioneer
 setup(
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
-    scripts=["scripts/chimerawb", "scripts/chime_convert_and_tfzap.psh"],
+    scripts=[
+        "scripts/chimerawb",
+        "scripts/chimeradm",
+        "scripts/chime_convert_and_tfzap.psh",
+    ],
 )
@@ -0,0 +1,424 @@
+import csv
+import os
+import shutil
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from chimerawb import align_port
+from chimerawb.align_port import (
+    DM_TABLE_COLUMNS,
+    PORTRAIT_ARRAYS,
+    DispersionStatistic,
+    Portrait,
+    PortraitCache,
+    create_dm_table,
+    find_DM,
+    find_DM_portrait,
+    get_dm_phase_delays,
+    get_subband_edges,
+    get_subband_profiles,
+    get_trial_stds,
+    main,
+    optimize_DM,
+    read_metafile,
+)
+from chimerawb.psrfits import DM_CONSTANT, get_dispersion_phases
+from test_psrfits import make_psrfits
+
+
+def get_roll_stds(port, shifts):
+    """Standard deviation of the frequency-summed profile after rolling each channel
+    by a whole number of bins, like the original loop in find_DM."""
+    stds = []
+    for trial_shifts in shifts:
+        shifted_port = np.zeros_like(port)
+        for i in range(port.shape[0]):
+            shifted_port[i] = np.roll(port[i], trial_shifts[i])
+        stds.append(shifted_port.sum(axis=0).std())
+    return np.array(stds)
+
+
+def get_unit_shift_freqs(nchan, nbin, P, fmax=800.0):
+    """Frequencies for which a change in DM of 1 delays channel i by nchan - 1 - i
+    bins relative to the highest frequency."""
+    unit_shifts = np.arange(nchan)[::-1]
+    freqs = (fmax**-2 + unit_shifts * P / nbin / DM_CONSTANT) ** -0.5
+    freqs[-1] = fmax
+    return freqs, unit_shifts
+
+
+def test_get_dm_phase_delays():
+    freqs = np.array([400.0, 600.0, 800.0])
+    delays = get_dm_phase_delays(freqs, 0.01, np.array([0.0, 1.0, -2.0]))
+    assert delays.shape == (3, 3)
+    assert np.allclose(delays[0], 0)
+    assert np.allclose(delays[1], DM_CONSTANT * (freqs**-2 - 800.0**-2) / 0.01)
+    assert np.allclose(delays[2], -2 * delays[1])
+
+
+def test_trial_stds_integer_shifts():
+    nchan, nbin, P = 16, 64, 0.01
+    rng = np.random.default_rng(0)
+    port = rng.normal(size=(nchan, nbin))
+    freqs, unit_shifts = get_unit_shift_freqs(nchan, nbin, P)
+
+    delta_DM = np.arange(-3, 4)
+    stds = get_trial_stds(port, freqs, P, delta_DM)
+    expected = get_roll_stds(port, np.outer(delta_DM, unit_shifts))
+    assert np.allclose(stds, expected)
+
+
+def test_trial_stds_odd_nbin():
+    rng = np.random.default_rng(1)
+    port = rng.normal(size=(4, 33))
+    freqs = np.array([400.0, 500.0, 600.0, 700.0])
+    assert np.allclose(get_trial_stds(port, freqs, 0.01, [0.0]), port.sum(axis=0).std())
+
+
+def test_trial_stds_batches(monkeypatch):
+    rng = np.random.default_rng(2)
+    port = rng.normal(size=(8, 32))
+    freqs = np.linspace(400, 800, 8)
+    delta_DM = np.linspace(-1e-2, 1e-2, 11)
+    stds = get_trial_stds(port, freqs, 0.01, delta_DM)
+
+    # The trials are processed in batches that are smaller than the number of trials.
+    monkeypatch.setattr(align_port, "MAX_RAMP_BATCH_SIZE", 3 * port.size)
+    assert np.allclose(get_trial_stds(port, freqs, 0.01, delta_DM), stds)
+
+
+def make_dispersed_portrait(freqs, P, nbin, dm):
+    """A Gaussian pulse at phase 0.5 in each channel, delayed by a change in DM
+    `dm`."""
+    phases = np.arange(nbin) / nbin
+    delays = get_dm_phase_delays(freqs, P, [dm])[0]
+    # The phase offsets from the pulse, wrapped to [-0.5, 0.5).
+    offsets = (phases[None, :] - delays[:, None]) % 1 - 0.5
+    return np.exp(-0.5 * offsets**2 / 0.02**2)
+
+
+def test_dispersion_statistic():
+    rng = np.random.default_rng(3)
+    port = rng.normal(size=(8, 32))
+    freqs = np.linspace(400, 800, 8)
+    delta_DM = np.linspace(-1e-2, 1e-2, 5)
+    statistic = DispersionStatistic(port, freqs, 0.01)
+    assert np.allclose(statistic(delta_DM), get_trial_stds(port, freqs, 0.01, delta_DM))
+    assert np.allclose(statistic(0.0), port.sum(axis=0).std())
+
+
+def test_optimize_DM():
+    best_DM, trials = optimize_DM(lambda dms: -((dms - 2e-3) ** 2), tol=1e-7)
+    assert best_DM == pytest.approx(2e-3, abs=1e-6)
+    assert len(trials) > 0
+
+
+def test_optimize_DM_widen():
+    # The maximum is outside the initial coarse grid [-1e-2, 1e-2].
+    best_DM, _ = optimize_DM(lambda dms: -((dms - 0.05) ** 2), tol=1e-7)
+    assert best_DM == pytest.approx(0.05, abs=1e-6)
+
+    best_DM, _ = optimize_DM(lambda dms: -((dms + 0.05) ** 2), tol=1e-7)
+    assert best_DM == pytest.approx(-0.05, abs=1e-6)
+
+
+def test_optimize_DM_max_widen():
+    # The grid stops being widened at the edge of the search range.
+    best_DM, trials = optimize_DM(lambda dms: dms, max_widen=2)
+    assert best_DM == max(trials)
+
+
+@pytest.mark.parametrize(
+    "statistic",
+    [
+        lambda dms: np.ones_like(dms),
+        lambda dms: np.zeros_like(dms),
+        lambda dms: np.full_like(dms, np.nan),
+        lambda dms: np.where(dms > 0, np.nan, -(dms**2)),
+    ],
+)
+def test_optimize_DM_flat(statistic):
+    best_DM, trials = optimize_DM(statistic)
+    assert np.isnan(best_DM)
+    assert len(trials) == align_port.DM_COARSE_TRIALS
+
+
+def make_portrait(port, freqs, P):
+    return Portrait(port, np.ones((1, len(freqs))), freqs[None, :], np.array([P]))
+
+
+def test_find_DM_portrait_grid():
+    nbin, P = 256, 0.005
+    freqs = np.linspace(800, 400, 32)
+    dp = make_portrait(make_dispersed_portrait(freqs, P, nbin, 3e-3), freqs, P)
+
+    delta_DM = np.linspace(-1e-2, 1e-2, 41)
+    best_DM, std = find_DM_portrait(dp, delta_DM, return_std=True)
+    assert best_DM == pytest.approx(-3e-3, abs=2e-4)
+    assert len(std) == len(delta_DM)
+
+    # The maximum is at or next to the edges of the grid.
+    for grid in [delta_DM[:15], delta_DM[12:], delta_DM[14:]]:
+        best_DM = find_DM_portrait(dp, grid)
+        assert grid[0] <= best_DM <= grid[-1]
+        assert best_DM == pytest.approx(-3e-3, abs=2e-4)
+    assert find_DM_portrait(dp, delta_DM[:12]) == delta_DM[11]
+    assert find_DM_portrait(dp, delta_DM[16:]) == delta_DM[16]
+
+
+def test_find_DM_portrait_flat():
+    freqs = np.linspace(800, 400, 8)
+    dp = make_portrait(np.ones((8, 64)), freqs, 0.005)
+    assert np.isnan(find_DM_portrait(dp, np.linspace(-1e-2, 1e-2, 11)))
+    assert np.isnan(find_DM_portrait(dp))
+
+
+def test_optimize_DM_dispersed_portrait():
+    nbin, P = 256, 0.005
+    freqs = np.linspace(800, 400, 32)
+    port = make_dispersed_portrait(freqs, P, nbin, 3e-3)
+    best_DM, _ = optimize_DM(DispersionStatistic(port, freqs, P), tol=1e-6)
+    assert best_DM == pytest.approx(-3e-3, abs=1e-4)
+
+
+@pytest.mark.parametrize("nchan, subbands", [(64, 8), (67, 8), (67, 5)])
+def test_get_subband_profiles(nchan, subbands):
+    nbin = 32
+    rng = np.random.default_rng(2)
+    port = rng.normal(size=(nchan, nbin)) + 10
+    weights = rng.uniform(size=nchan)
+    weights[3] = 0
+    freqs = np.linspace(800, 400, nchan)
+
+    profiles, subband_freqs = get_subband_profiles(
+        port, weights, freqs, subbands, norm=False
+    )
+
+    edges = get_subband_edges(nchan, subbands)
+    assert edges[-1] == nchan
+    assert np.all(np.diff(edges) >= nchan // subbands)
+    for i in range(subbands):
+        d = port[edges[i] : edges[i + 1]]
+        w = weights[edges[i] : edges[i + 1]]
+        f = freqs[edges[i] : edges[i + 1]]
+        assert np.allclose(profiles[i], (d.T * w).sum(axis=1) / w.sum())
+        assert subband_freqs[i] == pytest.approx((f * w).sum() / w.sum())
+
+    norm_profiles, _ = get_subband_profiles(port, weights, freqs, subbands)
+    assert np.allclose(norm_profiles.max(axis=1), 1)
+
+
+def test_get_subband_profiles_zero_weight():
+    port = np.ones((4, 8))
+    weights = np.array([1.0, 0.0, 1.0, 1.0])
+    profiles, freqs = get_subband_profiles(port, weights, np.arange(4.0), 4)
+    assert np.all(np.isnan(profiles[1])) and np.isnan(freqs[1])
+    assert np.allclose(profiles[[0, 2, 3]], 1)
+
+
+@pytest.fixture
+def fake_load_portrait(monkeypatch):
+    """Stand-in for load_portrait, which makes a 16 x 64 portrait filled with the
+    number in the archive, and records the archives loaded."""
+    loaded = []
+
+    def load_portrait(datafile, chunk_size=None):
+        loaded.append(datafile)
+        with open(datafile) as f:
+            value = float(f.read())
+        return Portrait(
+            np.full((16, 64), value), np.ones(16), np.linspace(800, 400, 16), [0.01]
+        )
+
+    monkeypatch.setattr(align_port, "load_portrait", load_portrait)
+    return loaded
+
+
+def make_archives(tmp_path, n):
+    datafiles = []
+    for i in range(n):
+        datafile = f"{tmp_path}/{i}.ar"
+        with open(datafile, "w") as f:
+            f.write(str(i))
+        datafiles.append(datafile)
+    return datafiles
+
+
+def get_cache_size(cache_dir):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, dirs, files in os.walk(cache_dir)
+        for f in files
+    )
+
+
+def test_portrait_cache_hit(tmp_path, fake_load_portrait):
+    (datafile,) = make_archives(tmp_path, 1)
+    cache = PortraitCache(f"{tmp_path}/cache")
+
+    dp = cache.load(datafile)
+    assert fake_load_portrait == [datafile]
+
+    # The cached portrait is memory-mapped instead of being loaded again.
+    cached_dp = cache.load(datafile)
+    assert fake_load_portrait == [datafile]
+    assert isinstance(cached_dp.port, np.memmap)
+    for name in PORTRAIT_ARRAYS:
+        assert np.array_equal(getattr(cached_dp, name), getattr(dp, name))
+
+
+def test_portrait_cache_modified_archive(tmp_path, fake_load_portrait):
+    (datafile,) = make_archives(tmp_path, 1)
+    cache = PortraitCache(f"{tmp_path}/cache")
+    cache.load(datafile)
+
+    with open(datafile, "w") as f:
+        f.write("5")
+    os.utime(datafile, ns=(0, 10**9))
+    dp = cache.load(datafile)
+    assert fake_load_portrait == [datafile, datafile]
+    assert np.all(dp.port == 5)
+    assert np.all(cache.load(datafile).port == 5)
+    assert len(fake_load_portrait) == 2
+
+
+def test_portrait_cache_eviction(tmp_path, fake_load_portrait):
+    datafiles = make_archives(tmp_path, 6)
+    cache_dir = f"{tmp_path}/cache"
+
+    cache = PortraitCache(cache_dir)
+    cache.load(datafiles[0])
+    entry_size = get_cache_size(cache_dir)
+    shutil.rmtree(cache_dir)
+
+    # The cache stays within its size while it is being used, and the least
+    # recently used entries are removed as a whole.
+    cache = PortraitCache(cache_dir, max_size=int(2.5 * entry_size))
+    for datafile in datafiles:
+        cache.load(datafile)
+        # Keep the first archive the most recently used.
+        cache.load(datafiles[0])
+        assert get_cache_size(cache_dir) <= cache.max_size
+    cache.evict()
+
+    entries = os.listdir(cache_dir)
+    assert len(entries) == 2
+    for entry in entries:
+        assert sorted(os.listdir(f"{cache_dir}/{entry}")) == sorted(
+            f"{name}.npy" for name in PORTRAIT_ARRAYS
+        )
+
+    # The archive loaded last and the one reused all along are cached.
+    del fake_load_portrait[:]
+    cache.load(datafiles[0])
+    cache.load(datafiles[-1])
+    assert fake_load_portrait == []
+
+
+@pytest.fixture
+def dispersed_archives(tmp_path, monkeypatch):
+    """Archives observed at MJDs 59003, 59001 and 59002, with a stand-in for
+    load_portrait that makes a portrait dispersed by the change in DM in the
+    header of the archive. Returns the metafile listing the archives and the
+    changes in DM."""
+    nbin, P = 128, 0.005
+    freqs = np.linspace(800, 400, 16)
+
+    def load_portrait(datafile, chunk_size=None):
+        dm = fits.getheader(datafile)["TEST_DM"]
+        port = make_dispersed_portrait(freqs, P, nbin, dm)
+        return Portrait(port, np.ones((1, len(freqs))), freqs[None, :], [P])
+
+    monkeypatch.setattr(align_port, "load_portrait", load_portrait)
+
+    dms = {59003: 2e-3, 59001: -1e-3, 59002: 0.0}
+    metafile = f"{tmp_path}/J0000+0000.meta"
+    with open(metafile, "w") as f:
+        for mjd, dm in dms.items():
+            datafile = f"{tmp_path}/CHIME_J0000+0000_{mjd}.pzap"
+            primary = fits.PrimaryHDU()
+            primary.header["STT_IMJD"] = mjd
+            primary.header["STT_SMJD"] = 43200
+            primary.header["STT_OFFS"] = 0.0
+            primary.header["TEST_DM"] = dm
+            primary.writeto(datafile)
+            f.write(f"{datafile}\n")
+    return metafile, dms
+
+
+def check_dm_table(rows, dms):
+    for row in rows:
+        mjd = int(float(row["mjd"]))
+        assert float(row["mjd"]) == mjd + 0.5
+        assert f"_{mjd}.pzap" in row["archive"]
+        # The delay of the pulse is undone by the change in DM.
+        assert float(row["delta_dm"]) == pytest.approx(-dms[mjd], abs=1e-4)
+        assert int(row["ntrials"]) > 0
+
+
+def test_chimeradm_csv(tmp_path, dispersed_archives):
+    metafile, dms = dispersed_archives
+    outfile = f"{tmp_path}/dm.csv"
+    plot_dir = f"{tmp_path}/plots"
+    main(["-m", metafile, "-o", outfile, "-j", "2", "--plot_dir", plot_dir])
+
+    with open(outfile, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(int(float(row["mjd"])) for row in rows) == sorted(dms)
+    check_dm_table(rows, dms)
+
+    for mjd in dms:
+        for plot in ["dm", "shifted_profiles", "shifted_portrait"]:
+            assert os.path.isfile(f"{plot_dir}/CHIME_J0000+0000_{mjd}_{plot}.pdf")
+
+
+def test_chimeradm_npz(tmp_path, dispersed_archives):
+    metafile, dms = dispersed_archives
+    # A missing archive is reported as NaN and sorted last.
+    with open(metafile, "a") as f:
+        f.write(f"{tmp_path}/missing.pzap\n")
+    outfile = f"{tmp_path}/dm.npz"
+    rows = create_dm_table(read_metafile(metafile), outfile)
+    assert len(rows) == 4
+
+    table = np.load(outfile)
+    assert list(table["mjd"][:3]) == [59001.5, 59002.5, 59003.5]
+    assert np.isnan(table["mjd"][3]) and np.isnan(table["delta_dm"][3])
+    check_dm_table(
+        [{col: table[col][i] for col in DM_TABLE_COLUMNS} for i in range(3)], dms
+    )
+
+
+def test_find_DM_native_reader(tmp_path, monkeypatch):
+    nsub, nchan, nbin, P, dm, delta_dm = 2, 32, 256, 0.005, 10.0, 3e-3
+    freqs = np.linspace(800, 400, nchan, endpoint=False) - 200 / nchan
+
+    def make_pulses(dm):
+        delays = get_dispersion_phases(freqs, freqs.mean(), dm, P)
+        offsets = (np.arange(nbin)[None, :] / nbin - delays[:, None]) % 1 - 0.5
+        return np.exp(-0.5 * offsets**2 / 0.02**2)
+
+    # An archive dispersed at a DM larger by delta_dm than the DM in its header.
+    datafile = f"{tmp_path}/in.fits"
+    data = np.rint(1000 * make_pulses(dm + delta_dm))
+    make_psrfits(
+        datafile,
+        nsub=nsub,
+        nchan=nchan,
+        nbin=nbin,
+        data=np.broadcast_to(data, (nsub, 1, nchan, nbin)),
+        dm=dm,
+    )
+
+    # Stand-in for pplib.DataPortrait, which dedisperses the archive at its DM.
+    def DataPortrait(datafile):
+        return Portrait(make_pulses(delta_dm), np.ones((1, nchan)), freqs[None, :], [P])
+
+    monkeypatch.setattr(align_port.pplib, "DataPortrait", DataPortrait, raising=False)
+
+    pplib_DM = find_DM(datafile)
+    native_DM = find_DM(datafile, chunk_size=2**16)
+    assert pplib_DM == pytest.approx(-delta_dm, abs=1e-4)
+    assert native_DM == pytest.approx(pplib_DM, abs=1e-4)
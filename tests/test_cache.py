@@ -0,0 +1,47 @@
+import os
+
+from chimerawb.cache import evict_lru
+
+
+def make_entry(cache_dir, key, sizes, mtime):
+    """Write a cache entry with a file of each of the given sizes, last used at
+    `mtime`."""
+    entry_dir = f"{cache_dir}/{key}"
+    os.makedirs(entry_dir)
+    for idx, size in enumerate(sizes):
+        filename = f"{entry_dir}/{idx}.npy"
+        with open(filename, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(filename, (mtime, mtime))
+    return entry_dir
+
+
+def test_evict_lru(tmp_path):
+    cache_dir = str(tmp_path)
+    old = make_entry(cache_dir, "old", [100, 100], 1000)
+    mid = make_entry(cache_dir, "mid", [150], 2000)
+    new = make_entry(cache_dir, "new", [50, 50], 3000)
+
+    # Entries are removed as a whole, least recently used first.
+    assert evict_lru(cache_dir, 300) == 250
+    assert not os.path.exists(old)
+    assert os.path.isdir(mid) and os.path.isdir(new)
+
+    assert evict_lru(cache_dir, 300) == 250
+    assert evict_lru(cache_dir, 0) == 0
+    assert os.listdir(cache_dir) == []
+
+
+def test_evict_lru_incomplete_entries(tmp_path):
+    cache_dir = str(tmp_path)
+    tmp_entry = make_entry(cache_dir, "key.123.tmp", [500], 1000)
+    os.makedirs(f"{cache_dir}/empty")
+    entry = make_entry(cache_dir, "key", [100], 2000)
+
+    # Entries that may be being written by other processes are not counted or
+    # removed, except in the final cleanup.
+    assert evict_lru(cache_dir, 100) == 100
+    assert os.path.isdir(tmp_entry) and os.path.isdir(f"{cache_dir}/empty")
+
+    assert evict_lru(cache_dir, 100, cleanup=True) == 100
+    assert os.listdir(cache_dir) == [os.path.basename(entry)]
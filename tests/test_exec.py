@@ -0,0 +1,147 @@
+import json
+import os
+import signal
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from chimerawb.exec import (
+    get_timing_aggregates,
+    get_timing_filename,
+    record_timing,
+    run_cmd,
+    update_fits_header,
+)
+
+
+def test_run_cmd():
+    retcode, exec_time, usage = run_cmd("exit 3", False)
+    assert retcode == 3
+    assert exec_time > 0
+    assert usage["cpu_user"] >= 0
+    assert run_cmd("exit 3", True) == ("skip", 0, None)
+
+
+def test_run_cmd_max_rss():
+    # The maximum RSS of the command does not include the memory of the pipeline.
+    buffer = np.ones(2**28, dtype=np.uint8)
+    _, _, usage = run_cmd("true", False)
+    assert usage["max_rss"] < buffer.nbytes / 4
+    del buffer
+
+    _, _, usage = run_cmd(
+        f"{sys.executable} -c 'x = bytearray(2**28); x[::4096] = b\"a\" * 2**16'",
+        False,
+    )
+    assert usage["max_rss"] > 2**28
+
+
+def test_run_cmd_timeout(tmp_path):
+    # The whole process group is killed, including the commands run in the
+    # background.
+    start = time.time()
+    retcode, exec_time, usage = run_cmd(
+        f"(sleep 1; touch {tmp_path}/a) & sleep 100", False, timeout=0.3
+    )
+    assert retcode == "timeout"
+    assert exec_time < 10 and time.time() - start < 10
+    assert "max_rss" not in usage
+    time.sleep(1.5)
+    assert not os.path.exists(f"{tmp_path}/a")
+
+    assert run_cmd("exit 0", False, timeout=10)[0] == 0
+
+
+def test_run_cmd_memfail():
+    # Commands that abort or are killed are classified as memfail only if there is
+    # a memory limit.
+    assert run_cmd("kill -ABRT $$", False, memory_limit=2**32)[0] == "memfail"
+    assert run_cmd("kill -KILL $$", False, memory_limit=2**32)[0] == "memfail"
+    assert run_cmd("sh -c 'kill -ABRT $$'", False, memory_limit=2**32)[0] == "memfail"
+    assert run_cmd("kill -ABRT $$", False)[0] == -signal.SIGABRT
+    # A segmentation fault is not taken for running out of memory.
+    assert run_cmd("kill -SEGV $$", False, memory_limit=2**32)[0] == -signal.SIGSEGV
+
+
+def test_run_cmd_memory_limit():
+    # Like psrsh with an uncaught std::bad_alloc, the command aborts when an
+    # allocation fails.
+    cmd = (
+        f"{sys.executable} -c 'import os\n"
+        "try:\n"
+        "    x = bytearray(2**30)\n"
+        "except MemoryError:\n"
+        "    os.abort()'"
+    )
+    assert run_cmd(cmd, False, memory_limit=2**28)[0] == "memfail"
+    assert run_cmd(cmd, False)[0] == 0
+
+
+def test_update_fits_header(tmp_path, monkeypatch):
+    filename = f"{tmp_path}/a.fits"
+    subint = fits.BinTableHDU.from_columns(
+        [fits.Column("DATA", "64I", array=np.arange(64 * 10).reshape(10, 64))],
+        name="SUBINT",
+    )
+    fits.HDUList([fits.PrimaryHDU(), subint]).writeto(filename)
+    with fits.open(filename) as hdul:
+        data_start = hdul.fileinfo(0)["datLoc"]
+    with open(filename, "rb") as f:
+        body = f.read()[data_start:]
+    stat = os.stat(filename)
+
+    cmd = ["chimerawb", "-i", "input", "-o", "output", "-c", "config.json"]
+    monkeypatch.setattr(sys, "argv", cmd + ["-m", "x" * 200])
+    update_fits_header(filename, 2, 1.23456, "abcdef")
+
+    # All cards are written, and the header is rewritten in place without touching
+    # the rest of the file.
+    header = fits.getheader(filename)
+    assert header["PL_CMD"] == " ".join(sys.argv)
+    assert header["PL_LVL"] == 2
+    assert header["PL_TIME"] == 1.235
+    assert header["PL_CFG"] == "abcdef"
+    for key in ["PL_DATE", "PL_VER", "PL_PSRCH"]:
+        assert key in header
+
+    with open(filename, "rb") as f:
+        assert f.read()[data_start:] == body
+    assert os.stat(filename).st_ino == stat.st_ino
+    assert os.stat(filename).st_size == stat.st_size
+
+
+def test_timing_aggregates(tmp_path):
+    session = SimpleNamespace(output_dir=str(tmp_path), start_time=1000.0)
+    assert get_timing_aggregates(session, "J0000+0000") == {}
+
+    # Records of an earlier run and of other pulsars are not included.
+    old_session = SimpleNamespace(output_dir=str(tmp_path), start_time=500.0)
+    record_timing(old_session, "J0000+0000", "a", "level01", 100.0)
+    record_timing(session, "J1111+1111", "a", "level01", 100.0)
+
+    times = [float(t) for t in range(1, 21)]
+    for idx, exec_time in enumerate(times):
+        record_timing(session, "J0000+0000", f"file{idx}", "level01", exec_time)
+    record_timing(session, "J0000+0000", "file0", "level12", 2.5, nfiles=4)
+
+    aggregates = get_timing_aggregates(session, "J0000+0000")
+    assert sorted(aggregates) == ["level01", "level12"]
+    assert aggregates["level01"] == {
+        "count": 20,
+        "total": 210.0,
+        "mean": 10.5,
+        "p50": 10.5,
+        "p95": pytest.approx(19.05),
+        "max": 20.0,
+    }
+    assert aggregates["level12"]["count"] == 1
+    assert aggregates["level12"]["p95"] == 2.5
+
+    with open(get_timing_filename(session)) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 23
+    assert records[-1]["file"] == "file0" and records[-1]["nfiles"] == 4
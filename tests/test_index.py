@@ -0,0 +1,51 @@
+import numpy as np
+from astropy.io import fits
+
+from chimerawb.index import get_chime_mjd, read_fits_header, read_headers
+
+
+def make_psrfits_header(filename, nsub=4, nchan=16, nbin=64, npol=1):
+    """Write a PSRFITS file with an empty SUBINT table of the given dimensions."""
+    primary = fits.PrimaryHDU()
+    primary.header["STT_IMJD"] = 59000
+    primary.header["STT_SMJD"] = 43200
+    primary.header["STT_OFFS"] = 0.5
+    subint = fits.BinTableHDU.from_columns(
+        [fits.Column("TSUBINT", "1D", array=np.full(nsub, 10.0))], name="SUBINT"
+    )
+    subint.header["NCHAN"] = nchan
+    subint.header["NBIN"] = nbin
+    subint.header["NPOL"] = npol
+    fits.HDUList([primary, subint]).writeto(filename)
+
+
+def test_get_chime_mjd():
+    assert get_chime_mjd("/data/CHIME_J2302+4442_beam_1_59611_43200.ar") == 59611.5
+    assert get_chime_mjd("CHIME_J2302+4442_beam_2_59611_0.ar") == 59611
+    assert get_chime_mjd("J2302+4442.ar") is None
+
+
+def test_read_fits_header(tmp_path):
+    filename = f"{tmp_path}/a.fits"
+    make_psrfits_header(filename, nsub=4, nchan=16, nbin=64, npol=1)
+    assert read_fits_header(filename) == {
+        "mjd": 59000 + (43200 + 0.5) / 86400,
+        "nsub": 4,
+        "nchan": 16,
+        "nbin": 64,
+        "npol": 1,
+    }
+
+
+def test_read_headers(tmp_path):
+    filename, empty = f"{tmp_path}/a.fits", f"{tmp_path}/empty.ar"
+    make_psrfits_header(filename)
+    open(empty, "w").close()
+
+    headers = read_headers([filename, empty, f"{tmp_path}/missing.ar"])
+    assert sorted(headers) == [filename, empty]
+    assert headers[filename]["status"] == "ok"
+    assert headers[filename]["nsub"] == 4
+    # The length of PSRFITS files is not read.
+    assert headers[filename]["length"] is None
+    assert headers[empty]["status"] == "empty"
@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+from chimerawb.manifest import HEADER_COLUMNS, Manifest, get_file_signature
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return Manifest(f"{tmp_path}/manifest.sqlite3")
+
+
+def write_file(filename, contents, mtime=None):
+    with open(filename, "w") as f:
+        f.write(contents)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+
+def test_get_file_signature(tmp_path):
+    filename = f"{tmp_path}/a.ar"
+    write_file(filename, "abc", mtime=1000)
+    assert get_file_signature(filename) == (3, 1000 * 10**9)
+    assert get_file_signature(f"{tmp_path}/missing.ar") == (None, None)
+    assert get_file_signature(None) == (None, None)
+
+
+def test_update_input(tmp_path, manifest):
+    input_file = f"{tmp_path}/a.ar"
+    write_file(input_file, "abc", mtime=1000)
+
+    assert not manifest.is_input_unchanged(input_file)
+    input_hash = manifest.update_input(input_file)
+    assert manifest.is_input_unchanged(input_file)
+    assert manifest.get_input_hash(input_file) == input_hash
+
+    # Touching the file without changing its contents does not change the hash.
+    write_file(input_file, "abc", mtime=2000)
+    assert not manifest.is_input_unchanged(input_file)
+    assert manifest.update_input(input_file) == input_hash
+
+    write_file(input_file, "abd", mtime=3000)
+    assert manifest.update_input(input_file) != input_hash
+
+
+def test_stage_current(tmp_path, manifest):
+    input_file, output_file = f"{tmp_path}/a.ar", f"{tmp_path}/a.zap"
+    write_file(input_file, "abc")
+    manifest.update_input(input_file)
+
+    assert not manifest.is_stage_current(input_file, "level01", "p1", output_file)
+
+    write_file(output_file, "zapped", mtime=1000)
+    manifest.record_stage(input_file, "level01", "p1", output_file, 0, 1.5)
+    assert manifest.is_stage_current(input_file, "level01", "p1", output_file)
+
+    # Different parameters, output file or stage.
+    assert not manifest.is_stage_current(input_file, "level01", "p2", output_file)
+    assert not manifest.is_stage_current(
+        input_file, "level01", "p1", f"{tmp_path}/b.zap"
+    )
+    assert not manifest.is_stage_current(input_file, "level12", "p1", output_file)
+
+    # The output file was modified or removed after the stage was recorded.
+    write_file(output_file, "zapped", mtime=2000)
+    assert not manifest.is_stage_current(input_file, "level01", "p1", output_file)
+    os.unlink(output_file)
+    assert not manifest.is_stage_current(input_file, "level01", "p1", output_file)
+
+
+def test_stage_failed(tmp_path, manifest):
+    input_file, output_file = f"{tmp_path}/a.ar", f"{tmp_path}/a.zap"
+    write_file(input_file, "abc")
+    write_file(output_file, "zapped")
+    manifest.update_input(input_file)
+    manifest.record_stage(input_file, "level01", "p1", output_file, 0, 1.5)
+
+    # A failed stage is recorded without an output file, and its output (e.g. from
+    # an earlier run) is not current.
+    manifest.record_stage(input_file, "level01", "p1", None, "timeout", 10.0)
+    assert not manifest.is_stage_current(input_file, "level01", "p1", output_file)
+
+
+def test_stage_invalidated_by_input_change(tmp_path, manifest):
+    input_file, output_file = f"{tmp_path}/a.ar", f"{tmp_path}/a.zap"
+    write_file(input_file, "abc", mtime=1000)
+    write_file(output_file, "zapped")
+    manifest.update_input(input_file)
+    manifest.record_stage(input_file, "level01", "p1", output_file, 0, 1.5)
+
+    # Same contents: the stages are kept.
+    write_file(input_file, "abc", mtime=2000)
+    manifest.update_input(input_file)
+    assert manifest.is_stage_current(input_file, "level01", "p1", output_file)
+
+    # Different contents: all stages of the file are invalidated.
+    write_file(input_file, "abd", mtime=3000)
+    manifest.update_input(input_file)
+    assert not manifest.is_stage_current(input_file, "level01", "p1", output_file)
+
+
+def test_manifest_persistent(tmp_path, manifest):
+    input_file, output_file = f"{tmp_path}/a.ar", f"{tmp_path}/a.zap"
+    write_file(input_file, "abc")
+    write_file(output_file, "zapped")
+    manifest.update_input(input_file)
+    manifest.record_stage(input_file, "level01", "p1", output_file, 0, 1.5)
+
+    reopened = Manifest(manifest.filename)
+    assert reopened.is_input_unchanged(input_file)
+    assert reopened.is_stage_current(input_file, "level01", "p1", output_file)
+
+
+def test_toas(tmp_path, manifest):
+    archive = f"{tmp_path}/a.pzap"
+    write_file(archive, "scrunched", mtime=1000)
+
+    assert manifest.get_toa_count(archive) is None
+    assert not manifest.is_toa_current(archive, "t1")
+
+    manifest.record_toas("J0000+0000", archive, "t1", 1)
+    assert manifest.get_toa_count(archive) == 1
+    assert manifest.is_toa_current(archive, "t1")
+    assert not manifest.is_toa_current(archive, "t2")
+
+    write_file(archive, "scrunched again", mtime=2000)
+    assert not manifest.is_toa_current(archive, "t1")
+
+
+def test_headers(tmp_path, manifest):
+    archive = f"{tmp_path}/a.ar"
+    write_file(archive, "abc", mtime=1000)
+    size, mtime = get_file_signature(archive)
+    header = dict(
+        zip(HEADER_COLUMNS, [size, mtime, "ok", 59000.5, 10, 1024, 256, 4, 600.0])
+    )
+
+    assert manifest.get_header(archive) is None
+    manifest.record_headers({archive: header})
+    assert manifest.get_header(archive) == header
+
+    # The header is scanned again once the archive is modified.
+    write_file(archive, "abcd", mtime=2000)
+    assert manifest.get_header(archive) is None
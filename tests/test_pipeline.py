@@ -0,0 +1,390 @@
+import os
+import shutil
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from chimerawb import pipeline
+from chimerawb.fileutils import (
+    get_ftscr_filename,
+    get_fused_script_filename,
+    get_pzap_filename,
+    get_zap_filename,
+)
+from chimerawb.manifest import Manifest
+from chimerawb.scheduler import estimate_memory
+from chimerawb.pipeline import (
+    create_fused_script,
+    get_stage_timeout,
+    get_skip_status,
+    process_file,
+    process_files,
+    process_files_batched,
+    run_native_pzap,
+)
+from chimerawb.session import PulsarConfig
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scripts")
+
+# Stand-in for the psrchive commands, which copies each input file to the output
+# dir with the extension given by -e. If FAKE_FAIL is "<command>:<pattern>", the
+# command skips the files whose names contain the pattern and exits with 1.
+FAKE_COMMAND = f"""#!{sys.executable}
+import os, shutil, sys
+name, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+fail_cmd, _, fail_pattern = os.environ.get("FAKE_FAIL", "").partition(":")
+ext = args[args.index("-e") + 1]
+output_dir = args[args.index("-O" if "-O" in args else "-u") + 1]
+failed = False
+for filename in args:
+    if os.path.isfile(filename):
+        if name == fail_cmd and fail_pattern in filename:
+            failed = True
+            continue
+        prefix = os.path.splitext(os.path.basename(filename))[0]
+        shutil.copy(filename, f"{{output_dir}}/{{prefix}}.{{ext}}")
+sys.exit(1 if failed else 0)
+"""
+
+
+@pytest.fixture
+def fake_commands(tmp_path, monkeypatch):
+    bin_dir = f"{tmp_path}/bin"
+    os.makedirs(bin_dir)
+    for name in ["chime_convert_and_tfzap.psh", "pam", "paz"]:
+        with open(f"{bin_dir}/{name}", "w") as f:
+            f.write(FAKE_COMMAND)
+        os.chmod(f"{bin_dir}/{name}", 0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.delenv("FAKE_FAIL", raising=False)
+
+
+def make_session(tmp_path, **kwargs):
+    """A stand-in for Session with the attributes used by the pipeline."""
+    output_dir = f"{tmp_path}/output"
+    os.makedirs(output_dir, exist_ok=True)
+    config_file = f"{tmp_path}/config.json"
+    with open(config_file, "w") as f:
+        f.write("{}")
+
+    options = {
+        "output_dir": output_dir,
+        "config_file": config_file,
+        "manifest": Manifest(f"{output_dir}/manifest.sqlite3"),
+        "start_time": time.time(),
+        "input_metafile": None,
+        "min_mjd": None,
+        "max_mjd": None,
+        "reprocess": False,
+        "skip_pzap": False,
+        "fused": False,
+        "batch": False,
+        "jobs": 1,
+        "clean_files": False,
+        "zap_cache_size": None,
+        "test_mode": False,
+        "timeout": None,
+        "timeout_per_gb": None,
+        "memory_limit": None,
+        "max_memory": None,
+        "trace_file": None,
+    }
+    options.update(kwargs)
+    return SimpleNamespace(**options)
+
+
+def make_input_files(tmp_path, names):
+    input_dir = f"{tmp_path}/input"
+    os.makedirs(input_dir, exist_ok=True)
+    filenames = []
+    for name in names:
+        filename = f"{input_dir}/CHIME_J0000+0000_beam_1_59000_{name}.ar"
+        with open(filename, "w") as f:
+            f.write(name)
+        filenames.append(filename)
+    return filenames
+
+
+@pytest.mark.parametrize("nsub", [1, 4])
+def test_create_fused_script(tmp_path, monkeypatch, nsub):
+    monkeypatch.setenv("PATH", f"{SCRIPTS_DIR}:{os.environ['PATH']}")
+    session = make_session(tmp_path)
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, nsub, [1, 2])
+    create_fused_script(session, pulsar)
+
+    with open(get_fused_script_filename(session, pulsar)) as f:
+        lines = [line.strip() for line in f]
+
+    assert "edit dm=10.0" in lines
+    # The scrunch factors are never 0 (scrunch everything).
+    assert "fscrunch {max(1,floor($nchan/64))}" in lines
+    if nsub == 1:
+        assert "tscrunch" in lines
+    else:
+        assert "tscrunch {max(1,floor($nsubint/4))}" in lines
+    assert "zap chan 1 2" in lines
+
+
+def test_create_fused_script_skip_pzap(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", f"{SCRIPTS_DIR}:{os.environ['PATH']}")
+    session = make_session(tmp_path, skip_pzap=True)
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 4, [1, 2])
+    create_fused_script(session, pulsar)
+
+    with open(get_fused_script_filename(session, pulsar)) as f:
+        assert "zap chan 1 2" not in [line.strip() for line in f]
+
+
+def test_failed_stage_removes_old_output(tmp_path, fake_commands, monkeypatch):
+    session = make_session(tmp_path)
+    (ar_file,) = make_input_files(tmp_path, ["100"])
+    ftscr_file = get_ftscr_filename(session, "CHIME_J0000+0000_beam_1_59000_100")
+
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [])
+    assert process_file(session, pulsar, ar_file)["status"] == "success"
+    assert os.path.isfile(ftscr_file)
+    assert get_skip_status(session, pulsar, ar_file) == "skip_exist"
+
+    # The output created with the old parameters is not taken for the output of
+    # the failed command.
+    pulsar = PulsarConfig("J0000+0000", 10.0, 32, 1, [])
+    monkeypatch.setenv("FAKE_FAIL", "pam:")
+    assert process_file(session, pulsar, ar_file)["status"] == "processfail"
+    assert not os.path.isfile(ftscr_file)
+    assert get_skip_status(session, pulsar, ar_file) is None
+
+    monkeypatch.delenv("FAKE_FAIL")
+    assert process_file(session, pulsar, ar_file)["status"] == "success"
+    assert get_skip_status(session, pulsar, ar_file) == "skip_exist"
+
+
+def test_failed_stage_with_output(tmp_path, fake_commands, monkeypatch):
+    session = make_session(tmp_path)
+    (ar_file,) = make_input_files(tmp_path, ["100"])
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [])
+
+    # The command writes its output but fails.
+    with open(f"{tmp_path}/bin/pam", "w") as f:
+        f.write(FAKE_COMMAND.replace("sys.exit(1 if failed else 0)", "sys.exit(2)"))
+    assert process_file(session, pulsar, ar_file)["status"] == "processfail"
+    assert not os.path.isfile(
+        get_ftscr_filename(session, "CHIME_J0000+0000_beam_1_59000_100")
+    )
+    assert get_skip_status(session, pulsar, ar_file) is None
+
+
+def test_failed_batch(tmp_path, fake_commands, monkeypatch):
+    session = make_session(tmp_path, batch=True)
+    ar_files = make_input_files(tmp_path, ["100", "200", "300"])
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [])
+
+    # The files of the failed batch are processed again one at a time, and only
+    # the file that makes pam fail is skipped.
+    monkeypatch.setenv("FAKE_FAIL", "pam:_200")
+    results = process_files_batched(session, pulsar, ar_files, None)
+    assert [result["status"] for result in results] == [
+        "success",
+        "processfail",
+        "success",
+    ]
+    assert [get_skip_status(session, pulsar, ar_file) for ar_file in ar_files] == [
+        "skip_exist",
+        None,
+        "skip_exist",
+    ]
+
+
+def test_batch_memory_budget(tmp_path, fake_commands, monkeypatch):
+    session = make_session(tmp_path, batch=True, jobs=2, max_memory=10 * 1024**3)
+    ar_files = make_input_files(tmp_path, ["100", "200", "300", "400"])
+    dims = {ar_files[1]: (64, 1024, 1024, 4)}
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [1])
+
+    calls = []
+
+    def fake_run_jobs(func, args_list, jobs=1, costs=None, budget=None):
+        calls.append((func, args_list, costs, budget))
+        return [func(*args) for args in args_list]
+
+    monkeypatch.setattr(pipeline, "run_jobs", fake_run_jobs)
+    results = process_files_batched(session, pulsar, ar_files, None, dims)
+    assert all(result["status"] == "success" for result in results)
+
+    # Each batch costs as much as its largest input file.
+    (_, level12_args, level12_costs, budget), (_, level23_args, level23_costs, _) = [
+        call for call in calls if call[0] == pipeline.run_batch
+    ]
+    assert budget == session.max_memory
+    zap_file = get_zap_filename(session, "CHIME_J0000+0000_beam_1_59000_100")
+    assert level12_costs == [
+        estimate_memory(ar_files[1], dims[ar_files[1]]),
+        estimate_memory(zap_file),
+    ]
+    assert len(level23_costs) == len(level23_args) == 2
+    assert level23_costs[0] == estimate_memory(zap_file)
+
+
+def test_touched_input_is_skipped(tmp_path, fake_commands):
+    session = make_session(tmp_path)
+    (ar_file,) = make_input_files(tmp_path, ["100"])
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [])
+    assert process_file(session, pulsar, ar_file)["status"] == "success"
+
+    # The hash of a file that was touched is checked before processing it.
+    os.utime(ar_file, (1000, 1000))
+    assert get_skip_status(session, pulsar, ar_file) is None
+    assert process_file(session, pulsar, ar_file)["status"] == "skip_exist"
+    assert get_skip_status(session, pulsar, ar_file) == "skip_exist"
+
+
+def fake_zap_channels(infile, outfile, zap_chans):
+    """Stand-in for zap_channels, which updates the output file and then fails if
+    there are channels to zap."""
+    if outfile != infile:
+        shutil.copy(infile, outfile)
+    with open(outfile, "a") as f:
+        f.write(" zapped")
+    if len(zap_chans) > 0:
+        raise OSError("No space left on device.")
+
+
+@pytest.mark.parametrize("clean_files", [False, True])
+def test_run_native_pzap(tmp_path, monkeypatch, clean_files):
+    monkeypatch.setattr(pipeline, "zap_channels", fake_zap_channels)
+    session = make_session(tmp_path, clean_files=clean_files)
+    prefix = "CHIME_J0000+0000_beam_1_59000_100"
+    ftscr_file = get_ftscr_filename(session, prefix)
+    pzap_file = get_pzap_filename(session, prefix)
+    with open(ftscr_file, "w") as f:
+        f.write("100")
+
+    # The Level 2 file is not modified and no Level 3 file is left behind.
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [1, 2])
+    retcode, _, _ = run_native_pzap(session, pulsar, ftscr_file, pzap_file)
+    assert retcode == 1
+    with open(ftscr_file) as f:
+        assert f.read() == "100"
+    assert not os.path.isfile(pzap_file)
+
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [])
+    retcode, _, _ = run_native_pzap(session, pulsar, ftscr_file, pzap_file)
+    assert retcode == 0
+    with open(ftscr_file) as f:
+        assert f.read() == "100"
+    with open(pzap_file) as f:
+        assert f.read() == "100 zapped"
+
+
+def test_native_pzap_failure_clean(tmp_path, fake_commands, monkeypatch):
+    monkeypatch.setattr(pipeline, "zap_channels", fake_zap_channels)
+    session = make_session(tmp_path, clean_files=True)
+    (ar_file,) = make_input_files(tmp_path, ["100"])
+    ftscr_file = get_ftscr_filename(session, "CHIME_J0000+0000_beam_1_59000_100")
+
+    # The Level 2 file recorded in the manifest is kept intact when zapping fails,
+    # and is removed once zapping succeeds.
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [1], pzap_engine="native")
+    assert process_file(session, pulsar, ar_file)["status"] == "processfail"
+    with open(ftscr_file) as f:
+        assert f.read() == "100"
+
+    monkeypatch.setattr(
+        pipeline,
+        "zap_channels",
+        lambda infile, outfile, zap_chans: shutil.copy(infile, outfile),
+    )
+    assert process_file(session, pulsar, ar_file)["status"] == "success"
+    assert not os.path.isfile(ftscr_file)
+    assert get_skip_status(session, pulsar, ar_file) == "skip_exist"
+
+
+def test_process_files_metafile(tmp_path, fake_commands, monkeypatch):
+    ar_files = make_input_files(tmp_path, ["100", "200"])
+    session = make_session(
+        tmp_path,
+        input_metafile=f"{tmp_path}/input.txt",
+        input_file_names=ar_files[:1],
+        memfail_retry_limit=None,
+    )
+    scanned = []
+    monkeypatch.setattr(
+        pipeline,
+        "scan_headers",
+        lambda session, filenames: scanned.extend(filenames) or {},
+    )
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [])
+
+    # The headers of the files that are not in the metafile are not scanned.
+    results = process_files(session, pulsar, ar_files)
+    assert [result["status"] for result in results] == ["success", "skip_meta"]
+    assert scanned == ar_files[:1]
+
+
+def test_get_stage_timeout(tmp_path):
+    filenames = make_input_files(tmp_path, ["100", "200"])
+    for filename in filenames:
+        with open(filename, "wb") as f:
+            f.truncate(250 * 10**6)
+
+    assert get_stage_timeout(make_session(tmp_path), filenames) is None
+    session = make_session(tmp_path, timeout=60.0)
+    assert get_stage_timeout(session, filenames) == 120.0
+    session = make_session(tmp_path, timeout=60.0, timeout_per_gb=100.0)
+    assert get_stage_timeout(session, filenames) == pytest.approx(170.0)
+    assert get_stage_timeout(session, filenames[:1]) == pytest.approx(85.0)
+
+
+def get_dir_size(dirname):
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, dirs, files in os.walk(dirname)
+        for f in files
+    )
+
+
+def test_zap_cache(tmp_path, fake_commands, monkeypatch):
+    names = ["100", "200", "300", "400", "500"]
+    ar_files = make_input_files(tmp_path, names)
+    for ar_file, name in zip(ar_files, names):
+        with open(ar_file, "w") as f:
+            f.write(name * 250)
+    monkeypatch.setattr(pipeline, "scan_headers", lambda session, filenames: {})
+    session = make_session(
+        tmp_path, clean_files=True, zap_cache_size=1600, memfail_retry_limit=None
+    )
+    cache_dir = f"{session.output_dir}/zap_cache"
+
+    cache_sizes = []
+    cache_zap_file = pipeline.cache_zap_file
+
+    def fake_cache_zap_file(session, pulsar, result):
+        cache_zap_file(session, pulsar, result)
+        cache_sizes.append(get_dir_size(cache_dir))
+
+    monkeypatch.setattr(pipeline, "cache_zap_file", fake_cache_zap_file)
+
+    # The cache stays within its budget during the run.
+    pulsar = PulsarConfig("J0000+0000", 10.0, 64, 1, [])
+    results = process_files(session, pulsar, ar_files)
+    assert all(result["status"] == "success" for result in results)
+    assert len(cache_sizes) == len(names)
+    assert max(cache_sizes) <= 1600
+    assert len(os.listdir(cache_dir)) == 2
+
+    # The cached (most recently used) zap files are reused when only the number of
+    # channels changes, and the others are made again (which fails here).
+    monkeypatch.setenv("FAKE_FAIL", "chime_convert_and_tfzap.psh:")
+    pulsar = PulsarConfig("J0000+0000", 10.0, 32, 1, [])
+    results = process_files(session, pulsar, ar_files)
+    assert [result["status"] for result in results] == [
+        "processfail",
+        "processfail",
+        "processfail",
+        "success",
+        "success",
+    ]
+    assert max(cache_sizes) <= 1600
+    assert len(os.listdir(cache_dir)) == 2
+    assert not any(f.endswith(".zap") for f in os.listdir(session.output_dir))
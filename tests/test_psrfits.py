@@ -0,0 +1,284 @@
+import os
+import tracemalloc
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from chimerawb.psrfits import (
+    DM_CONSTANT,
+    get_dispersion_phases,
+    quantize_profiles,
+    read_portrait,
+    remove_baseline,
+    rotate_profiles,
+    scrunch,
+    zap_channels,
+)
+
+
+def make_psrfits(filename, nsub=4, nchan=16, nbin=64, npol=1, data=None, dm=10.0):
+    """Write a fold-mode PSRFITS file with a synthetic SUBINT table."""
+    rng = np.random.default_rng(0)
+    freqs = np.linspace(800, 400, nchan, endpoint=False) - 200 / nchan
+    if data is None:
+        data = rng.integers(-1000, 1000, (nsub, npol, nchan, nbin))
+
+    primary = fits.PrimaryHDU()
+    primary.header["OBS_MODE"] = "PSR"
+    primary.header["STT_IMJD"] = 59000
+    primary.header["STT_SMJD"] = 100
+    primary.header["STT_OFFS"] = 0.25
+
+    columns = [
+        fits.Column("INDEXVAL", "1D", array=np.arange(nsub)),
+        fits.Column("TSUBINT", "1D", array=np.full(nsub, 10.0)),
+        fits.Column("OFFS_SUB", "1D", array=5 + 10.0 * np.arange(nsub)),
+        fits.Column("PERIOD", "1D", array=np.full(nsub, 0.005)),
+        fits.Column("DAT_FREQ", f"{nchan}D", array=np.tile(freqs, (nsub, 1))),
+        fits.Column("DAT_WTS", f"{nchan}E", array=rng.uniform(size=(nsub, nchan))),
+        fits.Column(
+            "DAT_OFFS", f"{nchan * npol}E", array=rng.normal(size=(nsub, nchan * npol))
+        ),
+        fits.Column(
+            "DAT_SCL",
+            f"{nchan * npol}E",
+            array=rng.uniform(1, 2, size=(nsub, nchan * npol)),
+        ),
+        fits.Column(
+            "DATA",
+            f"{nbin * nchan * npol}I",
+            dim=f"({nbin},{nchan},{npol})",
+            array=np.asarray(data, dtype=np.int16),
+        ),
+    ]
+    subint = fits.BinTableHDU.from_columns(columns, name="SUBINT")
+    subint.header["NCHAN"] = nchan
+    subint.header["NPOL"] = npol
+    subint.header["NBIN"] = nbin
+    subint.header["CHAN_BW"] = -400.0 / nchan
+    subint.header["DM"] = dm
+    subint.header["POL_TYPE"] = "AA+BB"
+    fits.HDUList([primary, subint]).writeto(filename, overwrite=True)
+
+
+def read_profiles(filename):
+    """The profiles (nsub, npol, nchan, nbin), weights and frequencies of a
+    PSRFITS file."""
+    with fits.open(filename) as hdul:
+        subint = hdul["SUBINT"]
+        nchan, npol, nbin = [subint.header[key] for key in ["NCHAN", "NPOL", "NBIN"]]
+        nsub = len(subint.data)
+        scales = subint.data["DAT_SCL"].reshape(nsub, npol, nchan, 1)
+        offsets = subint.data["DAT_OFFS"].reshape(nsub, npol, nchan, 1)
+        profiles = subint.data["DATA"].reshape(nsub, npol, nchan, nbin)
+        return (
+            profiles * scales + offsets,
+            subint.data["DAT_WTS"].reshape(nsub, nchan).astype(float),
+            subint.data["DAT_FREQ"].reshape(nsub, nchan).astype(float),
+        )
+
+
+def test_rotate_profiles():
+    rng = np.random.default_rng(1)
+    profiles = rng.normal(size=(3, 32))
+    rotated = rotate_profiles(profiles, np.array([0.0, 1 / 32, -5 / 32]))
+    assert np.allclose(rotated[0], profiles[0])
+    assert np.allclose(rotated[1], np.roll(profiles[1], -1))
+    assert np.allclose(rotated[2], np.roll(profiles[2], 5))
+
+
+def test_quantize_profiles():
+    rng = np.random.default_rng(2)
+    profiles = rng.normal(size=(2, 4, 32)) * 100
+    profiles[1, 2] = 3.0
+    data, scales, offsets = quantize_profiles(profiles)
+    assert data.dtype == np.int16
+    assert np.allclose(
+        data * scales[..., None] + offsets[..., None],
+        profiles,
+        atol=scales.max(),
+    )
+
+
+def test_scrunch_no_dm(tmp_path):
+    infile, outfile = f"{tmp_path}/in.fits", f"{tmp_path}/out.fits"
+    make_psrfits(infile, nsub=5, nchan=16, npol=2)
+    scrunch(infile, outfile, 4, 2, 0.0)
+
+    profiles, weights, freqs = read_profiles(infile)
+    out_profiles, out_weights, out_freqs = read_profiles(outfile)
+
+    # Like pam, 5 subintegrations are scrunched by 2 into 3.
+    assert out_profiles.shape == (3, 2, 4, 64)
+    with fits.open(outfile) as hdul:
+        subint = hdul["SUBINT"]
+        assert subint.header["NCHAN"] == 4
+        assert subint.header["CHAN_BW"] == pytest.approx(-100.0)
+        assert subint.header["DM"] == 0
+        assert np.allclose(subint.data["TSUBINT"], [20, 20, 10])
+        assert np.allclose(subint.data["OFFS_SUB"], [10, 30, 45])
+
+    for isub, (start, stop) in enumerate([(0, 2), (2, 4), (4, 5)]):
+        w = weights[start:stop].reshape(stop - start, 4, 4)
+        p = profiles[start:stop].reshape(stop - start, 2, 4, 4, 64)
+        expected = (p * w[:, None, :, :, None]).sum(axis=(0, 3)) / w.sum(axis=(0, 2))[
+            :, None
+        ]
+        scale = np.abs(expected).max() / 32767
+        assert np.allclose(out_profiles[isub], expected, atol=2 * scale)
+        assert np.allclose(out_weights[isub], w.sum(axis=(0, 2)))
+        assert np.allclose(out_freqs[isub], freqs[start].reshape(4, 4).mean(axis=1))
+
+
+def test_scrunch_dedisperse(tmp_path):
+    infile, outfile = f"{tmp_path}/in.fits", f"{tmp_path}/out.fits"
+    nsub, nchan, nbin, dm = 2, 32, 128, 30.0
+
+    # A pulse dispersed with `dm` relative to the centre of the band.
+    freqs = np.linspace(800, 400, nchan, endpoint=False) - 200 / nchan
+    phases = get_dispersion_phases(freqs, freqs.mean(), dm, 0.005)
+    x = np.arange(nbin) / nbin
+    pulse = np.exp(
+        -0.5 * (((x[None, :] - 0.5 - phases[:, None]) + 0.5) % 1 - 0.5) ** 2 / 0.01**2
+    )
+    data = np.rint(1000 * np.broadcast_to(pulse, (nsub, 1, nchan, nbin)))
+    make_psrfits(infile, nsub=nsub, nchan=nchan, nbin=nbin, data=data)
+
+    scrunch(infile, outfile, 1, 1, dm)
+    out_profiles, _, _ = read_profiles(outfile)
+    peak = out_profiles[0, 0, 0]
+    assert np.argmax(peak) == nbin // 2
+
+    scrunch(infile, outfile, 1, 1, 0.0)
+    smeared_peak = read_profiles(outfile)[0][0, 0, 0]
+    assert smeared_peak.max() - smeared_peak.min() < 0.5 * (peak.max() - peak.min())
+
+
+def test_scrunch_chunk_size(tmp_path):
+    infile = f"{tmp_path}/in.fits"
+    make_psrfits(infile, nsub=7, nchan=16, npol=2)
+    scrunch(infile, f"{tmp_path}/a.fits", 2, 1, 15.0)
+    scrunch(infile, f"{tmp_path}/b.fits", 2, 1, 15.0, chunk_size=1)
+    a, b = read_profiles(f"{tmp_path}/a.fits"), read_profiles(f"{tmp_path}/b.fits")
+    for x, y in zip(a, b):
+        assert np.allclose(x, y, rtol=1e-4, atol=1e-2)
+
+
+def test_scrunch_memory(tmp_path):
+    infile, outfile = f"{tmp_path}/in.fits", f"{tmp_path}/out.fits"
+    nsub, nchan, nbin = 256, 32, 256
+    make_psrfits(
+        infile,
+        nsub=nsub,
+        nchan=nchan,
+        nbin=nbin,
+        data=np.zeros((nsub, 1, nchan, nbin), dtype=np.int16),
+    )
+
+    # Only a single copy of the output data is kept in memory, and the input is
+    # not loaded into memory.
+    tracemalloc.start()
+    try:
+        scrunch(infile, outfile, nchan, nsub, 10.0, chunk_size=2**16)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    output_size = nsub * nchan * nbin * 2
+    assert peak < 1.5 * output_size
+    assert read_profiles(outfile)[0].shape == (nsub, 1, nchan, nbin)
+
+
+def test_scrunch_invalid_nchan(tmp_path):
+    infile = f"{tmp_path}/in.fits"
+    make_psrfits(infile, nchan=16)
+    with pytest.raises(ValueError):
+        scrunch(infile, f"{tmp_path}/out.fits", 3, 1, 0.0)
+
+
+def test_scrunch_write_error(tmp_path, monkeypatch):
+    infile, outfile = f"{tmp_path}/in.fits", f"{tmp_path}/out.fits"
+    make_psrfits(infile)
+
+    def writeto(self, filename, overwrite=False):
+        with open(filename, "w") as f:
+            f.write("partial")
+        raise OSError("No space left on device.")
+
+    monkeypatch.setattr(fits.HDUList, "writeto", writeto)
+    with pytest.raises(OSError):
+        scrunch(infile, outfile, 4, 1, 0.0)
+    assert sorted(os.listdir(tmp_path)) == ["in.fits"]
+
+
+def test_read_portrait(tmp_path):
+    infile = f"{tmp_path}/in.fits"
+    make_psrfits(infile, nsub=5, nchan=8, dm=0.0)
+    profiles, weights, freqs = read_profiles(infile)
+
+    for chunk_size in [1, 10**9]:
+        port, port_weights, port_freqs, Ps = read_portrait(infile, chunk_size)
+        expected = (profiles[:, 0] * weights[:, :, None]).sum(axis=0) / weights.sum(
+            axis=0
+        )[:, None]
+        assert np.allclose(port, remove_baseline(expected), rtol=1e-4, atol=1e-3)
+        assert np.allclose(port_weights, weights.sum(axis=0)[None, :])
+        assert np.allclose(port_freqs, freqs[:1])
+        assert np.allclose(Ps, [0.005])
+
+
+def test_read_portrait_dedisperse(tmp_path):
+    nsub, nchan, nbin, P, dm = 3, 16, 128, 0.005, 10.0
+    freqs = np.linspace(800, 400, nchan, endpoint=False) - 200 / nchan
+    delays = get_dispersion_phases(freqs, freqs.mean(), dm, P)
+    # A pulse at phase 0.5 after dedispersion, on top of a baseline.
+    offsets = (np.arange(nbin)[None, :] / nbin - delays[:, None]) % 1 - 0.5
+    pulse = 100 + 1000 * np.exp(-0.5 * offsets**2 / 0.05**2)
+    data = np.rint(np.broadcast_to(pulse, (nsub, 1, nchan, nbin)))
+
+    infile = f"{tmp_path}/in.fits"
+    make_psrfits(infile, nsub=nsub, nchan=nchan, nbin=nbin, data=data, dm=dm)
+    port, _, _, _ = read_portrait(infile)
+
+    # The pulse is aligned in all channels and the baseline is removed.
+    assert np.all(np.argmax(port, axis=1) == nbin // 2)
+    assert np.allclose(
+        np.sort(port, axis=1)[:, : nbin // 10], 0, atol=np.abs(port).max() * 0.01
+    )
+
+
+def test_remove_baseline():
+    nbin = 100
+    profile = np.zeros(nbin)
+    profile[40:60] = 1.0
+    port = np.array([profile + 5, 2 * profile - 3])
+    assert np.allclose(remove_baseline(port), [profile, 2 * profile])
+
+
+def test_dispersion_phases():
+    assert get_dispersion_phases(400.0, 800.0, 1.0, 1.0) == pytest.approx(
+        DM_CONSTANT * (400.0**-2 - 800.0**-2)
+    )
+
+
+def test_zap_channels(tmp_path):
+    infile, outfile = f"{tmp_path}/in.fits", f"{tmp_path}/out.fits"
+    make_psrfits(infile, nchan=16)
+    with open(infile, "rb") as f:
+        original = f.read()
+
+    zap_channels(infile, outfile, [1, 5, 100])
+
+    # The input file is not modified when the output file is different.
+    with open(infile, "rb") as f:
+        assert f.read() == original
+
+    profiles, weights, _ = read_profiles(infile)
+    out_profiles, out_weights, _ = read_profiles(outfile)
+    assert np.all(out_weights[:, [1, 5]] == 0)
+    keep = [chan for chan in range(16) if chan not in [1, 5]]
+    assert np.all(out_weights[:, keep] == weights[:, keep])
+    assert np.all(out_profiles == profiles)
+
+    zap_channels(outfile, outfile, [2])
+    assert np.all(read_profiles(outfile)[1][:, [1, 2, 5]] == 0)
@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+from chimerawb.scheduler import (
+    MEMORY_BASE,
+    MEMORY_OVERHEAD_FACTOR,
+    estimate_memory,
+    parse_size,
+    run_jobs,
+)
+
+
+def record_job(log_dir, idx, duration=0.2):
+    """A job that records the interval during which it ran."""
+    start = time.time()
+    time.sleep(duration)
+    end = time.time()
+    with open(f"{log_dir}/{idx}", "w") as f:
+        f.write(f"{start} {end}")
+    return idx
+
+
+def get_intervals(log_dir, njobs):
+    intervals = []
+    for idx in range(njobs):
+        with open(f"{log_dir}/{idx}") as f:
+            intervals.append(tuple(map(float, f.read().split())))
+    return intervals
+
+
+def get_max_in_use(intervals, costs):
+    """The maximum total cost of the jobs running at the same time."""
+    return max(
+        sum(
+            cost
+            for (other_start, other_end), cost in zip(intervals, costs)
+            if other_start <= start < other_end
+        )
+        for start, _ in intervals
+    )
+
+
+@pytest.mark.parametrize(
+    "size, nbytes",
+    [("1000", 1000), ("1.5K", 1536), ("64G", 64 * 1024**3), ("512M", 512 * 1024**2)],
+)
+def test_parse_size(size, nbytes):
+    assert parse_size(size) == nbytes
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_estimate_memory(tmp_path):
+    filename = f"{tmp_path}/a.ar"
+    with open(filename, "wb") as f:
+        f.write(b"\0" * 1000)
+    assert estimate_memory(filename) == MEMORY_BASE + MEMORY_OVERHEAD_FACTOR * 2000
+    assert estimate_memory(filename, (10, 1024, 256, 1)) == (
+        MEMORY_BASE + MEMORY_OVERHEAD_FACTOR * 10 * 1024 * 256 * 4
+    )
+
+
+def test_run_jobs_order(tmp_path):
+    args_list = [(tmp_path, idx, 0.05 * (4 - idx)) for idx in range(4)]
+    assert run_jobs(record_job, args_list, 1) == list(range(4))
+    assert run_jobs(record_job, args_list, 4) == list(range(4))
+
+
+def test_run_jobs_budget(tmp_path):
+    costs = [3, 3, 2, 2, 1, 1]
+    args_list = [(tmp_path, idx) for idx in range(len(costs))]
+    assert run_jobs(record_job, args_list, 6, costs=costs, budget=5) == list(
+        range(len(costs))
+    )
+
+    intervals = get_intervals(tmp_path, len(costs))
+    assert get_max_in_use(intervals, costs) <= 5
+
+    # The budget does not prevent jobs from running in parallel.
+    assert get_max_in_use(intervals, [1] * len(costs)) > 1
+
+
+def test_run_jobs_over_budget_runs_alone(tmp_path):
+    costs = [10, 1, 1, 1]
+    args_list = [(tmp_path, idx) for idx in range(len(costs))]
+    run_jobs(record_job, args_list, 4, costs=costs, budget=5)
+
+    (start, end), *others = get_intervals(tmp_path, len(costs))
+    for other_start, other_end in others:
+        assert other_end <= start or other_start >= end
+
+
+def test_run_jobs_no_budget(tmp_path):
+    # Without a budget, all jobs run at the same time.
+    args_list = [(tmp_path, idx, 0.5) for idx in range(3)]
+    run_jobs(record_job, args_list, 3, costs=[10, 10, 10])
+    intervals = get_intervals(tmp_path, 3)
+    assert get_max_in_use(intervals, [1, 1, 1]) == 3
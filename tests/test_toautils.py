@@ -0,0 +1,263 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from chimerawb import toautils
+from chimerawb.manifest import Manifest
+from chimerawb.toautils import (
+    create_toas_batch,
+    create_toas_parallel,
+    get_partial_tim_filename,
+    get_tim_filename,
+    merge_tim_files,
+    read_tim_file,
+    update_toas,
+    write_tim_file,
+)
+
+
+class FakeGetTOAs:
+    """Stand-in for pptoas.GetTOAs, which creates one TOA for each archive with the
+    MJD written in the archive. Archives whose names contain "fail" make it raise,
+    or are skipped if they are listed in a metafile. Metafiles listing an archive
+    whose name contains "crash" make it raise."""
+
+    calls = []
+
+    def __init__(self, datafile, template):
+        self.datafile = datafile
+
+    def get_TOAs(self, DM0=None):
+        FakeGetTOAs.calls.append(self.datafile)
+        if ".meta" in os.path.basename(self.datafile):
+            with open(self.datafile) as f:
+                datafiles = [line.strip() for line in f]
+            if any("crash" in os.path.basename(f) for f in datafiles):
+                raise RuntimeError("Batch failed.")
+        elif "fail" in os.path.basename(self.datafile):
+            raise RuntimeError("No TOAs.")
+        else:
+            datafiles = [self.datafile]
+
+        self.TOA_list = []
+        for datafile in datafiles:
+            if "fail" in os.path.basename(datafile):
+                continue
+            with open(datafile) as f:
+                mjd = f.read().strip()
+            self.TOA_list.append(SimpleNamespace(archive=datafile, mjd=mjd))
+
+
+def fake_write_TOAs(toas, SNR_cutoff=0.0, outfile=None, append=True):
+    with open(outfile, "a" if append else "w") as f:
+        for toa in toas:
+            f.write(f"{toa.archive} 600.000 {toa.mjd} 1.000 chime\n")
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    monkeypatch.setattr(toautils, "GetTOAs", FakeGetTOAs)
+    monkeypatch.setattr(toautils, "write_TOAs", fake_write_TOAs)
+    FakeGetTOAs.calls = []
+    return SimpleNamespace(
+        output_dir=str(tmp_path),
+        manifest=Manifest(f"{tmp_path}/manifest.sqlite3"),
+        start_time=time.time(),
+        reprocess=False,
+        toa_jobs=1,
+        batch_toas=False,
+        trace_file=None,
+    )
+
+
+@pytest.fixture
+def pulsar(tmp_path):
+    template = f"{tmp_path}/template.spl"
+    with open(template, "w") as f:
+        f.write("template")
+    return SimpleNamespace(name="J0000+0000", template=template, dm=10.0)
+
+
+def make_archives(tmp_path, mjds):
+    archives = []
+    for name, mjd in mjds.items():
+        archive = f"{tmp_path}/{name}.pzap"
+        with open(archive, "w") as f:
+            f.write(mjd)
+        archives.append(archive)
+    return archives
+
+
+def get_tim_archives(session, pulsar):
+    _, toa_lines = read_tim_file(get_tim_filename(session, pulsar))
+    return [line.split()[0] for line in toa_lines]
+
+
+def test_read_write_tim_file(tmp_path):
+    timfile = f"{tmp_path}/a.tim"
+    toa_lines = [
+        "b.pzap 600.000 59002.5 1.000 chime",
+        "a.pzap 600.000 59001.5 1.000 chime",
+    ]
+    write_tim_file(timfile, ["FORMAT 1"], toa_lines)
+    assert read_tim_file(timfile) == (["FORMAT 1"], toa_lines[::-1])
+
+
+def test_merge_tim_files(tmp_path):
+    write_tim_file(f"{tmp_path}/1.tim", ["FORMAT 1"], ["a 600 59003.0 1 chime"])
+    write_tim_file(
+        f"{tmp_path}/2.tim",
+        ["FORMAT 1"],
+        ["b 600 59001.0 1 chime", "c 600 59002.0 1 chime"],
+    )
+    merge_tim_files([f"{tmp_path}/1.tim", f"{tmp_path}/2.tim"], f"{tmp_path}/3.tim")
+    header_lines, toa_lines = read_tim_file(f"{tmp_path}/3.tim")
+    assert header_lines == ["FORMAT 1"]
+    assert [line.split()[0] for line in toa_lines] == ["b", "c", "a"]
+
+
+def test_update_toas(tmp_path, session, pulsar):
+    a, b, c = make_archives(tmp_path, {"a": "59003.5", "b": "59001.5", "c": "59002.5"})
+
+    assert update_toas(session, pulsar, [a, b]) == []
+    assert get_tim_archives(session, pulsar) == [b, a]
+
+    # Only the new file gets TOAs, and they are spliced in MJD order.
+    FakeGetTOAs.calls = []
+    assert update_toas(session, pulsar, [a, b, c]) == []
+    assert FakeGetTOAs.calls == [c]
+    assert get_tim_archives(session, pulsar) == [b, c, a]
+
+    # Nothing to do.
+    FakeGetTOAs.calls = []
+    update_toas(session, pulsar, [a, b, c])
+    assert FakeGetTOAs.calls == []
+
+    # The TOAs of a modified file replace its old TOAs.
+    with open(a, "w") as f:
+        f.write("59000.25")
+    update_toas(session, pulsar, [a, b, c])
+    assert FakeGetTOAs.calls == [a]
+    _, toa_lines = read_tim_file(get_tim_filename(session, pulsar))
+    assert [line.split()[:3:2] for line in toa_lines] == [
+        [a, "59000.25"],
+        [b, "59001.5"],
+        [c, "59002.5"],
+    ]
+
+
+def test_update_toas_removed_files(tmp_path, session, pulsar):
+    a, b = make_archives(tmp_path, {"a": "59001.5", "b": "59002.5"})
+    update_toas(session, pulsar, [a, b])
+
+    update_toas(session, pulsar, [a], keep_other_files=True)
+    assert get_tim_archives(session, pulsar) == [a, b]
+
+    update_toas(session, pulsar, [a])
+    assert get_tim_archives(session, pulsar) == [a]
+
+
+def test_update_toas_failed_files(tmp_path, session, pulsar):
+    a, fail = make_archives(tmp_path, {"a": "59001.5", "fail": "59002.5"})
+    assert update_toas(session, pulsar, [a, fail]) == [fail]
+    assert get_tim_archives(session, pulsar) == [a]
+
+    # Failed files are not retried unless they change.
+    FakeGetTOAs.calls = []
+    assert update_toas(session, pulsar, [a, fail]) == [fail]
+    assert FakeGetTOAs.calls == []
+
+
+def test_update_toas_stale_partial_tim_file(tmp_path, session, pulsar):
+    a, b = make_archives(tmp_path, {"a": "59001.5", "b": "59002.5"})
+    update_toas(session, pulsar, [a])
+
+    # Partial tim files left over by an interrupted run are not spliced in.
+    new_timfile = get_partial_tim_filename(session, pulsar, "new")
+    with open(new_timfile, "w") as f:
+        f.write("stale.pzap 600.000 59000.5 1.000 chime\n")
+
+    update_toas(session, pulsar, [a, b])
+    assert get_tim_archives(session, pulsar) == [a, b]
+    assert not os.path.isfile(new_timfile)
+
+
+def test_update_toas_reprocess(tmp_path, session, pulsar):
+    a, b = make_archives(tmp_path, {"a": "59001.5", "b": "59002.5"})
+    update_toas(session, pulsar, [a, b])
+
+    session.reprocess = True
+    FakeGetTOAs.calls = []
+    update_toas(session, pulsar, [a, b])
+    assert FakeGetTOAs.calls == [a, b]
+    assert get_tim_archives(session, pulsar) == [a, b]
+
+
+def test_create_toas_batch(tmp_path, session, pulsar):
+    a, fail, b = make_archives(
+        tmp_path, {"a": "59002.5", "fail": "59001.5", "b": "59000.5"}
+    )
+    session.output_meta_file = f"{tmp_path}/{pulsar.name}.meta"
+    timfile = get_tim_filename(session, pulsar)
+
+    # The files that GetTOAs skips are failed.
+    assert create_toas_batch(session, pulsar, [a, fail, b]) == [fail]
+    assert len(FakeGetTOAs.calls) == 1
+    assert get_tim_archives(session, pulsar) == [a, b]
+
+    # The temporary metafile is removed, and the output metafile is untouched.
+    assert session.output_meta_file == f"{tmp_path}/{pulsar.name}.meta"
+    assert os.path.isfile(timfile)
+    assert not any(".meta" in f for f in os.listdir(tmp_path))
+
+
+def test_create_toas_batch_fallback(tmp_path, session, pulsar):
+    a, crash, fail = make_archives(
+        tmp_path, {"a": "59002.5", "crash": "59001.5", "fail": "59000.5"}
+    )
+    metafile = f"{tmp_path}/{pulsar.name}.meta.new"
+
+    # If the batch fails, the TOAs are created one by one.
+    assert create_toas_batch(session, pulsar, [a, crash, fail], None, metafile) == [
+        fail
+    ]
+    assert FakeGetTOAs.calls == [metafile, a, crash, fail]
+    assert get_tim_archives(session, pulsar) == [a, crash]
+    assert not os.path.exists(metafile)
+
+
+def test_update_toas_batch(tmp_path, session, pulsar):
+    a, fail, b = make_archives(
+        tmp_path, {"a": "59002.5", "fail": "59001.5", "b": "59000.5"}
+    )
+    session.batch_toas = True
+    assert update_toas(session, pulsar, [a, fail, b]) == [fail]
+    assert get_tim_archives(session, pulsar) == [b, a]
+    assert not any(".meta" in f for f in os.listdir(tmp_path))
+
+
+def test_create_toas_parallel(tmp_path, session, pulsar):
+    a, b, fail, c, crash = make_archives(
+        tmp_path,
+        {
+            "a": "59004.5",
+            "b": "59001.5",
+            "fail": "59003.5",
+            "c": "59000.5",
+            "crash": "59002.5",
+        },
+    )
+    session.toa_jobs = 2
+    timfile = get_tim_filename(session, pulsar)
+
+    # Chunks of [a, fail, crash] and [b, c]. The first chunk falls back to creating
+    # TOAs one by one.
+    failed_files = create_toas_parallel(session, pulsar, [a, b, fail, c, crash])
+    assert failed_files == [fail]
+    assert get_tim_archives(session, pulsar) == [c, b, crash, a]
+
+    # The partial tim and meta files are removed.
+    assert os.path.isfile(timfile)
+    assert not any(".tim." in f or ".meta" in f for f in os.listdir(tmp_path))
@@ -0,0 +1,79 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from chimerawb.trace import (
+    TRACE_PID,
+    get_trace_events_filename,
+    trace_span,
+    write_trace_file,
+)
+
+
+def record_span(session, prefix):
+    with trace_span(session, "level12", "stage", pulsar="J0000+0000", file=prefix):
+        pass
+    return os.getpid()
+
+
+def test_write_trace_file(tmp_path):
+    session = SimpleNamespace(trace_file=f"{tmp_path}/trace.json")
+
+    record_span(session, "a")
+    with pytest.raises(RuntimeError):
+        with trace_span(session, "toagen", "toa", pulsar="J0000+0000"):
+            raise RuntimeError()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        worker_pid = executor.submit(record_span, session, "b").result()
+
+    write_trace_file(session)
+    with open(session.trace_file) as f:
+        events = json.load(f)["traceEvents"]
+
+    # A complete event for each span (also if it raises).
+    spans = [event for event in events if event["ph"] == "X"]
+    assert [(span["name"], span["tid"]) for span in spans] == [
+        ("level12", os.getpid()),
+        ("toagen", os.getpid()),
+        ("level12", worker_pid),
+    ]
+    assert spans[0]["cat"] == "stage"
+    assert spans[0]["args"] == {"pulsar": "J0000+0000", "file": "a"}
+    assert spans[2]["args"]["file"] == "b"
+    for span in spans:
+        assert span["pid"] == TRACE_PID
+        assert span["dur"] >= 0 and span["ts"] > 0
+
+    # The process and each worker process (thread) are named.
+    metadata = [event for event in events if event["ph"] == "M"]
+    assert {"name": "chimerawb"} in [
+        event["args"] for event in metadata if event["name"] == "process_name"
+    ]
+    thread_names = {
+        event["tid"]: event["args"]["name"]
+        for event in metadata
+        if event["name"] == "thread_name"
+    }
+    assert thread_names == {
+        os.getpid(): "main",
+        worker_pid: f"worker {worker_pid}",
+    }
+
+
+def test_no_trace(tmp_path):
+    session = SimpleNamespace(trace_file=None)
+    record_span(session, "a")
+    write_trace_file(session)
+    assert os.listdir(tmp_path) == []
+
+
+def test_write_trace_file_no_events(tmp_path):
+    session = SimpleNamespace(trace_file=f"{tmp_path}/trace.json")
+    write_trace_file(session)
+    with open(session.trace_file) as f:
+        events = json.load(f)["traceEvents"]
+    assert [event["name"] for event in events] == ["process_name"]
+    assert not os.path.exists(get_trace_events_filename(session))
@@ -0,0 +1,92 @@
+import os
+from types import SimpleNamespace
+
+from chimerawb import watch
+from chimerawb.manifest import get_file_signature
+from chimerawb.watch import DirectoryWatcher, process_new_files
+
+
+def write_file(filename, contents, mtime=None):
+    with open(filename, "w") as f:
+        f.write(contents)
+    if mtime is not None:
+        os.utime(filename, (mtime, mtime))
+
+
+def get_complete_files(watcher, ntries=10):
+    """The complete files found within `ntries` checks."""
+    for _ in range(ntries):
+        complete_files = watcher.get_complete_files()
+        if len(complete_files) > 0:
+            return complete_files
+    return []
+
+
+def test_watcher_new_file(tmp_path):
+    old_file = f"{tmp_path}/old.ar"
+    write_file(old_file, "old")
+    watcher = DirectoryWatcher(str(tmp_path), 0.05, 0)
+
+    new_file = f"{tmp_path}/new.ar"
+    write_file(new_file, "new")
+    assert get_complete_files(watcher) == [new_file]
+    assert get_complete_files(watcher, 2) == []
+
+
+def test_watcher_ignore_unchanged(tmp_path):
+    watcher = DirectoryWatcher(str(tmp_path), 0.05, 0)
+
+    # A file that arrives after the watcher is started, but is processed before the
+    # watcher sees it (e.g. in the initial pass over the input dir).
+    filename = f"{tmp_path}/a.ar"
+    write_file(filename, "a", mtime=1000)
+    watcher.ignore_unchanged({filename: get_file_signature(filename)})
+    assert get_complete_files(watcher, 2) == []
+
+    # The file is processed again once it is modified.
+    write_file(filename, "ab", mtime=2000)
+    assert get_complete_files(watcher) == [filename]
+
+
+def test_process_new_files_counts(tmp_path, monkeypatch):
+    statuses = {"a.ar": "success", "b.ar": "skip_exist", "c.ar": "processfail"}
+    monkeypatch.setattr(
+        watch,
+        "process_files",
+        lambda session, pulsar, ar_files: [
+            {
+                "input_file": ar_file,
+                "prefix": ar_file[:-3],
+                "output_file": f"{ar_file[:-3]}.pzap",
+                "status": statuses[ar_file],
+                "exec_time": 1.0,
+                "usage": {},
+            }
+            for ar_file in ar_files
+        ],
+    )
+    metafile_entries = []
+    session = SimpleNamespace(
+        output_dir=str(tmp_path),
+        start_time=0,
+        skip_toagen=True,
+        create_output_metafile=lambda pulsar, files, append: metafile_entries.extend(
+            files
+        ),
+    )
+    pulsar = SimpleNamespace(name="J0000+0000", template="")
+    summary = {
+        "num_files_total": 3,
+        "num_files_success": 1,
+        "num_files_skip_exist": 2,
+        "num_files_processfail": 0,
+    }
+
+    process_new_files(session, pulsar, list(statuses), summary)
+
+    # The file that is up to date has been counted before.
+    assert summary["num_files_total"] == 5
+    assert summary["num_files_success"] == 2
+    assert summary["num_files_skip_exist"] == 2
+    assert summary["num_files_processfail"] == 1
+    assert metafile_entries == ["a.pzap"]